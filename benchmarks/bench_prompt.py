@@ -0,0 +1,222 @@
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import timeit
+
+from mtkresearch.llm.prompt import MRPromptV1, MRPromptV2
+
+
+CJK = [chr(c) for c in range(0x4E00, 0x9FA6)]
+ASCII = 'abcdefghijklmnopqrstuvwxyz     '
+
+
+def make_text(rng, length, cjk=False):
+    pool = CJK if cjk else ASCII
+    return ''.join(rng.choice(pool) for _ in range(length)).strip() or 'x'
+
+
+def make_functions(rng, n_functions, cjk=False):
+    functions = []
+    for i in range(n_functions):
+        properties = {
+            'query': {
+                'type': 'string',
+                'description': make_text(rng, 40, cjk)
+            },
+            'limit': {
+                'type': 'integer',
+                'description': make_text(rng, 20, cjk),
+                'default': 10
+            },
+            'unit': {
+                'type': 'string',
+                'enum': ['celsius', 'fahrenheit']
+            }
+        }
+        functions.append({
+            'name': f'function_{i}',
+            'description': make_text(rng, 80, cjk),
+            'parameters': {
+                'type': 'object',
+                'properties': properties,
+                'required': ['query']
+            }
+        })
+    return functions
+
+
+def make_conversations(rng, n_turns, functions=None, payload_size=32, cjk=False, calls_per_turn=2):
+    # system turn, then rounds of a user turn, tool calls with their responses when there are
+    # `functions`, and an answer, until there are `n_turns` turns after the system turn
+    conversations = [{'role': 'system', 'content': make_text(rng, 100, cjk)}]
+    n = 0
+    while n < n_turns:
+        conversations.append({'role': 'user', 'content': make_text(rng, 100, cjk)})
+        n += 1
+        if functions and n + calls_per_turn + 2 <= n_turns:
+            tool_calls = []
+            for j in range(calls_per_turn):
+                function = rng.choice(functions)
+                tool_calls.append({
+                    'id': f'call_{n}_{j}',
+                    'type': 'function',
+                    'function': {
+                        'name': function['name'],
+                        'arguments': json.dumps({'query': make_text(rng, payload_size, cjk), 'unit': 'celsius'},
+                                                ensure_ascii=False)
+                    }
+                })
+            conversations.append({'role': 'assistant', 'tool_calls': tool_calls})
+            for c in tool_calls:
+                conversations.append({
+                    'role': 'tool',
+                    'tool_call_id': c['id'],
+                    'name': c['function']['name'],
+                    'content': json.dumps({'result': make_text(rng, payload_size, cjk)}, ensure_ascii=False)
+                })
+            n += 1 + calls_per_turn
+        conversations.append({'role': 'assistant', 'content': make_text(rng, 200, cjk)})
+        n += 1
+    return conversations
+
+
+def make_generated_str(prompt, rng, functions=None, n_calls=0, payload_size=32, cjk=False):
+    if isinstance(prompt, MRPromptV2):
+        if n_calls:
+            calls = ''.join(
+                prompt.tool_call_begin_token + json.dumps({
+                    'name': rng.choice(functions)['name'],
+                    'arguments': json.dumps({'query': make_text(rng, payload_size, cjk)}, ensure_ascii=False)
+                }, ensure_ascii=False) + prompt.tool_call_end_token
+                for _ in range(n_calls)
+            )
+            return prompt.tool_call_token + calls + prompt.instance_end_token
+        return prompt.answer_token + make_text(rng, payload_size, cjk) + prompt.instance_end_token
+    return make_text(rng, payload_size, cjk) + prompt.eos_token
+
+
+def build_cases(seed=0):
+    # {case name: zero-argument callable}
+    cases = {}
+    for version, prompt in [('v1', MRPromptV1()), ('v2', MRPromptV2())]:
+        for cjk in [False, True]:
+            script = 'cjk' if cjk else 'ascii'
+            for n_turns in [4, 32, 256]:
+                rng = random.Random(seed)
+                conversations = make_conversations(rng, n_turns, cjk=cjk)
+                cases[f'{version}/get_prompt/turns={n_turns}/{script}'] = \
+                    lambda p=prompt, c=conversations: p.get_prompt(c)
+                cases[f'{version}/check_conversations/turns={n_turns}/{script}'] = \
+                    lambda p=prompt, c=conversations: p.check_conversations(c)
+
+            rng = random.Random(seed)
+            generated_str = make_generated_str(prompt, rng, payload_size=1024, cjk=cjk)
+            cases[f'{version}/parse_generated_str/answer/{script}'] = \
+                lambda p=prompt, s=generated_str: p.parse_generated_str(s)
+
+    prompt = MRPromptV2()
+    for cjk in [False, True]:
+        script = 'cjk' if cjk else 'ascii'
+        for n_functions in [1, 16, 128]:
+            rng = random.Random(seed)
+            functions = make_functions(rng, n_functions, cjk)
+            cases[f'v2/check_functions/functions={n_functions}/{script}'] = \
+                lambda f=functions: prompt.check_functions(f)
+            for payload_size in [32, 4096]:
+                conversations = make_conversations(rng, 32, functions, payload_size, cjk)
+                name = f'functions={n_functions}/payload={payload_size}/{script}'
+                cases[f'v2/get_prompt/tools/{name}'] = \
+                    lambda f=functions, c=conversations: prompt.get_prompt(c, f)
+                cases[f'v2/check_conversations/tools/{name}'] = \
+                    lambda f=functions, c=conversations: prompt.check_conversations(c, functions=f)
+                cases[f'v2/parse_prompt/tools/{name}'] = \
+                    lambda t=prompt.get_prompt(conversations, functions): prompt.parse_prompt(t)
+        for n_calls in [1, 8]:
+            for payload_size in [32, 4096]:
+                rng = random.Random(seed)
+                functions = make_functions(rng, 4, cjk)
+                generated_str = make_generated_str(prompt, rng, functions, n_calls, payload_size, cjk)
+                cases[f'v2/parse_generated_str/calls={n_calls}/payload={payload_size}/{script}'] = \
+                    lambda s=generated_str: prompt.parse_generated_str(s)
+    return cases
+
+
+def run_case(func, repeat, min_time):
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {'best': min(times), 'median': statistics.median(times), 'number': number, 'repeat': repeat}
+
+
+def compare(results, baseline, threshold):
+    # returns the names of the cases slower than the baseline by more than `threshold`
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name]['best'] / baseline[name]['best']
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        print(f'{name:70s} {baseline[name]["best"] * 1e6:12.2f}us {results[name]["best"] * 1e6:12.2f}us '
+              f'{ratio:6.2f}x{flag}', file=sys.stderr)
+    return regressions
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark prompt rendering, validation and parsing of MRPromptV1 and MRPromptV2.')
+    parser.add_argument('-o', '--output', default=None, help='write the results as JSON to this file')
+    parser.add_argument('--baseline', default=None, help='results JSON of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression, 0.1 by default')
+    parser.add_argument('-k', '--filter', default=None, help='only run the cases containing this string')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.05, help='seconds per repeat of a case')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    cases = build_cases(args.seed)
+    results = {}
+    for name, func in cases.items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = run_case(func, args.repeat, args.min_time)
+        print(f'{name:70s} {results[name]["best"] * 1e6:12.2f}us', file=sys.stderr)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        print('\nbaseline / current:', file=sys.stderr)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regressions', file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import collections
+import concurrent.futures
+import pickle
+
+from .prompt import compile_functions
+
+
+class RenderError(ValueError):
+    def __init__(self, index, error_type, message):
+        super().__init__(f'conversation {index}: {error_type}: {message}')
+        self.index = index
+        self.error_type = error_type
+        self.message = message
+
+    def __reduce__(self):
+        return RenderError, (self.index, self.error_type, self.message)
+
+
+_worker_prompt = (None, None)  # (pickled prompt, prompt) of the last chunk rendered by this worker
+
+
+def _load_prompt(pickled):
+    # the prompt travels pickled with each chunk, a few hundred bytes, and is unpickled once
+    # per worker; `initializer` of the executor would need Python 3.7
+    global _worker_prompt
+    if _worker_prompt[0] != pickled:
+        _worker_prompt = (pickled, pickle.loads(pickled))
+    return _worker_prompt[1]
+
+
+def _render(prompt, conversations, functions, add_bos_token, return_spans=False):
+    try:
+        if functions is None:
+            return True, prompt.get_prompt(conversations, add_bos_token=add_bos_token, return_spans=return_spans)
+        return True, prompt.get_prompt(conversations, functions, add_bos_token=add_bos_token,
+                                       return_spans=return_spans)
+    except Exception as e:
+        return False, (type(e).__name__, str(e))
+
+
+def _render_chunk(pickled_prompt, items, add_bos_token, return_spans=False):
+    prompt = _load_prompt(pickled_prompt)
+    return [_render(prompt, conversations, functions, add_bos_token, return_spans)
+            for conversations, functions in items]
+
+
+def _prepare(items):
+    # compile the function lists in the parent; a list shared by consecutive items is compiled
+    # once, and the catalogs are pickled as their serialized header and picked up from the
+    # catalog cache of each worker
+    last = (None, None)
+    for i, (conversations, functions) in enumerate(items):
+        if functions is not None:
+            if functions is not last[0]:
+                try:
+                    last = (functions, (True, compile_functions(functions)))
+                except Exception as e:
+                    last = (functions, (False, (type(e).__name__, str(e))))
+            ok, functions = last[1]
+            if not ok:
+                yield i, None, RenderError(i, *functions)
+                continue
+        yield i, conversations, functions
+
+
+def _result(index, rendered):
+    ok, value = rendered
+    return value if ok else RenderError(index, *value)
+
+
+def _collect(chunk, future):
+    rendered = iter(future.result())
+    for i, conversations, functions in chunk:
+        yield functions if isinstance(functions, RenderError) else _result(i, next(rendered))
+
+
+def iter_prompts(prompt, items, add_bos_token=False, workers=None, chunksize=64, window=None, return_spans=False):
+    # Lazily renders (conversations, functions) pairs with `prompt.get_prompt` and yields the
+    # prompts in order, or (prompt, spans) pairs with `return_spans`. A conversation which
+    # fails validation yields a RenderError instead of aborting the run. At most `window`
+    # chunks are in flight, so memory stays bounded for inputs of any length.
+    prepared = _prepare(items)
+    if not workers or workers <= 1:
+        for i, conversations, functions in prepared:
+            if isinstance(functions, RenderError):
+                yield functions
+            else:
+                yield _result(i, _render(prompt, conversations, functions, add_bos_token, return_spans))
+        return
+
+    window = window or 2 * workers
+    in_flight = collections.deque()
+    pickled_prompt = pickle.dumps(prompt)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        chunk = []
+        for item in prepared:
+            chunk.append(item)
+            if len(chunk) < chunksize:
+                continue
+            renderable = [(c, f) for _, c, f in chunk if not isinstance(f, RenderError)]
+            in_flight.append((chunk, executor.submit(_render_chunk, pickled_prompt, renderable, add_bos_token, return_spans)))
+            chunk = []
+            if len(in_flight) >= window:
+                yield from _collect(*in_flight.popleft())
+        if chunk:
+            renderable = [(c, f) for _, c, f in chunk if not isinstance(f, RenderError)]
+            in_flight.append((chunk, executor.submit(_render_chunk, pickled_prompt, renderable, add_bos_token, return_spans)))
+        while in_flight:
+            yield from _collect(*in_flight.popleft())
+
+
+def get_prompts(prompt, conversations_list, functions_list=None, add_bos_token=False, workers=None, chunksize=64):
+    if functions_list is not None and len(functions_list) != len(conversations_list):
+        raise ValueError('functions_list and conversations_list differ in length')
+    if functions_list is None:
+        functions_list = [None] * len(conversations_list)
+    return list(iter_prompts(prompt, zip(conversations_list, functions_list), add_bos_token=add_bos_token,
+                             workers=workers, chunksize=chunksize))
@@ -0,0 +1,80 @@
+import os
+import random
+import string
+import threading
+
+
+_ALPHABET = string.ascii_letters + string.digits
+# bytes below this bound map to the alphabet without bias, the others are dropped
+_UNBIASED = 256 - 256 % len(_ALPHABET)
+_TABLE = bytes(ord(_ALPHABET[b % len(_ALPHABET)]) if b < _UNBIASED else 0 for b in range(256))
+_DROPPED = bytes(range(_UNBIASED, 256))
+
+
+class CallIdAllocator:
+    # Generates the ids of parsed tool calls, `call_` followed by 24 letters and digits.
+    #   'random': `random.choice` on the global random state, as `MRPromptV2.generate_call_id`
+    #   'fast': drawn from a buffer of `os.urandom` bytes refilled in batches
+    #   'seeded': drawn from a `random.Random(seed)` of its own, reproducible across runs
+    def __init__(self, mode='fast', seed=None, length=24, prefix='call_', batch_size=4096):
+        if mode not in ('random', 'fast', 'seeded'):
+            raise ValueError(f'Unknown mode: {mode!r}')
+        self.mode = mode
+        self.seed = seed
+        self.length = length
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed) if mode == 'seeded' else None
+        self._buffer = ''  # letters and digits not used yet, from `_pos`
+        self._pos = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        # a copy must not hand out the ids left in the buffer
+        state['_buffer'] = ''
+        state['_pos'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _fast_key(self):
+        with self._lock:
+            end = self._pos + self.length
+            while end > len(self._buffer):
+                fresh = os.urandom(max(self.batch_size, self.length)).translate(_TABLE, _DROPPED).decode('ascii')
+                self._buffer = self._buffer[self._pos:] + fresh
+                self._pos = 0
+                end = self.length
+            key = self._buffer[self._pos:end]
+            self._pos = end
+        return key
+
+    def __call__(self):
+        if self.mode == 'fast':
+            key = self._fast_key()
+        elif self.mode == 'seeded':
+            with self._lock:
+                key = ''.join(self._rng.choices(_ALPHABET, k=self.length))
+        else:
+            key = ''.join(random.choice(_ALPHABET) for _ in range(self.length))
+        return f'{self.prefix}{key}'
+
+    def group(self):
+        return _unique_ids(self)
+
+
+def _unique_ids(generate_call_id):
+    # wraps `generate_call_id` so that the ids of one tool_calls group never repeat
+    seen = set()
+
+    def generate():
+        while True:
+            call_id = generate_call_id()
+            if call_id not in seen:
+                seen.add(call_id)
+                return call_id
+    return generate
@@ -1,18 +1,156 @@
+import asyncio
+import bisect
+import contextlib
+import copy
 import json
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from .json_str import JsonStr
+from .prompt import FunctionCatalog, _chain_hash, compile_functions
+from .tools import _error_result, _tool_result
+
+
+_logger = logging.getLogger(__name__)
+
+
+def _read_only(*args, **kwargs):
+    raise TypeError('MRChatManager.conversations is read-only; assign an edited copy, '
+                    'e.g. of copy.deepcopy(manager.conversations), to it')
+
+
+class _ReadOnlyDict(dict):
+    # a dict of `MRChatManager.conversations`; its copies are plain dicts
+    __slots__ = ()
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def copy(self):
+        return dict(self)
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {key: copy.deepcopy(value, memo) for key, value in self.items()}
+
+    def __reduce_ex__(self, protocol):
+        return dict, (dict(self),)
+
+
+class _ReadOnlyList(list):
+    # a list of `MRChatManager.conversations`; its copies, slices and sums are plain lists
+    __slots__ = ()
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = insert = pop = remove = clear = \
+        sort = reverse = _read_only
+
+    def copy(self):
+        return list(self)
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(value, memo) for value in self]
+
+    def __reduce_ex__(self, protocol):
+        return list, (list(self),)
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return _ReadOnlyDict((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return _ReadOnlyList(_freeze(item) for item in value)
+    return value
+
+
+class _Turn:
+    # Compact form of one conversation turn. Roles and function names are interned, so the
+    # tool turns share them with the calls they answer; a turn of any other shape keeps a copy
+    # of its dict in `raw`.
+    __slots__ = ('role', 'content', 'tool_calls', 'tool_call_id', 'name', 'raw')
+
+    def __init__(self, role, content=None, tool_calls=None, tool_call_id=None, name=None, raw=None):
+        self.role = role
+        self.content = content
+        self.tool_calls = tool_calls  # ((id, name, arguments), ...)
+        self.tool_call_id = tool_call_id
+        self.name = name
+        self.raw = raw
+
+    @classmethod
+    def from_dict(cls, conv):
+        role = conv.get('role') if isinstance(conv, dict) else None
+        if isinstance(role, str):
+            role = sys.intern(role)
+            keys = conv.keys()
+            if keys == {'role', 'content'}:
+                return cls(role, content=conv['content'])
+            if role == 'tool' and keys == {'role', 'tool_call_id', 'name', 'content'} and \
+                    isinstance(conv['name'], str):
+                return cls(role, content=conv['content'], tool_call_id=conv['tool_call_id'],
+                           name=sys.intern(conv['name']))
+            if role == 'assistant' and keys == {'role', 'tool_calls'} and isinstance(conv['tool_calls'], list):
+                tool_calls = []
+                for x in conv['tool_calls']:
+                    if not (isinstance(x, dict) and x.keys() == {'id', 'type', 'function'} and
+                            x['type'] == 'function' and isinstance(x['function'], dict) and
+                            x['function'].keys() == {'name', 'arguments'} and
+                            isinstance(x['function']['name'], str)):
+                        break
+                    tool_calls.append((x['id'], sys.intern(x['function']['name']), x['function']['arguments']))
+                else:
+                    return cls(role, tool_calls=tuple(tool_calls))
+        return cls(role, raw=copy.deepcopy(conv))
+
+    def view(self):
+        # the turn as a read-only dict sharing the values of the turn, built without copying
+        if self.raw is not None:
+            return _freeze(self.raw)
+        if self.tool_calls is not None:
+            return _ReadOnlyDict(role=self.role, tool_calls=_ReadOnlyList(
+                _ReadOnlyDict(id=call_id, type='function',
+                              function=_ReadOnlyDict(name=name, arguments=_freeze(arguments)))
+                for call_id, name, arguments in self.tool_calls
+            ))
+        if self.name is not None:
+            return _ReadOnlyDict(role=self.role, tool_call_id=self.tool_call_id, name=self.name,
+                                 content=_freeze(self.content))
+        return _ReadOnlyDict(role=self.role, content=_freeze(self.content))
+
+    def __eq__(self, other):
+        if not isinstance(other, _Turn):
+            return NotImplemented
+        return self.role == other.role and self.content == other.content and \
+            self.tool_calls == other.tool_calls and self.tool_call_id == other.tool_call_id and \
+            self.name == other.name and self.raw == other.raw
 
 
 class MRChatManager:
-    def __init__(self, prompt, sys_prompt=None, functions=None):
+    def __init__(self, prompt, sys_prompt=None, functions=None, validate_arguments=False,
+                 max_length=None, length_function=len, call_id_allocator=None, instrumentation=None):
         self.functions = functions
         self.prompt = prompt  # MRPromptV1, MRPromptV2
+        # check the arguments of parsed tool calls against `functions` and fill in defaults
+        self.validate_arguments = validate_arguments
+        # drop the oldest turns once the prompt gets longer than `max_length`, as measured by
+        # `length_function` (len for characters, or the token count of a tokenizer)
+        self.max_length = max_length
+        self.length_function = length_function
+        # ids of the parsed tool calls, a CallIdAllocator or any callable returning a new id
+        self.call_id_allocator = call_id_allocator
+        # metrics.Instrumentation, the one of `prompt` by default
+        self.instrumentation = instrumentation if instrumentation is not None else \
+            getattr(prompt, 'instrumentation', None)
 
+        self._turns = []  # _Turn of each conversation turn, the system turn included
         if sys_prompt:
-            self.conversations = [
-                {'role': 'system', 'content': sys_prompt}
-            ]
-        else:
-            self.conversations = []
-        self._last_func_calls = {}
+            self._turns.append(_Turn('system', content=sys_prompt))
+        self._last_func_calls = {}  # {call id: function name} of the calls waiting for a response
+        self._reset_prompt_cache()
 
     def __enter__(self):
         return self
@@ -20,15 +158,228 @@ class MRChatManager:
     def __exit__(self, exc_type, exc_val, exc_tb):
         del self
 
+    @property
+    def conversations(self):
+        # a read-only snapshot of the history, whose edits raise a TypeError; assign an edited
+        # copy back to change the history. The snapshot shares the values of the turns.
+        return _ReadOnlyList(turn.view() for turn in self._turns)
+
+    @conversations.setter
+    def conversations(self, conversations):
+        turns = [_Turn.from_dict(conv) for conv in conversations]
+        n = min(len(turns), len(self._turns))
+        valid = 0
+        while valid < n and turns[valid] == self._turns[valid]:
+            valid += 1
+        if valid < len(self._turns):
+            self._invalidate(valid)
+        self._turns = turns
+
+    def _reset_prompt_cache(self):
+        self._cached_functions = None  # (functions, compiled catalog) the cache was built for
+        self._cached_format = None  # the compiled format of `prompt` the cache was rendered with
+        self._cached_header = None  # (add_bos_token, rendered header, header blocks)
+        self._cached_header_hashes = None  # [(end, hash)] of the header blocks
+        self._cached_digests = []  # chained hashes of `_cached_segments`, computed on request
+        self._cached_segments = []  # rendered turns after the system turn, all but the last one
+        self._cached_user_turns = []  # indices of the validated user turns after the system turn
+        self._cached_lengths = [0]  # running sums of the lengths of `_cached_segments`
+        self._cached_length_function = None
+        self._cached_header_length = None  # (header, length)
+        self._validator = None
+        self._validated = 0  # number of turns fed to `_validator`
+
+    def _invalidate(self, index):
+        # drop the cache from the turn at `index` on, which was edited, replaced or removed
+        if self.instrumentation is not None:
+            self.instrumentation.count('chat.invalidations')
+        offset = 1 if self._turns and self._turns[0].role == 'system' else 0
+        if index < offset or index == 0:
+            self._reset_prompt_cache()
+            return
+        # the rendered segment of a turn also depends on the role of the turn following it
+        kept = max(index - offset - 1, 0)
+        del self._cached_segments[kept:]
+        del self._cached_digests[kept:]
+        del self._cached_lengths[kept + 1:]
+        del self._cached_user_turns[bisect.bisect_left(self._cached_user_turns, index - offset):]
+        self._validator = None
+        self._validated = min(self._validated, index)
+
+    def _sync_functions(self):
+        # a FunctionCatalog is immutable and only referenced, as the one shared by the sessions
+        # of a pool; a list may have been edited in place, so it is compiled again and compared
+        # by the fingerprint of its catalog, a lookup in the catalog cache for a known list
+        functions = self.functions
+        if self._cached_functions is not None and self._cached_functions[0] is functions and \
+                isinstance(functions, FunctionCatalog):
+            return self._cached_functions[1]
+        catalog = compile_functions(functions) if functions else None
+        if self._cached_functions is None or self._cached_functions[1] != catalog:
+            self._cached_header = None
+            self._validator = None
+        self._cached_functions = (functions, catalog)
+        return catalog
+
+    def _sync_format(self):
+        # the rendered header and turns depend on the format compiled for the config and tokens
+        # of the prompt, which may have changed since the last call; validation does not
+        fmt = self.prompt._format()
+        if self._cached_format is not fmt:
+            self._cached_format = fmt
+            self._cached_header = None
+            self._cached_header_length = None
+            self._cached_digests = []
+            self._cached_segments = []
+            self._cached_lengths = [0]
+
+    def _sync_prompt_cache(self, offset):
+        self._sync_format()
+        catalog = self._sync_functions()
+        turns = self._turns
+        views = {}  # dict views of the turns used below, built once
+
+        def view(i):
+            if i not in views:
+                views[i] = turns[i].view()
+            return views[i]
+
+        if self._validator is None:
+            validator = self.prompt._validator(functions=catalog)
+            for i in range(self._validated):
+                validator.feed(view(i))
+            self._validator = validator
+        for i in range(self._validated, len(turns)):
+            self._validator.feed(view(i))
+            self._validated = i + 1
+            if turns[i].role == 'user' and i >= offset:
+                self._cached_user_turns.append(i - offset)
+        self._validator.finish()
+
+        rendered = []
+        for i in range(len(self._cached_segments) + offset, len(turns) - 1):
+            rendered.append(self.prompt._render_turn(view(i), view(i + 1)))
+        self._cached_segments.extend(rendered)
+        last = self.prompt._render_turn(view(len(turns) - 1)) if len(turns) > offset else ''
+        return catalog, last
+
+    def get_prompt(self, add_bos_token=False, return_block_hashes=False):
+        # same output as `self.prompt.get_prompt(self.conversations, self.functions)`, but only
+        # the turns appended since the last call are validated, rendered and hashed
+        system = self._turns[0]
+        sys = None
+        offset = 0
+        if system.role == 'system':
+            sys = system.view()['content']
+            offset = 1
+
+        metrics = self.instrumentation
+        if metrics is None:
+            catalog, last = self._sync_prompt_cache(offset)
+        else:
+            start = metrics.clock()
+            segments = len(self._cached_segments)
+            try:
+                catalog, last = self._sync_prompt_cache(offset)
+            except Exception:
+                metrics.count('chat.validate.errors')
+                raise
+            metrics.duration('chat.sync', metrics.clock() - start)
+            metrics.size('chat.rendered_turns', len(self._cached_segments) - segments + bool(last))
+
+        if self._cached_header is None or self._cached_header[0] != add_bos_token:
+            blocks = self.prompt._render_header_blocks(sys, functions=catalog, add_bos_token=add_bos_token)
+            self._cached_header = (add_bos_token, ''.join(blocks), blocks)
+            self._cached_header_hashes = None
+            self._cached_digests = []
+            if metrics is not None:
+                metrics.count('chat.header_renders')
+
+        if self.max_length is not None:
+            if metrics is None:
+                self._truncate(offset, last)
+            else:
+                start = metrics.clock()
+                if self._truncate(offset, last):
+                    metrics.count('chat.truncations')
+                metrics.duration('chat.truncate', metrics.clock() - start)
+        # the segments are joined on demand rather than kept twice, the prompt is a copy anyway
+        prompt = ''.join((self._cached_header[1], *self._cached_segments, last))
+        if metrics is not None:
+            metrics.size('chat.prompt_chars', len(prompt))
+        if return_block_hashes:
+            return prompt, self._block_hashes(catalog, last)
+        return prompt
+
+    def _block_hashes(self, catalog, last):
+        if self._cached_header_hashes is None:
+            self._cached_header_hashes = []
+            position = 0
+            digest = b''
+            for block in self._cached_header[2]:
+                position += len(block)
+                digest = _chain_hash(digest, block, catalog)
+                self._cached_header_hashes.append((position, digest))
+
+        position, digest = self._cached_header_hashes[-1]
+        digests = self._cached_digests
+        if digests:
+            digest = digests[-1]
+        for segment in self._cached_segments[len(digests):]:
+            if segment:
+                digest = _chain_hash(digest, segment)
+            digests.append(digest)
+
+        block_hashes = [(end, x.hex()) for end, x in self._cached_header_hashes]
+        for segment, digest in zip(self._cached_segments, digests):
+            if segment:
+                position += len(segment)
+                block_hashes.append((position, digest.hex()))
+        if last:
+            block_hashes.append((position + len(last), _chain_hash(digest, last).hex()))
+        return block_hashes
+
+    def _truncate(self, offset, last):
+        # Drops the oldest turns so that the prompt fits in `max_length`. The kept history
+        # starts at a user turn, so tool calls and their responses are dropped together, and the
+        # system turn is always kept. Only new segments are measured; the cut point is found by
+        # binary search over the running length sums.
+        measure = self.length_function
+        lengths = self._cached_lengths
+        if self._cached_length_function is not measure:
+            del lengths[1:]
+            self._cached_length_function = measure
+            self._cached_header_length = None
+        for segment in self._cached_segments[len(lengths) - 1:]:
+            lengths.append(lengths[-1] + measure(segment))
+        if self._cached_header_length is None or self._cached_header_length[0] is not self._cached_header[1]:
+            self._cached_header_length = (self._cached_header[1], measure(self._cached_header[1]))
+
+        excess = self._cached_header_length[1] + lengths[-1] + measure(last) - self.max_length
+        if excess <= 0:
+            return False
+
+        user_turns = self._cached_user_turns
+        k = bisect.bisect_left(user_turns, bisect.bisect_left(lengths, excess))
+        if k == len(user_turns):
+            k -= 1  # nothing fits, keep the history from the latest user turn
+        cut = user_turns[k] if k >= 0 else 0
+        if cut <= 0:
+            return False
+
+        del self._turns[offset:offset + cut]
+        del self._cached_segments[:cut]
+        self._cached_user_turns = [i - cut for i in user_turns[k:]]
+        self._cached_lengths = [x - lengths[cut] for x in lengths[cut:]]
+        self._cached_digests = []
+        self._validator.drop_turns(cut)
+        self._validated -= cut
+        return True
+
     def user_input(self, message):
         if self._last_func_calls:
             raise ValueError
-        self.conversations.append(
-            {
-                'role': 'user',
-                'content': message
-            }
-        )
+        self._turns.append(_Turn('user', content=message))
 
     def func_response(self, call_id, result):
         if self.functions is None:
@@ -36,32 +387,251 @@ class MRChatManager:
         if not isinstance(result, dict):
             raise ValueError
 
-        name = self._last_func_calls[call_id]['name']
-        self.conversations.append(
-            {
-                'role': 'tool',
-                'tool_call_id': call_id,
-                'name': name,
-                'content': json.dumps(result)
-            }
-        )
+        name = self._last_func_calls[call_id]
+        self._turns.append(_Turn('tool', content=JsonStr.dumps(result), tool_call_id=call_id, name=name))
         del self._last_func_calls[call_id]
 
     def parse_assistant(self, generated_str):
         if self._last_func_calls:
             raise ValueError
 
-        conv = self.prompt.parse_generated_str(generated_str)
-        self.conversations.append(conv)
+        conv = self.prompt.parse_generated_str(generated_str, call_id_allocator=self.call_id_allocator)
 
         if 'tool_calls' in conv:
-            self._last_func_calls = {x['id']: x['function'] for x in conv['tool_calls']}
-            return {'func_calls':[
+            func_calls = [
                 {
                     'name': x['function']['name'],
+                    # a copy of its own for the caller, the turn keeps the generated text
                     'arguments': json.loads(x['function']['arguments']),
                     'id': x['id']
                 } for x in conv['tool_calls']
-            ]}
+            ]
+            if self.validate_arguments:
+                catalog = self._sync_functions()
+                for x in func_calls:
+                    if catalog is None or x['name'] not in catalog.mapping:
+                        raise ValueError(f"Unknown function: '{x['name']}'")
+                    x['arguments'] = catalog.validator(x['name'])(x['arguments'])
+
+            turn = _Turn.from_dict(conv)
+            self._turns.append(turn)
+            if turn.tool_calls is not None:
+                self._last_func_calls = {call_id: name for call_id, name, _ in turn.tool_calls}
+            else:
+                self._last_func_calls = {x['id']: x['function']['name'] for x in conv['tool_calls']}
+            return {'func_calls': func_calls}
         else:
+            self._turns.append(_Turn.from_dict(conv))
             return {'message': conv['content']}
+
+
+class AsyncMRChatManager(MRChatManager):
+    # MRChatManager which runs the tool calls of an assistant turn with registered async
+    # callables. The calls of one turn run concurrently, each with its own timeout, and the
+    # results are recorded with `func_response` in the order of the calls, so the prompt does
+    # not depend on which call finishes first. With a `cache`, the results of the tools
+    # registered as idempotent are reused.
+    def __init__(self, prompt, sys_prompt=None, functions=None, tools=None, timeout=None, cache=None, **kwargs):
+        super().__init__(prompt, sys_prompt=sys_prompt, functions=functions, **kwargs)
+        self.timeout = timeout  # default seconds per call, None for no limit
+        self.cache = cache  # ToolResultCache
+        self.tools = {}  # {function name: (async callable, timeout)}
+        for name, tool in (tools or {}).items():
+            self.register_tool(name, tool)
+
+    def register_tool(self, name, tool, timeout=None, idempotent=False, ttl=None):
+        # `tool` is called with the arguments of the call as keyword arguments; the results of
+        # an idempotent tool are cached for `ttl` seconds
+        self.tools[name] = (tool, timeout)
+        if idempotent:
+            if self.cache is None:
+                raise ValueError('idempotent tools need a cache')
+            self.cache.register(name, ttl)
+
+    async def _call_tool(self, func_call):
+        try:
+            tool, timeout = self.tools[func_call['name']]
+        except KeyError:
+            return {'error': f"KeyError: Unknown tool: '{func_call['name']}'"}
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(func_call['name'], func_call['arguments'])
+            if key is not None:
+                result = self.cache.get(key)
+                if result is not None:
+                    return result
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            result = await asyncio.wait_for(tool(**func_call['arguments']), timeout)
+        except asyncio.TimeoutError:
+            return {'error': f'TimeoutError: No result after {timeout} seconds'}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return _error_result(e)
+        result = _tool_result(result)
+        if key is not None:
+            self.cache.put(key, result)
+        return result
+
+    async def run_tools(self, func_calls):
+        # Runs `func_calls`, as returned by `parse_assistant`, and records their results. A
+        # failed or timed out call records {'error': ...}. If this coroutine is cancelled, the
+        # calls still running are cancelled and record {'error': 'CancelledError: ...'}, the
+        # finished ones their result, so the conversation can go on with the next turn.
+        tasks = [asyncio.ensure_future(self._call_tool(x)) for x in func_calls]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            for x, task in zip(func_calls, tasks):
+                if x['id'] not in self._last_func_calls:
+                    continue
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    self.func_response(x['id'], task.result())
+                else:
+                    self.func_response(x['id'], {'error': 'CancelledError: The call was cancelled'})
+            raise
+        for x, result in zip(func_calls, results):
+            self.func_response(x['id'], result)
+        return results
+
+    async def step(self, generated_str):
+        # `parse_assistant` followed by `run_tools` for a turn with tool calls
+        result = self.parse_assistant(generated_str)
+        if 'func_calls' in result:
+            result['results'] = await self.run_tools(result['func_calls'])
+        return result
+
+
+class _Session:
+    __slots__ = ('manager', 'lock', 'last_used', 'users')
+
+    def __init__(self, manager, last_used):
+        self.manager = manager
+        self.lock = threading.RLock()
+        self.last_used = last_used
+        self.users = 0  # threads holding or waiting for `lock` through the pool
+
+
+class ChatSessionPool:
+    # Owns MRChatManager sessions by id for a multi-threaded server. The pool keeps at most
+    # `max_sessions` sessions and drops the ones idle for longer than `idle_ttl` seconds, least
+    # recently used first; `spill(session_id, manager)` is called for every evicted session. A
+    # session is used under its own lock, and a session in use is never evicted. The prompt
+    # object and the compiled function catalog are shared by all sessions.
+    def __init__(self, prompt, sys_prompt=None, functions=None, max_sessions=None, idle_ttl=None,
+                 spill=None, clock=time.monotonic, **manager_kwargs):
+        self.prompt = prompt
+        self.sys_prompt = sys_prompt
+        self.functions = compile_functions(functions) if functions else None
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.spill = spill
+        self.clock = clock
+        self.manager_kwargs = manager_kwargs
+
+        self._sessions = OrderedDict()  # {session id: _Session}, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def __contains__(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+    def _new_manager(self):
+        return MRChatManager(self.prompt, sys_prompt=self.sys_prompt, functions=self.functions,
+                             **self.manager_kwargs)
+
+    @contextlib.contextmanager
+    def session(self, session_id, create=True):
+        # yields the manager of `session_id` with its lock held
+        with self._lock:
+            now = self.clock()
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                if not create:
+                    raise KeyError(session_id)
+                entry = _Session(self._new_manager(), now)
+                self._sessions[session_id] = entry
+            else:
+                entry.last_used = now
+                self._sessions.move_to_end(session_id)
+            entry.users += 1
+            evicted = self._select_evicted(now)
+
+        try:
+            self._spill(evicted)
+            with entry.lock:
+                yield entry.manager
+        finally:
+            with self._lock:
+                entry.users -= 1
+                entry.last_used = self.clock()
+                if self._sessions.get(session_id) is entry:
+                    self._sessions.move_to_end(session_id)
+                # sessions skipped while in use are evicted once released
+                evicted = self._select_evicted(entry.last_used)
+            self._spill(evicted)
+
+    def add(self, session_id, manager):
+        # puts a manager, e.g. one restored from a spilled session, under `session_id`
+        with self._lock:
+            now = self.clock()
+            previous = self._sessions.pop(session_id, None)
+            self._sessions[session_id] = _Session(manager, now)
+            evicted = self._select_evicted(now, keep=session_id)
+        if previous is not None and previous.manager is not manager:
+            previous.lock.acquire()
+            evicted.append((session_id, previous))
+        self._spill(evicted)
+
+    def remove(self, session_id):
+        # removes a session without spilling it and returns its manager
+        with self._lock:
+            entry = self._sessions.pop(session_id)
+        with entry.lock:
+            return entry.manager
+
+    def evict_idle(self):
+        with self._lock:
+            evicted = self._select_evicted(self.clock())
+        self._spill(evicted)
+        return len(evicted)
+
+    def _select_evicted(self, now, keep=None):
+        # Removes the expired and the excess sessions, skipping the ones in use, and returns
+        # them with their locks held. Called with the pool lock held.
+        evicted = []
+        excess = len(self._sessions) - self.max_sessions if self.max_sessions is not None else 0
+        deadline = now - self.idle_ttl if self.idle_ttl is not None else None
+        # walked from the least recently used session, up to the first one neither expired nor
+        # in excess, so a call costs O(evicted + in use) rather than O(sessions)
+        for session_id, entry in self._sessions.items():
+            expired = deadline is not None and entry.last_used <= deadline
+            if not expired and excess <= 0:
+                break
+            if session_id == keep or entry.users or not entry.lock.acquire(blocking=False):
+                continue
+            evicted.append((session_id, entry))
+            excess -= 1
+        for session_id, _ in evicted:
+            del self._sessions[session_id]
+        return evicted
+
+    def _spill(self, evicted):
+        # a failing spill is logged and does not stop the other sessions from being spilled;
+        # every evicted session is released
+        for session_id, entry in evicted:
+            try:
+                if self.spill is not None:
+                    self.spill(session_id, entry.manager)
+            except Exception:
+                _logger.exception('spill of session %r failed', session_id)
+            finally:
+                entry.lock.release()
@@ -0,0 +1,302 @@
+import json
+import string
+
+from .json_str import _canonical_json
+
+
+# A prompt format is declared as a spec:
+#   'bos': template of the token put before the first header block with `add_bos_token`
+#   'system': the system block, with the `{system}` slot for the stripped system prompt, and
+#       the `default` system prompt used when none is given, or also for a blank one with
+#       `default_if_blank`
+#   'tools': optional block listing the functions, with the `{functions}` slot; it comes
+#       before the system block, and `default_if_blank` there applies to the system prompt
+#   'turns': a spec per kind of turn, 'user', 'answer', 'tool_call' and 'tool_response':
+#       'template', with the slots of the kind, see `_TURN_SLOTS`
+#       'decision': name of the token put in the `{decision}` field, if the config enables
+#           decision tokens
+#       'end_of_conversation': appended to the last turn of the conversation
+#       'end_of_run': appended to the last turn of a run of turns of this kind
+#       'call_separator', 'call_fields', 'last_call_fields': the tool calls of a 'tool_call'
+#           turn are JSON objects of `call_fields` ('last_call_fields' for the last turn)
+#           joined by `call_separator` in the `{calls}` slot
+#       'response_fields': fields of the JSON object in the `{response}` slot of a
+#           'tool_response' turn
+#   Turns of a kind without a spec render as ''.
+# Other fields of the templates are attributes of the prompt, e.g. `{eos_token}` or
+# `{instruct_tokens[0]}`, substituted when the format is compiled.
+
+V1_FORMAT = {
+    'bos': '{bos_token}',
+    'system': {
+        'template': '{system} ',
+        'default': 'You are a helpful AI assistant built by MediaTek Research. The user you are helping speaks '
+                   'Traditional Chinese and comes from Taiwan.',
+        'default_if_blank': True,
+    },
+    'turns': {
+        'user': {
+            'template': ' {instruct_tokens[0]} {content} {instruct_tokens[1]} ',
+        },
+        'answer': {
+            'template': '{content}',
+            'end_of_conversation': '{eos_token}',
+        },
+    },
+}
+
+V2_FORMAT = {
+    'bos': '{bos_token}',
+    'system': {
+        'template': '{instance_start_token}{system_role}\n{system}{instance_end_token}',
+        'default': 'You are a helpful assistant.',
+        'default_if_blank': True,
+    },
+    'tools': {
+        'template': '{instance_start_token}{tools_role}\n{functions}{instance_end_token}',
+        'default_if_blank': False,
+    },
+    'turns': {
+        'user': {
+            'template': '{instance_start_token}{user_role}\n{content}{instance_end_token}'
+                        '{instance_start_token}{assistant_role}\n',
+        },
+        'answer': {
+            'template': '{decision}{content}{instance_end_token}',
+            'decision': 'answer_token',
+        },
+        'tool_call': {
+            'template': '{decision}{reason}{tool_call_begin_token}{calls}{tool_call_end_token}{instance_end_token}',
+            'decision': 'tool_call_token',
+            'call_separator': '{tool_call_end_token}{tool_call_begin_token}',
+            'call_fields': ['call_id', 'name', 'arguments'],
+            'last_call_fields': ['name', 'arguments'],
+        },
+        'tool_response': {
+            'template': '{instance_start_token}{tool_response_role}\n{response}{instance_end_token}',
+            'response_fields': ['call_id', 'name', 'content'],
+            'end_of_run': '{instance_start_token}{assistant_role}\n',
+        },
+    },
+}
+
+_TURN_SLOTS = {
+    'user': ('content',),
+    'answer': ('content',),
+    'tool_call': ('calls', 'reason'),
+    'tool_response': ('response',),
+}
+
+_CALL_FIELDS = {
+    'call_id': lambda c: c['id'],
+    'name': lambda c: c['function']['name'],
+    'arguments': lambda c: _canonical_json(c['function']['arguments']),
+}
+
+_RESPONSE_FIELDS = {
+    'call_id': lambda conv: conv['tool_call_id'],
+    'name': lambda conv: conv['name'],
+    'content': lambda conv: _canonical_json(conv['content']),
+}
+
+_FORMATTER = string.Formatter()
+
+
+def _turn_kind(conv):
+    if conv['role'] == 'assistant':
+        return 'tool_call' if 'tool_calls' in conv else 'answer'
+    elif conv['role'] == 'tool':
+        return 'tool_response'
+    return conv['role']
+
+
+def _template_pieces(template, fields, slots):
+    # the template as literal strings, with the `fields` substituted, and (slot name,) tuples
+    pieces = []
+    for literal, name, format_spec, conversion in _FORMATTER.parse(template):
+        if literal:
+            pieces.append(literal)
+        if name is None:
+            continue
+        if name in slots:
+            pieces.append((name,))
+            continue
+        try:
+            value = _FORMATTER.get_field(name, (), fields)[0]
+        except (KeyError, AttributeError, IndexError):
+            raise ValueError(f'Unknown field in prompt format: {{{name}}}')
+        pieces.append(format(_FORMATTER.convert_field(value, conversion), format_spec))
+
+    merged = []
+    for piece in pieces:
+        if isinstance(piece, str) and merged and isinstance(merged[-1], str):
+            merged[-1] += piece
+        else:
+            merged.append(piece)
+    return merged
+
+
+def _compile_template(template, fields, slots=()):
+    # returns render(values) with the `fields` substituted and the `slots` read from `values`
+    merged = _template_pieces(template, fields, slots)
+    slot_indices = [i for i, piece in enumerate(merged) if not isinstance(piece, str)]
+    if not slot_indices:
+        text = ''.join(merged)
+        return lambda values: text
+    if len(slot_indices) == 1:
+        i = slot_indices[0]
+        prefix, (name,), suffix = ''.join(merged[:i]), merged[i], ''.join(merged[i + 1:])
+        return lambda values: prefix + values[name] + suffix
+
+    def render(values):
+        parts = list(merged)
+        for i in slot_indices:
+            parts[i] = values[merged[i][0]]
+        return ''.join(parts)
+    return render
+
+
+def _literal(template, fields):
+    return _compile_template(template, fields)(None)
+
+
+def _split_template(template, fields, slot):
+    # the literals before and after the one `slot` of the template
+    pieces = _template_pieces(template, fields, (slot,))
+    if pieces.count((slot,)) != 1:
+        raise ValueError(f'Template of a prompt format needs one {{{slot}}} slot: {template!r}')
+    i = pieces.index((slot,))
+    return ''.join(pieces[:i]), ''.join(pieces[i + 1:])
+
+
+def _empty(conv, next_conv):
+    return ''
+
+
+class PromptFormat:
+    # A spec compiled against the token and role attributes of a prompt: the header and each
+    # kind of turn get a render function which concatenates precomputed literals and the
+    # values of the turn.
+    def __init__(self, spec, fields, add_decision_token=False, add_reason=False, compact_functions=False,
+                 max_description_length=None):
+        self.spec = spec
+        # how the catalog is written in the tools block, see `FunctionCatalog.serialize`
+        self.functions_options = (compact_functions, max_description_length)
+        fields = dict(fields)
+        self.bos = _literal(spec.get('bos', ''), fields)
+
+        system = spec['system']
+        self._system = _split_template(system['template'], fields, 'system')
+        self._default_system = system.get('default', '')
+        self._default_if_blank = system.get('default_if_blank', False)
+
+        self._tools = None
+        tools = spec.get('tools')
+        if tools is not None:
+            self._tools = _split_template(tools['template'], fields, 'functions')
+            self._tools_default_if_blank = tools.get('default_if_blank', False)
+
+        for kind in spec.get('turns', {}):
+            if kind not in _TURN_SLOTS:
+                raise ValueError(f'Unknown kind of turn in prompt format: {kind}')
+        # render(conv, next_conv) of a turn by its role; an assistant turn is an answer or a
+        # tool call depending on `tool_calls`
+        tool_call = self._compile_turn('tool_call', spec, fields, add_decision_token, add_reason)
+        self.renderers = {
+            'user': self._compile_turn('user', spec, fields, add_decision_token, add_reason),
+            'assistant': self._compile_turn('answer', spec, fields, add_decision_token, add_reason, tool_call),
+            'tool': self._compile_turn('tool_response', spec, fields, add_decision_token, add_reason),
+        }
+
+    def _compile_turn(self, kind, spec, fields, add_decision_token, add_reason, tool_call=_empty):
+        turn = spec.get('turns', {}).get(kind)
+        if turn is None:
+            if kind != 'answer' or tool_call is _empty:
+                return _empty
+            return lambda conv, next_conv: tool_call(conv, next_conv) if 'tool_calls' in conv else ''
+
+        fields = dict(fields)
+        fields['decision'] = fields[turn['decision']] if add_decision_token and turn.get('decision') else ''
+        if not add_reason:
+            fields['reason'] = ''
+        end_of_conversation = _literal(turn.get('end_of_conversation', ''), fields)
+        end_of_run = _literal(turn.get('end_of_run', ''), fields)
+
+        if kind == 'user' or kind == 'answer':
+            # the most frequent turns are a single concatenation, with the check for tool calls
+            # inlined for answers
+            prefix, suffix = _split_template(turn['template'], fields, 'content')
+            last_suffix = suffix + end_of_conversation + end_of_run
+            is_answer = kind == 'answer'
+            if not end_of_run:
+                def render(conv, next_conv):
+                    if is_answer and 'tool_calls' in conv:
+                        return tool_call(conv, next_conv)
+                    return prefix + conv['content'].strip() + (suffix if next_conv is not None else last_suffix)
+                return render
+            run_suffix = suffix + end_of_run
+
+            def render(conv, next_conv):
+                if is_answer and 'tool_calls' in conv:
+                    return tool_call(conv, next_conv)
+                if next_conv is None:
+                    return prefix + conv['content'].strip() + last_suffix
+                if _turn_kind(next_conv) != kind:
+                    return prefix + conv['content'].strip() + run_suffix
+                return prefix + conv['content'].strip() + suffix
+            return render
+
+        if kind == 'tool_call':
+            body = _compile_template(turn['template'], fields, ('calls', 'reason') if add_reason else ('calls',))
+            separator = _literal(turn.get('call_separator', ''), fields)
+            call_fields = [(x, _CALL_FIELDS[x]) for x in turn['call_fields']]
+            last_call_fields = [(x, _CALL_FIELDS[x]) for x in turn.get('last_call_fields', turn['call_fields'])]
+
+            def segment(conv, next_conv):
+                selected = last_call_fields if next_conv is None else call_fields
+                calls = separator.join([
+                    json.dumps({name: get(c) for name, get in selected}, ensure_ascii=False)
+                    for c in conv['tool_calls']
+                ])
+                return body({'calls': calls, 'reason': conv.get('reason', '')})
+        else:
+            prefix, suffix = _split_template(turn['template'], fields, 'response')
+            response_fields = [(x, _RESPONSE_FIELDS[x]) for x in turn['response_fields']]
+
+            def segment(conv, next_conv):
+                response = json.dumps({name: get(conv) for name, get in response_fields}, ensure_ascii=False)
+                return prefix + response + suffix
+
+        def render(conv, next_conv):
+            text = segment(conv, next_conv)
+            if next_conv is None:
+                return text + end_of_conversation + end_of_run
+            if end_of_run and _turn_kind(next_conv) != kind:
+                return text + end_of_run
+            return text
+        return render
+
+    def render_turn(self, conv, next_conv=None):
+        # `next_conv` is None for the last turn of the conversation
+        return self.renderers.get(conv['role'], _empty)(conv, next_conv)
+
+    def tools_block(self, serialized, add_bos_token=False):
+        return (self.bos if add_bos_token else '') + self._tools[0] + serialized + self._tools[1]
+
+    def header_blocks(self, sys, catalog=None, add_bos_token=False):
+        bos = self.bos if add_bos_token else ''
+        prefix, suffix = self._system
+        if catalog is not None and self._tools is not None:
+            if sys is None or (self._tools_default_if_blank and not sys.strip()):
+                sys = self._default_system
+            # the tools block is kept with the catalog, it is the same for every request
+            key = ('tools', bos, *self._tools, *self.functions_options)
+            tools = catalog._memo.get(key)
+            if tools is None:
+                tools = catalog._memo[key] = self.tools_block(catalog.serialize(*self.functions_options),
+                                                              add_bos_token)
+            return [tools, prefix + sys.strip() + suffix]
+
+        if sys is None or (self._default_if_blank and not sys.strip()):
+            sys = self._default_system
+        return [bos + prefix + sys.strip() + suffix]
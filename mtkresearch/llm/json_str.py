@@ -0,0 +1,61 @@
+import copy
+import json
+
+
+class JsonStr(str):
+    # A JSON text, such as the `arguments` of a tool call or the `content` of a tool response,
+    # which keeps its decoded value and its canonical `ensure_ascii=False` encoding once they
+    # are computed, so an unchanged turn is decoded and re-encoded only once however often it
+    # is validated and rendered. It compares as the plain string and pickles as one, without
+    # the caches. `parsed` returns a copy, so changes to a decoded value never reach the
+    # cached one.
+    __slots__ = ('_parsed', '_canonical')
+
+    @classmethod
+    def dumps(cls, value):
+        return cls(json.dumps(value))
+
+    def __reduce__(self):
+        return str, (str(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def _value(self):
+        # the cached decoded value, shared by the readers of this package which never modify it
+        try:
+            return self._parsed
+        except AttributeError:
+            value = self._parsed = json.loads(self)
+            return value
+
+    @property
+    def parsed(self):
+        return copy.deepcopy(self._value())
+
+    @property
+    def canonical(self):
+        # computed on first use; None is kept when the text is already canonical, e.g. ASCII
+        try:
+            canonical = self._canonical
+        except AttributeError:
+            canonical = json.dumps(self._value(), ensure_ascii=False)
+            canonical = self._canonical = None if canonical == self else canonical
+        return self if canonical is None else canonical
+
+
+def _json_str(value):
+    # wraps a plain string, other values are left as they are
+    return JsonStr(value) if type(value) is str else value
+
+
+def _json_value(s):
+    # read-only: the value of a JsonStr is shared
+    return s._value() if isinstance(s, JsonStr) else json.loads(s)
+
+
+def _canonical_json(s):
+    return s.canonical if isinstance(s, JsonStr) else json.dumps(json.loads(s), ensure_ascii=False)
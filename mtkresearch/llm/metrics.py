@@ -0,0 +1,92 @@
+import re
+import threading
+import time
+
+
+class Instrumentation:
+    # Opt-in measurements of the prompt layer, set as `prompt.instrumentation` or passed to
+    # MRChatManager. Every measurement is passed to each sink as sink(kind, name, value):
+    #   'duration': seconds spent in a stage, e.g. 'validate', 'header', 'render', 'parse'
+    #   'size': e.g. 'prompt_chars', 'turns', 'generated_chars'
+    #   'count': events, e.g. 'validate.errors', 'parse.skip_errors'
+    # A sink is any callable, such as a MetricsAggregator. With no instrumentation set, the
+    # only cost is one attribute check per call.
+    def __init__(self, *sinks, clock=time.perf_counter):
+        self.sinks = list(sinks)
+        self.clock = clock
+
+    def duration(self, name, seconds):
+        for sink in self.sinks:
+            sink('duration', name, seconds)
+
+    def size(self, name, value):
+        for sink in self.sinks:
+            sink('size', name, value)
+
+    def count(self, name, value=1):
+        for sink in self.sinks:
+            sink('count', name, value)
+
+
+class MetricsAggregator:
+    # In-memory sink keeping the count, sum, min and max of the durations and sizes of each
+    # name and the total of each counter.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {'duration': {}, 'size': {}}  # {kind: {name: [count, sum, min, max]}}
+        self._counters = {}
+
+    def __call__(self, kind, name, value):
+        with self._lock:
+            if kind == 'count':
+                self._counters[name] = self._counters.get(name, 0) + value
+                return
+            stats = self._stats[kind].get(name)
+            if stats is None:
+                self._stats[kind][name] = [1, value, value, value]
+            else:
+                stats[0] += 1
+                stats[1] += value
+                if value < stats[2]:
+                    stats[2] = value
+                if value > stats[3]:
+                    stats[3] = value
+
+    def reset(self):
+        with self._lock:
+            self._stats = {'duration': {}, 'size': {}}
+            self._counters = {}
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                kind: {
+                    name: {'count': s[0], 'sum': s[1], 'min': s[2], 'max': s[3]}
+                    for name, s in stats.items()
+                } for kind, stats in self._stats.items()
+            }
+            snapshot['count'] = dict(self._counters)
+        return snapshot
+
+    def prometheus(self, prefix='mtkresearch_prompt'):
+        # the aggregated metrics in the Prometheus text exposition format
+        snapshot = self.snapshot()
+        lines = []
+        for kind, metric, label in [('duration', f'{prefix}_stage_seconds', 'stage'),
+                                    ('size', f'{prefix}_size', 'name')]:
+            if not snapshot[kind]:
+                continue
+            lines.append(f'# TYPE {metric} summary')
+            for name, s in sorted(snapshot[kind].items()):
+                lines.append(f'{metric}_sum{{{label}="{_escape(name)}"}} {s["sum"]!r}')
+                lines.append(f'{metric}_count{{{label}="{_escape(name)}"}} {s["count"]}')
+        if snapshot['count']:
+            metric = f'{prefix}_events_total'
+            lines.append(f'# TYPE {metric} counter')
+            for name, value in sorted(snapshot['count'].items()):
+                lines.append(f'{metric}{{name="{_escape(name)}"}} {value}')
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+def _escape(value):
+    return re.sub(r'(["\\])', r'\\\1', value).replace('\n', '\\n')
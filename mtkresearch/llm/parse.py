@@ -0,0 +1,206 @@
+import json
+
+from .call_id import _unique_ids
+from .json_str import _json_str
+
+
+class PromptParser:
+    # Inverse of `MRPromptV2.get_prompt`: feed rendered prompts chunk by chunk and receive the
+    # (conversations, functions) of each prompt once the next one starts; `close` returns the
+    # last one. The text is scanned once, each `<|im_start|>role\n...<|im_end|>` block and
+    # assistant turn is decoded as soon as its end token arrives, and only the unfinished block
+    # is buffered. A prompt starts with the bos token, or with a tools or system block after
+    # turns of the previous prompt. `functions` is None for a prompt without a tools block.
+    # Contents come back stripped as they were rendered, and the tool calls of a last
+    # assistant turn, rendered without ids, get new ids.
+    def __init__(self, prompt, call_id_allocator=None):
+        self.prompt = prompt  # MRPromptV2
+        self.call_id_allocator = call_id_allocator
+        self._start_tokens = [prompt.bos_token, prompt.instance_start_token]
+
+        self._buffer = ''
+        self._pos = 0  # start of the text not consumed yet
+        self._scan = 0  # the end token of the open block does not start before this position
+        self._offset = 0  # position of the buffer in the whole input
+        self._assistant = False  # an assistant turn may follow
+        self._conversations = []
+        self._functions = None
+        self._closed = False
+
+    def feed(self, chunk):
+        if self._closed:
+            raise ValueError('parser is closed')
+        self._offset += self._pos
+        self._scan -= self._pos
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        records = []
+        self._parse(records, final=False)
+        return records
+
+    def close(self):
+        # the (conversations, functions) of the last prompt, None if there is none
+        if self._closed:
+            raise ValueError('parser is closed')
+        records = []
+        self._parse(records, final=True)
+        self._closed = True
+        self._flush(records)
+        return records[-1] if records else None
+
+    def _flush(self, records):
+        if self._conversations or self._functions is not None:
+            records.append((self._conversations, self._functions))
+        self._conversations = []
+        self._functions = None
+        self._assistant = False
+
+    def _error(self, message, pos):
+        return ValueError(f'{message} at position {self._offset + pos}')
+
+    def _starts_with(self, token, final):
+        # True or False, or None while the buffer ends with the beginning of `token`
+        rest = self._buffer[self._pos:self._pos + len(token)]
+        if rest == token:
+            return True
+        if not final and len(rest) < len(token) and token.startswith(rest):
+            return None
+        return False
+
+    def _find_end(self, token, start, final):
+        # position of `token` from `start`, or None if more text is needed
+        end = self._buffer.find(token, max(start, self._scan))
+        if end >= 0:
+            return end
+        if final:
+            raise self._error(f'Missing {token}', start)
+        self._scan = max(start, len(self._buffer) - len(token) + 1)
+        return None
+
+    def _parse(self, records, final):
+        prompt = self.prompt
+        while self._pos < len(self._buffer):
+            found = [self._starts_with(token, final) for token in self._start_tokens]
+            if None in found and not any(found):
+                return
+            if found[0]:
+                self._flush(records)
+                self._pos += len(prompt.bos_token)
+            elif found[1]:
+                if not self._parse_block(records, final):
+                    return
+            elif self._assistant:
+                end = self._find_end(prompt.instance_end_token, self._pos, final)
+                if end is None:
+                    return
+                self._conversations.append(self._parse_assistant(self._buffer[self._pos:end], self._pos))
+                self._assistant = False
+                self._pos = end + len(prompt.instance_end_token)
+            else:
+                raise self._error('Unexpected text', self._pos)
+
+    def _parse_block(self, records, final):
+        # one `<|im_start|>role\n...<|im_end|>` block; False if more text is needed
+        prompt = self.prompt
+        start = self._pos + len(prompt.instance_start_token)
+        newline = self._buffer.find('\n', start)
+        if newline < 0:
+            if final:
+                raise self._error('Missing role', start)
+            return False
+        role = self._buffer[start:newline]
+        if role == prompt.assistant_role:
+            # opens the assistant turn, or ends the prompt for the generation
+            self._assistant = True
+            self._pos = newline + 1
+            return True
+
+        end = self._find_end(prompt.instance_end_token, newline + 1, final)
+        if end is None:
+            return False
+        body = self._buffer[newline + 1:end]
+        try:
+            if role == prompt.tools_role:
+                if self._conversations or self._functions is not None:
+                    self._flush(records)
+                self._functions = json.loads(body)
+            elif role == prompt.system_role:
+                if self._conversations:
+                    self._flush(records)
+                self._conversations.append({'role': 'system', 'content': body})
+            elif role == prompt.user_role:
+                self._conversations.append({'role': 'user', 'content': body})
+            elif role == prompt.tool_response_role:
+                response = json.loads(body)
+                self._conversations.append({
+                    'role': 'tool',
+                    'tool_call_id': response['call_id'],
+                    'name': response['name'],
+                    'content': _json_str(response['content'])
+                })
+            else:
+                raise ValueError(f'Unknown role: {role!r}')
+        except (ValueError, KeyError, TypeError) as e:
+            raise self._error(f'Invalid {role} block ({type(e).__name__}: {e})', self._pos)
+        self._assistant = False
+        self._pos = end + len(prompt.instance_end_token)
+        return True
+
+    def _parse_assistant(self, body, pos):
+        prompt = self.prompt
+        if body.startswith(prompt.answer_token):
+            return {'role': 'assistant', 'content': body[len(prompt.answer_token):]}
+        if body.startswith(prompt.tool_call_token):
+            body = body[len(prompt.tool_call_token):]
+            pos += len(prompt.tool_call_token)
+        elif prompt.tool_call_begin_token not in body:
+            return {'role': 'assistant', 'content': body}
+
+        begin_token = prompt.tool_call_begin_token
+        end_token = prompt.tool_call_end_token
+        generate_call_id = None
+        tool_calls = []
+        begin = body.find(begin_token)
+        reason = body[:begin] if begin >= 0 else body
+        while begin >= 0:
+            end = body.find(end_token, begin)
+            if end < 0:
+                raise self._error(f'Missing {end_token}', pos + begin)
+            try:
+                call = json.loads(body[begin + len(begin_token):end])
+                call_id = call.get('call_id')
+                if call_id is None:
+                    # the last turn is rendered without ids
+                    generate_call_id = generate_call_id or _unique_ids(
+                        self.call_id_allocator or prompt.generate_call_id)
+                    call_id = generate_call_id()
+                tool_calls.append({
+                    'id': call_id,
+                    'type': 'function',
+                    'function': {
+                        'name': call['name'],
+                        'arguments': _json_str(call['arguments'])
+                    }
+                })
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                raise self._error(f'Invalid tool call ({type(e).__name__}: {e})', pos + begin)
+            begin = end + len(end_token)
+            if begin == len(body):
+                break
+            if not body.startswith(begin_token, begin):
+                raise self._error('Unexpected text', pos + begin)
+        conv = {'role': 'assistant', 'tool_calls': tool_calls}
+        if reason:
+            conv['reason'] = reason
+        return conv
+
+
+def parse_prompts(prompt, chunks, call_id_allocator=None):
+    # yields the (conversations, functions) of each prompt in the text of `chunks`, e.g.
+    # `iter(lambda: f.read(1 << 20), '')` for a log file of rendered prompts
+    parser = PromptParser(prompt, call_id_allocator=call_id_allocator)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    last = parser.close()
+    if last is not None:
+        yield last
@@ -2,6 +2,15 @@ import json
 import string
 import random
 import sys
+import hashlib
+import threading
+from collections import OrderedDict
+
+from .call_id import _unique_ids
+from .format import V1_FORMAT, V2_FORMAT, PromptFormat, _empty as _empty_turn, _turn_kind
+from .json_str import _json_str, _json_value
+from .parse import PromptParser
+from .schema import ArgumentsValidator, _TYPE_MAP, _parse_default
 
 
 def _removeprefix(content, prefix):
@@ -18,224 +27,454 @@ def _removesuffix(content, suffix):
         return content[:-len(suffix)] if content.endswith(suffix) else content
 
 
-class MRPromptV1:
-    def __init__(self, bos_token='<s>', eos_token='</s>'):
-        self.bos_token = bos_token
-        self.eos_token = eos_token
-        self.instruct_tokens = ['[INST]', '[/INST]']
-        self.func_tokens = ['[FUNC]', '[/FUNC]']
-        self.call_tokens = ['[FUNC_CALL]', '[/FUNC_CALL]']
-        self.result_tokens = ['[FUNC_RESULT]', '[/FUNC_RESULT]']
-
-    def _font(self, sys=None, add_bos_token=False):
-        if sys is None or not sys.strip():
-            sys = 'You are a helpful AI assistant built by MediaTek Research. The user you are helping speaks Traditional Chinese and comes from Taiwan.'
-        sys = sys.strip()
-        return f'{self.bos_token}{sys} ' if add_bos_token else f'{sys} '
-
-    def _check_arguments(self, arguments, func_description):
-        errors = []
-
-        if not isinstance(func_description['parameters'], dict) or func_description['parameters'] == {}:  # for the function which no need param.
-            return
-        
-        param_details = func_description['parameters']['properties']
-        required_params = func_description['parameters'].get('required', [])
-        for param in required_params:
-            if param not in arguments:
-                errors.append(f"Missing required parameter: '{param}'")
-        
-        for param, value in arguments.items():
-            if param not in param_details:
-                errors.append(f"Unexpected parameter: '{param}'")
-                continue
-            expected_type = param_details[param]['type']
-
-            if expected_type == 'string' and not isinstance(value, str):
-                errors.append(f"Incorrect type for '{param}': Expected string, got {type(value).__name__}")
-            elif expected_type == 'integer' and not isinstance(value, int):
-                errors.append(f"Incorrect type for '{param}': Expected integer, got {type(value).__name__}")
-            elif expected_type == 'float' and not (isinstance(value, float) or isinstance(value, int)):
-                errors.append(f"Incorrect type for '{param}': Expected float, got {type(value).__name__}")
-            elif expected_type == 'boolean' and not isinstance(value, bool):
-                errors.append(f"Incorrect type for '{param}': Expected boolean, got {type(value).__name__}")
-            elif expected_type == 'array' and not isinstance(value, list):
-                errors.append(f"Incorrect type for '{param}': Expected array, got {type(value).__name__}")
-
-            if 'enum' in param_details[param]:
-                if value not in param_details[param]['enum']:
-                    errors.append(f"Incorrect value for '{param}': Expected one of {param_details[param]['enum']}, got '{value}'")
-
-        if errors:
-            raise ValueError('\n'.join(errors))
-
-    def check_conversations(self, conversations, functions=None):
-        if functions is not None:
-            function_mapping = {func['name']: func for func in functions}
-
-        for i, conv in enumerate(conversations):
-            role = conv['role']
-            if role == 'system':
-                if i != 0:
-                    raise ValueError
-                if not isinstance(conv['content'], str):
-                    raise ValueError
-                if conversations[1]['role'] != 'user':
+def _check_functions(functions):
+    for func in functions:
+        if 'name' not in func or 'description' not in func or 'parameters' not in func:
+            raise ValueError
+        if not isinstance(func['name'], str) or not isinstance(func['description'], str):
+            raise ValueError
+        if not (func['parameters'] is None or isinstance(func['parameters'], dict)):
+            raise ValueError
+        if func['parameters'] is None or len(func['parameters']) == 0:
+            continue
+        if 'type' not in func['parameters'] or 'properties' not in func['parameters']:
+            raise ValueError
+        if not isinstance(func['parameters']['properties'], dict):
+            raise ValueError
+        if 'required' in func['parameters']:
+            if not isinstance(func['parameters']['required'], list):
+                raise ValueError
+            for name in func['parameters']['required']:
+                if name not in func['parameters']['properties']:
                     raise ValueError
 
-            elif role == 'user':
-                if not isinstance(conv['content'], str):
-                    raise ValueError
-                if i != 0:
-                    if conversations[i - 1]['role'] == 'user':
-                        raise ValueError
-                    if conversations[i - 1]['role'] == 'assistant' and 'tool_calls' in conversations[i - 1]:
-                        raise ValueError
+        for param, param_dict in func['parameters']['properties'].items():
+            if isinstance(param_dict, dict) and 'default' in param_dict.keys():
+                expected_type = _TYPE_MAP.get(param_dict['type'].lower())
+                parsed_value = _parse_default(param_dict['default'], expected_type)
+                if expected_type in _TYPE_MAP.keys() and not isinstance(parsed_value, expected_type):
+                    raise ValueError("Default value type mismatch")
+
+
+def _chain_hash(previous, block, catalog=None):
+    # hash of a prompt prefix from the hash of the previous prefix and the next block; the
+    # hashes of the tools block are kept with the catalog
+    key = ('hash', previous, block)
+    if isinstance(catalog, FunctionCatalog):
+        digest = catalog._memo.get(key)
+        if digest is not None:
+            return digest
+    h = hashlib.blake2b(previous, digest_size=16)
+    h.update(block.encode('utf-8'))
+    digest = h.digest()
+    if isinstance(catalog, FunctionCatalog) and previous == b'':
+        catalog._memo[key] = digest
+    return digest
+
+
+def _with_extras(prompt, spans, block_hashes):
+    extras = [x for x in (spans, block_hashes) if x is not None]
+    return (prompt, *extras) if extras else prompt
+
+
+def _shorten(value, compact, max_description_length, names=False, keep=()):
+    # `names`: `value` maps property names to schemas, which are kept even if empty; `keep`:
+    # the keys of `value` kept even if empty
+    if isinstance(value, list):
+        return [_shorten(item, compact, max_description_length) for item in value]
+    if not isinstance(value, dict):
+        return value
+    shortened = {}
+    for key, item in value.items():
+        if names:
+            shortened[key] = _shorten(item, compact, max_description_length)
+            continue
+        if key == 'description' and isinstance(item, str):
+            if max_description_length is not None and len(item) > max_description_length:
+                item = item[:max_description_length].rstrip() + '…'
+        elif key != 'default' and key != 'enum':
+            item = _shorten(item, compact, max_description_length, names=key == 'properties')
+        if compact and key != 'name' and key != 'default' and key not in keep and \
+                (item is None or item in ('', [], {})):
+            continue
+        shortened[key] = item
+    return shortened
+
+
+def _shorten_function(func, compact, max_description_length):
+    # the keys checked by `_check_functions` are kept even if empty, so that a compact tools
+    # block is still parsed back by `parse_prompt`; only the parameter schemas are pruned
+    shortened = _shorten(func, compact, max_description_length, keep=('name', 'description', 'parameters'))
+    if isinstance(func.get('parameters'), dict):
+        shortened['parameters'] = _shorten(func['parameters'], compact, max_description_length,
+                                           keep=('type', 'properties'))
+    return shortened
+
+
+def _serialize_functions(functions, compact=False, max_description_length=None):
+    # `functions` is a function list, or a single function
+    if compact or max_description_length is not None:
+        if isinstance(functions, dict):
+            functions = _shorten_function(functions, compact, max_description_length)
+        else:
+            functions = [_shorten_function(func, compact, max_description_length) for func in functions]
+    return json.dumps(functions, ensure_ascii=False, separators=(',', ':') if compact else None)
+
+
+class FunctionCatalog:
+    # A validated, immutable function list. The tools header is serialized once and the
+    # catalog is identified by the fingerprint of that serialization.
+    def __init__(self, serialized, fingerprint):
+        self.serialized = serialized
+        self.fingerprint = fingerprint
+        self.functions = json.loads(serialized)
+        self.mapping = {func['name']: func for func in self.functions}
+        self._validators = {}
+        self._memo = {}  # rendered blocks and hashes derived from the catalog
+
+    def validator(self, name):
+        # compiled on first use and shared by every user of the catalog
+        validator = self._validators.get(name)
+        if validator is None:
+            validator = self._validators[name] = ArgumentsValidator(self.mapping[name])
+        return validator
+
+    def __len__(self):
+        return len(self.functions)
+
+    def __iter__(self):
+        return iter(self.functions)
+
+    def __getitem__(self, index):
+        return self.functions[index]
+
+    def serialize(self, compact=False, max_description_length=None):
+        # the functions as written in the tools block; `compact` minifies the JSON and drops
+        # empty fields, `max_description_length` cuts longer descriptions. Validation always
+        # uses the functions as given.
+        if not compact and max_description_length is None:
+            return self.serialized
+        key = ('serialized', compact, max_description_length)
+        serialized = self._memo.get(key)
+        if serialized is None:
+            serialized = self._memo[key] = _serialize_functions(self.functions, compact, max_description_length)
+        return serialized
+
+    def __hash__(self):
+        return hash(self.fingerprint)
+
+    def __eq__(self, other):
+        return isinstance(other, FunctionCatalog) and self.fingerprint == other.fingerprint
+
+    def __reduce__(self):
+        return _load_catalog, (self.serialized,)
+
+    def __repr__(self):
+        return f'FunctionCatalog({len(self)} functions, fingerprint={self.fingerprint[:12]})'
+
+
+_CATALOG_CACHE_SIZE = 128
+_catalog_cache = OrderedDict()
+_catalog_cache_lock = threading.Lock()
+
+
+def _load_catalog(serialized):
+    fingerprint = hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+    with _catalog_cache_lock:
+        catalog = _catalog_cache.get(fingerprint)
+        if catalog is not None:
+            _catalog_cache.move_to_end(fingerprint)
+            return catalog
+
+    catalog = FunctionCatalog(serialized, fingerprint)
+    _check_functions(catalog.functions)
+
+    with _catalog_cache_lock:
+        _catalog_cache[fingerprint] = catalog
+        while len(_catalog_cache) > _CATALOG_CACHE_SIZE:
+            _catalog_cache.popitem(last=False)
+    return catalog
+
+
+def compile_functions(functions):
+    if isinstance(functions, FunctionCatalog):
+        return functions
+    return _load_catalog(json.dumps(functions, ensure_ascii=False))
+
+
+class ConversationValidator:
+    # Checks a conversation turn by turn with the rules of `check_conversations`. Each fed turn
+    # is checked against the state left by the previous ones, so appending a turn costs O(1)
+    # in the length of the history.
+    def __init__(self, prompt, functions=None):
+        self.prompt = prompt  # MRPromptV1, MRPromptV2
+        self.functions = functions
+        self._validators = {}  # {name: ArgumentsValidator} of a function list, compiled on first call
+        if isinstance(functions, FunctionCatalog):
+            self._function_mapping = functions.mapping
+        elif functions is not None:
+            self._function_mapping = {func['name']: func for func in functions}
+        else:
+            self._function_mapping = None
+
+        self._count = 0
+        self._last_role = None  # 'tool_calls' for an assistant turn calling tools
+        self._tool_calls = None  # the tool calls answered by the following tool turns
+        self._call_names = None  # {call id: function name}, built on the first tool response
+
+    def _arguments_validator(self, name):
+        if isinstance(self.functions, FunctionCatalog):
+            return self.functions.validator(name)
+        validator = self._validators.get(name)
+        if validator is None:
+            validator = self._validators[name] = ArgumentsValidator(self._function_mapping[name])
+        return validator
+
+    def feed(self, conv):
+        i = self._count
+        last_role = self._last_role
+        role = conv['role']
+
+        if i == 1 and last_role == 'system' and role != 'user':
+            raise ValueError
+
+        if role == 'system':
+            if i != 0:
+                raise ValueError
+            if not isinstance(conv['content'], str):
+                raise ValueError
 
-            elif role == 'assistant' and 'tool_calls' not in conv: # assistant answer
-                if i == 0:
-                    raise ValueError
-                elif not(conversations[i - 1]['role'] == 'user' or conversations[i - 1]['role'] == 'tool'):
-                    raise ValueError
+        elif role == 'user':
+            if not isinstance(conv['content'], str):
+                raise ValueError
+            if last_role == 'user' or last_role == 'tool_calls':
+                raise ValueError
 
-                if not isinstance(conv['content'], str):
-                    raise ValueError
+        elif role == 'assistant' and 'tool_calls' not in conv: # assistant answer
+            if i == 0:
+                raise ValueError
+            elif not (last_role == 'user' or last_role == 'tool'):
+                raise ValueError
 
-            elif role == 'assistant' and 'tool_calls' in conv: # assistant tool call
-                if i == 0:
-                    raise ValueError
-                elif not(conversations[i - 1]['role'] == 'user' or conversations[i - 1]['role'] == 'tool'):
-                    raise ValueError
+            if not isinstance(conv['content'], str):
+                raise ValueError
 
-                if not functions:
-                    raise ValueError
+        elif role == 'assistant' and 'tool_calls' in conv: # assistant tool call
+            if i == 0:
+                raise ValueError
+            elif not (last_role == 'user' or last_role == 'tool'):
+                raise ValueError
 
-                for tool_call in conv['tool_calls']:
-                    if tool_call['type'] != 'function':
-                        raise ValueError
-                    arguments = json.loads(tool_call['function']['arguments'])
-                    name = tool_call['function']['name']
-                    if name not in function_mapping:
-                        raise ValueError
-                    self._check_arguments(arguments, function_mapping[name])
+            if not self.functions:
+                raise ValueError
 
-            elif role == 'tool': # tool response
-                if i == 0:
-                    raise ValueError
-                elif not ((conversations[i - 1]['role'] == 'assistant' and 'tool_calls' in conversations[i - 1]) or (conversations[i - 1]['role'] == 'tool')):
+            for tool_call in conv['tool_calls']:
+                if tool_call['type'] != 'function':
                     raise ValueError
-
-                if not functions:
+                arguments = _json_value(tool_call['function']['arguments'])
+                name = tool_call['function']['name']
+                if name not in self._function_mapping:
                     raise ValueError
+                self._arguments_validator(name).check(arguments)
 
-                json.loads(conv['content'])
+            self._tool_calls = conv['tool_calls']
+            self._call_names = None
+            role = 'tool_calls'
 
-                tool_call_id = conv['tool_call_id']
-                name = conv['name']
-                # go to corresponding calls
-                j = i - 1
-                while j >= 0:
-                    if conversations[j]['role'] == 'assistant' and 'tool_calls' in conversations[j]:
-                        break
-                    elif conversations[j]['role'] != 'tool':
-                        raise ValueError
-                    j -= 1
-                if j < 0:
-                    raise ValueError
-                corresponding_tool_calls = conversations[j]['tool_calls']
-                corresponding_ids = [c['id'] for c in corresponding_tool_calls]
-                k = corresponding_ids.index(tool_call_id)
-                if k < 0:
-                    raise ValueError
-                if corresponding_tool_calls[k]['function']['name'] != name:
-                    raise ValueError
-
-    def check_functions(self, functions):
-        for func in functions:
-            if 'name' not in func or 'description' not in func or 'parameters' not in func:
+        elif role == 'tool': # tool response
+            if i == 0:
                 raise ValueError
-            if not isinstance(func['name'], str) or not isinstance(func['description'], str):
+            elif not (last_role == 'tool_calls' or last_role == 'tool'):
                 raise ValueError
-            if not (func['parameters'] is None or isinstance(func['parameters'], dict)):
+
+            if not self.functions:
                 raise ValueError
-            if func['parameters'] is None or len(func['parameters']) == 0:
-                continue
-            if 'type' not in func['parameters'] or 'properties' not in func['parameters']:
+
+            _json_value(conv['content'])
+
+            call_names = self._call_names
+            if call_names is None:
+                call_names = {}
+                for c in self._tool_calls:
+                    call_names.setdefault(c['id'], c['function']['name'])
+            if conv['tool_call_id'] not in call_names:
                 raise ValueError
-            if not isinstance(func['parameters']['properties'], dict):
+            if call_names[conv['tool_call_id']] != conv['name']:
                 raise ValueError
-            if 'required' in func['parameters']:
-                if not isinstance(func['parameters']['required'], list):
-                    raise ValueError
-                for name in func['parameters']['required']:
-                    if name not in func['parameters']['properties']:
-                        raise ValueError
-                    
-            if isinstance(func['parameters'], dict) and 'properties' in func['parameters'].keys():
-                for param, param_dict in func['parameters']['properties'].items():
-                    if isinstance(param_dict, dict) and 'default' in param_dict.keys():
-                        def parse_value(value_str, expected_type):
-                            if expected_type == str:
-                                return value_str
-                            elif expected_type == int:
-                                # 先轉換為 float，然後轉換為 int
-                                if type(value_str) == str:
-                                    raise ValueError("Expect int but get str")
-                                return int(float(value_str))
-                            elif expected_type == float:
-                                return float(value_str)
-                            elif expected_type == bool:
-                                return value_str in ('true', 'yes', '1', 'on')
-                            else:
-                                # TODO
-                                pass
-
-                        type_map = {
-                            'string': str,
-                            'integer': int,
-                            'float': float,
-                            'boolean': bool,
-                            # 'list': list,
-                            # 'dict': dict
-                        }
-
-                        expected_type = type_map.get(param_dict['type'].lower())
-                        parsed_value = parse_value(param_dict['default'], expected_type)
-                        if expected_type in type_map.keys() and not isinstance(parsed_value, expected_type):
-                            raise ValueError("Default value type mismatch")
-
-
-    def get_prompt(self, conversations, add_bos_token=False):
+            self._call_names = call_names
+
+        self._count = i + 1
+        self._last_role = role
+
+    def drop_turns(self, count):
+        # the oldest `count` turns after the system turn were removed from the conversation,
+        # which has to start at a user turn again
+        self._count -= count
+
+    def finish(self):
+        # a system turn has to be followed by a user turn
+        if self._count == 1 and self._last_role == 'system':
+            raise ValueError
+
+
+class MRPromptV1:
+    format = V1_FORMAT  # see format.py
+    instrumentation = None  # metrics.Instrumentation, None to measure nothing
+    config = None
+
+    def __init__(self, bos_token='<s>', eos_token='</s>'):
+        self.bos_token = bos_token
+        self.eos_token = eos_token
+        self.instruct_tokens = ['[INST]', '[/INST]']
+        self.func_tokens = ['[FUNC]', '[/FUNC]']
+        self.call_tokens = ['[FUNC_CALL]', '[/FUNC_CALL]']
+        self.result_tokens = ['[FUNC_RESULT]', '[/FUNC_RESULT]']
+        self.system_role = 'system'
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_compiled_formats', None)
+        return state
+
+    def __setattr__(self, name, value):
+        # the compiled formats depend on the tokens and roles
+        self.__dict__.pop('_compiled_formats', None)
+        super().__setattr__(name, value)
+
+    def _format(self):
+        # the format compiled, on first use, for the tokens and each setting of the config
+        config = self.config
+        if config:
+            key = (config.get('add_decision_token', False), config.get('add_reason', False),
+                   config.get('compact_functions', False), config.get('max_description_length'))
+        else:
+            key = (False, False, False, None)
+        try:
+            return self._compiled_formats[key]
+        except AttributeError:
+            self.__dict__['_compiled_formats'] = {}
+        except KeyError:
+            pass
+        fmt = self._compiled_formats[key] = PromptFormat(self.format, vars(self), *key)
+        return fmt
+
+    def _font(self, sys=None, add_bos_token=False):
+        return self._format().header_blocks(sys, add_bos_token=add_bos_token)[0]
+
+    def check_conversations(self, conversations, functions=None):
+        validator = ConversationValidator(self, functions=functions)
+        for conv in conversations:
+            validator.feed(conv)
+        validator.finish()
+
+    def check_functions(self, functions):
+        compile_functions(functions)
+
+    def _validate(self, conversations, functions=None):
         self.check_conversations(conversations)
 
-        prompt = ''
+    def _measured_validate(self, metrics, conversations, functions=None):
+        start = metrics.clock()
+        try:
+            self._validate(conversations, functions=functions)
+        except Exception:
+            metrics.count('validate.errors')
+            raise
+        metrics.duration('validate', metrics.clock() - start)
+
+    def _validator(self, functions=None):
+        return ConversationValidator(self)
+
+    def _render_header_blocks(self, sys, functions=None, add_bos_token=False):
+        return self._format().header_blocks(sys, add_bos_token=add_bos_token)
+
+    def _render_header(self, sys, functions=None, add_bos_token=False):
+        return ''.join(self._render_header_blocks(sys, functions=functions, add_bos_token=add_bos_token))
+
+    def _render_turn(self, conv, next_conv=None):
+        # `next_conv` is None for the last turn of the conversation
+        return self._format().render_turn(conv, next_conv)
+
+    def _render(self, conversations, functions=None, add_bos_token=False, spans=None, block_hashes=None):
+        # `spans` collects a (start, end, role, turn index, kind) tuple per rendered segment and
+        # `block_hashes` an (end, chained hash) pair per header block and turn
+        metrics = self.instrumentation
+        if metrics is not None:
+            start = metrics.clock()
         sys = None
+        offset = 0
         if conversations[0]['role'] == 'system':
             sys = conversations[0]['content']
             conversations = conversations[1:]
-
-        prompt += self._font(sys, add_bos_token)
-
+            offset = 1
+
+        header_blocks = self._render_header_blocks(sys, functions=functions, add_bos_token=add_bos_token)
+        if metrics is not None:
+            now = metrics.clock()
+            metrics.duration('header', now - start)
+            start = now
+        pieces = list(header_blocks)
+        position = 0
+        digest = b''
+        for block in header_blocks:
+            position += len(block)
+            if block_hashes is not None:
+                digest = _chain_hash(digest, block, functions)
+                block_hashes.append((position, digest.hex()))
+        if spans is not None:
+            spans.append((0, position, self.system_role, 0 if offset else None, 'header'))
+
+        renderers = self._format().renderers
         for i, conv in enumerate(conversations):
-            if conv['role'] == 'user':
-                prompt += f' {self.instruct_tokens[0]} {conv["content"].strip()} {self.instruct_tokens[1]} '
-            elif conv['role'] == 'assistant' and 'tool_calls' not in conv:
-                prompt += conv['content'].strip()
-                if i == len(conversations) - 1:
-                    prompt += self.eos_token
-
+            next_conv = conversations[i + 1] if i + 1 < len(conversations) else None
+            segment = renderers.get(conv['role'], _empty_turn)(conv, next_conv)
+            pieces.append(segment)
+            if not segment:
+                continue
+            if spans is not None:
+                spans.append((position, position + len(segment), conv['role'], i + offset, _turn_kind(conv)))
+            position += len(segment)
+            if block_hashes is not None:
+                digest = _chain_hash(digest, segment)
+                block_hashes.append((position, digest.hex()))
+
+        prompt = ''.join(pieces)
+        if metrics is not None:
+            metrics.duration('render', metrics.clock() - start)
+            metrics.size('turns', len(conversations) + offset)
+            metrics.size('prompt_chars', len(prompt))
         return prompt
 
-    def parse_generated_str(self, generated_str):
+    def get_prompt(self, conversations, add_bos_token=False, return_spans=False, return_block_hashes=False):
+        metrics = self.instrumentation
+        if metrics is None:
+            self._validate(conversations)
+        else:
+            self._measured_validate(metrics, conversations)
+
+        spans = [] if return_spans else None
+        block_hashes = [] if return_block_hashes else None
+        prompt = self._render(conversations, add_bos_token=add_bos_token, spans=spans, block_hashes=block_hashes)
+        return _with_extras(prompt, spans, block_hashes)
+
+    def parse_generated_str(self, generated_str, call_id_allocator=None):
+        metrics = self.instrumentation
+        if metrics is not None:
+            start = metrics.clock()
         generated_str = generated_str.strip()
         conv = {
             'role': 'assistant',
             'content': _removesuffix(generated_str, self.eos_token)
         }
+        if metrics is not None:
+            metrics.duration('parse', metrics.clock() - start)
+            metrics.size('generated_chars', len(generated_str))
         return conv
 
 
 class MRPromptV2(MRPromptV1):
+    format = V2_FORMAT
+
     def __init__(self, bos_token='<s>', eos_token='</s>',
                  instance_start_token='<|im_start|>', instance_end_token='<|im_end|>',
                  tool_call_token='<|use_tool|>', answer_token='<|answer|>',
@@ -255,106 +494,106 @@ class MRPromptV2(MRPromptV1):
         self.tools_role = 'tools'
         self.tool_response_role = 'tool_response'
 
-    def _font(self, sys=None, add_bos_token=False):
-        if sys is None or not sys.strip():
-            sys = 'You are a helpful assistant.'
-        sys = sys.strip()
-        prompt = f'{self.instance_start_token}{self.system_role}\n{sys}{self.instance_end_token}'
-        return self.bos_token + prompt if add_bos_token else prompt
+        self.config = {
+            'add_decision_token': True,
+            'add_reason': False,
+            # tools block: minified JSON without empty fields, descriptions cut to a length
+            'compact_functions': False,
+            'max_description_length': None,
+        }
 
     def _font_with_functions(self, sys, functions, add_bos_token=False):
-        if sys is None:
-            sys = 'You are a helpful assistant.'
-        sys = sys.strip()
-        functions = json.dumps(functions, ensure_ascii=False)
-        prompt = f'{self.instance_start_token}{self.tools_role}\n{functions}{self.instance_end_token}' + \
-            f'{self.instance_start_token}{self.system_role}\n{sys}{self.instance_end_token}'
-        return self.bos_token + prompt if add_bos_token else prompt
-    
+        return ''.join(self._font_with_functions_blocks(sys, functions, add_bos_token=add_bos_token))
+
+    def _font_with_functions_blocks(self, sys, functions, add_bos_token=False):
+        return self._format().header_blocks(sys, compile_functions(functions), add_bos_token=add_bos_token)
+
+    def functions_report(self, functions, count_tokens=len):
+        # the size of the tools block of `functions` with the current config and as given, in
+        # total and per function, measured by `count_tokens`, e.g.
+        # `lambda text: len(tokenizer.encode(text))`; characters by default
+        catalog = compile_functions(functions)
+        fmt = self._format()
+        options = fmt.functions_options
+        default = count_tokens(fmt.tools_block(catalog.serialized))
+        current = count_tokens(fmt.tools_block(catalog.serialize(*options)))
+        return {
+            'tools_block': current,
+            'default_tools_block': default,
+            'saved': default - current,
+            'functions': {
+                func['name']: count_tokens(_serialize_functions(func, *options)) for func in catalog
+            },
+        }
+
     def generate_call_id(self):
         length = 24
         pool = string.ascii_letters + string.digits
         key = ''.join(random.choice(pool) for i in range(length))
         return f'call_{key}'
 
-    def get_prompt(self, conversations, functions=None, add_bos_token=False):
-        config = {
-            'add_decision_token': True,
-            'add_reason': False,
-        }
-        
+    def _validate(self, conversations, functions=None):
         if functions:
             self.check_functions(functions)
             self.check_conversations(conversations, functions=functions)
         else:
             self.check_conversations(conversations)
 
-        prompt = ''
-        sys = None
-        if conversations[0]['role'] == 'system':
-            sys = conversations[0]['content']
-            conversations = conversations[1:]
+    def _validator(self, functions=None):
+        return ConversationValidator(self, functions=functions or None)
 
-        if functions:
-            prompt += self._font_with_functions(sys, functions, add_bos_token=add_bos_token)
-        else:
-            prompt += self._font(sys, add_bos_token=add_bos_token)
-
-        for i, conv in enumerate(conversations):
-            if conv['role'] == 'user':
-                prompt += f'{self.instance_start_token}{self.user_role}\n{conv["content"].strip()}{self.instance_end_token}' + \
-                    f'{self.instance_start_token}{self.assistant_role}\n'
-
-            elif conv['role'] == 'assistant' and 'tool_calls' not in conv:
-                appended_prompt = conv['content'].strip() + self.instance_end_token
-                if config['add_decision_token']:
-                    appended_prompt = self.answer_token + appended_prompt
-                prompt += appended_prompt
-
-            elif conv['role'] == 'assistant' and 'tool_calls' in conv:
-                tool_calls = conv['tool_calls']
-
-                if i + 1 == len(conversations):
-                    tool_calls_str = f'{self.tool_call_end_token}{self.tool_call_begin_token}'.join([
-                        json.dumps({
-                            "name": c["function"]["name"],
-                            "arguments": json.dumps(json.loads(c["function"]["arguments"]), ensure_ascii=False)
-                        }, ensure_ascii=False)
-                        for c in tool_calls
-                    ])
-                else:
-                    tool_calls_str = f'{self.tool_call_end_token}{self.tool_call_begin_token}'.join([
-                        json.dumps({
-                            "call_id": c["id"], 
-                            "name": c["function"]["name"],
-                            "arguments": json.dumps(json.loads(c["function"]["arguments"]), ensure_ascii=False)
-                        }, ensure_ascii=False)
-                        for c in tool_calls
-                    ])
-
-                appended_prompt = f'{self.tool_call_begin_token}{tool_calls_str}{self.tool_call_end_token}{self.instance_end_token}'
-                
-                if config['add_reason']:
-                    appended_prompt = conv.get('reason', '') + appended_prompt
-                if config['add_decision_token']:
-                    appended_prompt = self.tool_call_token + appended_prompt
-                prompt += appended_prompt
-
-            elif conv['role'] == 'tool':
-                tool_response_str = json.dumps(
-                    {
-                        "call_id": conv['tool_call_id'],
-                        "name": conv['name'],
-                        "content": json.dumps(json.loads(conv['content']), ensure_ascii=False)
-                    }, ensure_ascii=False)
-                prompt += f'{self.instance_start_token}{self.tool_response_role}\n{tool_response_str}{self.instance_end_token}'
-
-                if i + 1 == len(conversations) or conversations[i + 1]['role'] != 'tool':
-                    prompt += f'{self.instance_start_token}{self.assistant_role}\n'
+    def _render_header_blocks(self, sys, functions=None, add_bos_token=False):
+        catalog = compile_functions(functions) if functions else None
+        return self._format().header_blocks(sys, catalog, add_bos_token=add_bos_token)
 
-        return prompt
+    def get_prompt(self, conversations, functions=None, add_bos_token=False, return_spans=False,
+                   return_block_hashes=False):
+        metrics = self.instrumentation
+        if metrics is None:
+            if functions:
+                functions = compile_functions(functions)
+            self._validate(conversations, functions=functions)
+        else:
+            if functions:
+                start = metrics.clock()
+                try:
+                    functions = compile_functions(functions)
+                except Exception:
+                    metrics.count('check_functions.errors')
+                    raise
+                metrics.duration('check_functions', metrics.clock() - start)
+            self._measured_validate(metrics, conversations, functions=functions)
+
+        spans = [] if return_spans else None
+        block_hashes = [] if return_block_hashes else None
+        prompt = self._render(conversations, functions=functions, add_bos_token=add_bos_token,
+                              spans=spans, block_hashes=block_hashes)
+        return _with_extras(prompt, spans, block_hashes)
+
+    def parse_prompt(self, prompt, call_id_allocator=None):
+        # the (conversations, functions) rendered as `prompt` by `get_prompt`, see PromptParser
+        # for many prompts or a stream
+        parser = PromptParser(self, call_id_allocator=call_id_allocator)
+        records = parser.feed(prompt)
+        last = parser.close()
+        if records or last is None:
+            raise ValueError(f'Expected one prompt, found {len(records) + (last is not None)}')
+        return last
+
+    def parse_generated_str(self, generated_str, call_id_allocator=None):
+        # `call_id_allocator` is a CallIdAllocator, or any callable returning a new id
+        metrics = self.instrumentation
+        if metrics is None:
+            return self._parse_generated_str(generated_str, _unique_ids(call_id_allocator or self.generate_call_id))
+        start = metrics.clock()
+        conv = self._parse_generated_str(generated_str, _unique_ids(call_id_allocator or self.generate_call_id))
+        metrics.duration('parse', metrics.clock() - start)
+        metrics.size('generated_chars', len(generated_str))
+        if 'tool_calls' in conv:
+            metrics.count('parse.tool_calls', len(conv['tool_calls']))
+        return conv
 
-    def parse_generated_str(self, generated_str):
+    def _parse_generated_str(self, generated_str, generate_call_id):
         generated_str = generated_str.strip()
         generated_str = _removeprefix(generated_str, self.answer_token).strip()
         generated_str = _removeprefix(generated_str, self.tool_call_token).strip()
@@ -369,9 +608,9 @@ class MRPromptV2(MRPromptV1):
                         raise ValueError
 
                     func_call = json.loads(_removesuffix(segment, self.tool_call_end_token).strip())
-                    func_call['arguments'] = func_call['arguments']
+                    func_call['arguments'] = _json_str(func_call['arguments'])
                     tool_calls.append({
-                        'id': self.generate_call_id(),
+                        'id': generate_call_id(),
                         'type': 'function',
                         'function': func_call
                     })
@@ -381,6 +620,8 @@ class MRPromptV2(MRPromptV1):
                 }
             except Exception as e:
                 print(f'skip error: {e}')
+                if self.instrumentation is not None:
+                    self.instrumentation.count('parse.skip_errors')
                 conv = {
                     'role': 'assistant',
                     'content': ''
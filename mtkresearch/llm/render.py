@@ -0,0 +1,111 @@
+import argparse
+import collections
+import io
+import json
+import sys
+
+from .batch import iter_prompts
+from .prompt import MRPromptV1, MRPromptV2
+
+
+PROMPTS = {
+    'v1': MRPromptV1,
+    'v2': MRPromptV2,
+}
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m mtkresearch.llm.render',
+        description='Add rendered prompts to JSONL conversation records.')
+    parser.add_argument('input', nargs='?', default='-', help='JSONL file, "-" for stdin')
+    parser.add_argument('-o', '--output', default='-', help='JSONL file, "-" for stdout')
+    parser.add_argument('--prompt', choices=sorted(PROMPTS), default='v2')
+    parser.add_argument('--conversations-key', default='conversations')
+    parser.add_argument('--functions-key', default='functions')
+    parser.add_argument('--output-key', default='prompt')
+    parser.add_argument('--add-bos-token', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunksize', type=int, default=64)
+    parser.add_argument('--window', type=int, default=None,
+                        help='chunks in flight at once, 2 * workers by default')
+    return parser.parse_args(argv)
+
+
+def _open(path, mode):
+    # stdin and stdout are read and written as UTF-8 as well, whatever the locale
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return io.TextIOWrapper(stream.buffer, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def _close(f, path):
+    if path == '-':
+        f.detach()  # flushes, and leaves sys.stdin and sys.stdout open
+    else:
+        f.close()
+
+
+def convert(lines, output, prompt, conversations_key='conversations', functions_key='functions',
+            output_key='prompt', add_bos_token=False, workers=1, chunksize=64, window=None):
+    # Records are read lazily and written back in input order; only the records of the chunks
+    # in flight are held in memory.
+    pending = collections.deque()  # (record, line number) waiting for their prompt, None for an unparsed line
+    counts = {'records': 0, 'errors': 0}
+
+    def items():
+        for n, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                item = (record[conversations_key], record.get(functions_key) or None)
+            except (ValueError, KeyError, AttributeError, TypeError) as e:
+                pending.append(({'error': f'line {n}: {type(e).__name__}: {e}'}, None))
+                continue
+            pending.append((record, n))
+            yield item
+
+    def write(record, failed):
+        counts['records'] += 1
+        counts['errors'] += failed
+        output.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    for result in iter_prompts(prompt, items(), add_bos_token=add_bos_token,
+                               workers=workers, chunksize=chunksize, window=window):
+        while pending[0][1] is None:
+            write(pending.popleft()[0], True)
+        record, n = pending.popleft()
+        if isinstance(result, str):
+            record[output_key] = result
+        else:
+            # the index of a RenderError counts the parsed records only
+            record['error'] = f'line {n}: {result.error_type}: {result.message}'
+        write(record, not isinstance(result, str))
+    while pending:
+        write(pending.popleft()[0], True)
+    return counts
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    prompt = PROMPTS[args.prompt]()
+
+    lines = _open(args.input, 'r')
+    output = _open(args.output, 'w')
+    try:
+        counts = convert(lines, output, prompt,
+                         conversations_key=args.conversations_key, functions_key=args.functions_key,
+                         output_key=args.output_key, add_bos_token=args.add_bos_token,
+                         workers=args.workers, chunksize=args.chunksize, window=args.window)
+    finally:
+        _close(lines, args.input)
+        _close(output, args.output)
+
+    print(f'{counts["records"]} records, {counts["errors"]} errors', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
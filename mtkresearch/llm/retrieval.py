@@ -0,0 +1,124 @@
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from .prompt import compile_functions
+
+
+_CAMEL = re.compile(r'([a-z0-9])([A-Z])')
+_RUN = re.compile(r'[0-9a-z]+|[^\W_0-9a-z]+')
+
+
+def _tokenize(text, ngram_range=(1, 2)):
+    # latin words and numbers are terms, other scripts, e.g. Traditional Chinese, are
+    # character n-grams
+    terms = []
+    for run in _RUN.findall(_CAMEL.sub(r'\1 \2', text).lower()):
+        if all(ord(c) < 128 for c in run):  # str.isascii needs Python 3.7
+            terms.append(run)
+            continue
+        for n in range(ngram_range[0], ngram_range[1] + 1):
+            terms.extend(run[i:i + n] for i in range(len(run) - n + 1))
+    return terms
+
+
+def _descriptions(schema):
+    # the descriptions and property names of a JSON schema, recursively
+    if isinstance(schema, dict):
+        for key, value in schema.items():
+            if key == 'description' and isinstance(value, str):
+                yield value
+            elif key == 'properties' and isinstance(value, dict):
+                for name, prop in value.items():
+                    yield name
+                    yield from _descriptions(prop)
+            elif isinstance(value, (dict, list)):
+                yield from _descriptions(value)
+    elif isinstance(schema, list):
+        for item in schema:
+            yield from _descriptions(item)
+
+
+def _function_text(func):
+    return ' '.join([func['name'], func.get('description') or '', *_descriptions(func.get('parameters'))])
+
+
+class ToolRetriever:
+    # Selects the functions of a large catalog worth putting in the tools header of a request:
+    # the top `k` by BM25 between the latest user turn and the name, description and
+    # parameter descriptions of each function, plus every function already called in the
+    # conversation, so the selection always validates against the history. The selection
+    # keeps the order of the catalog and is compiled once per distinct set, so a repeated
+    # selection reuses its serialized tools header.
+    def __init__(self, functions, k=8, k1=1.5, b=0.75, ngram_range=(1, 2), cache_size=128):
+        self.catalog = compile_functions(functions)
+        self.k = k
+        self.k1 = k1
+        self.b = b
+        self.ngram_range = ngram_range
+        self.cache_size = cache_size
+        self._index = {func['name']: i for i, func in enumerate(self.catalog)}
+        self._selections = OrderedDict()  # {function indices: FunctionCatalog}
+        self._lock = threading.Lock()
+
+        self._postings = {}  # {term: [(function index, term frequency)]}
+        self._lengths = []
+        for i, func in enumerate(self.catalog):
+            terms = Counter(_tokenize(_function_text(func), ngram_range))
+            self._lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                self._postings.setdefault(term, []).append((i, tf))
+        n = len(self._lengths)
+        self._average_length = sum(self._lengths) / n if n else 0
+        self._idf = {
+            term: math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._postings.items()
+        }
+
+    def scores(self, query):
+        # {function index: BM25 score} of the functions sharing a term with `query`
+        scores = {}
+        k1, b, average_length = self.k1, self.b, self._average_length
+        for term, qtf in Counter(_tokenize(query, self.ngram_range)).items():
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            idf = self._idf[term] * qtf
+            for i, tf in postings:
+                norm = k1 * (1 - b + b * self._lengths[i] / average_length)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query, k=None):
+        # the names of the `k` best functions for `query`, best first
+        k = self.k if k is None else k
+        scores = self.scores(query)
+        best = sorted(scores, key=lambda i: (-scores[i], i))[:k]
+        return [self.catalog[i]['name'] for i in best]
+
+    def used_functions(self, conversations):
+        names = []
+        for conv in conversations:
+            if conv['role'] == 'assistant' and 'tool_calls' in conv:
+                names.extend(c['function']['name'] for c in conv['tool_calls'])
+            elif conv['role'] == 'tool':
+                names.append(conv.get('name'))
+        return [name for name in dict.fromkeys(names) if name in self._index]
+
+    def select(self, conversations, k=None):
+        # a FunctionCatalog of the selected functions, for `prompt.get_prompt(conversations, ...)`
+        query = next((conv['content'] for conv in reversed(conversations) if conv['role'] == 'user'), '')
+        names = self.search(query, k) + self.used_functions(conversations)
+        key = tuple(sorted(set(self._index[name] for name in names)))
+        with self._lock:
+            selection = self._selections.get(key)
+            if selection is not None:
+                self._selections.move_to_end(key)
+                return selection
+        selection = compile_functions([self.catalog[i] for i in key])
+        with self._lock:
+            self._selections[key] = selection
+            while len(self._selections) > self.cache_size:
+                self._selections.popitem(last=False)
+        return selection
@@ -0,0 +1,174 @@
+_TYPE_MAP = {
+    'string': str,
+    'integer': int,
+    'float': float,
+    'boolean': bool,
+    # 'list': list,
+    # 'dict': dict
+}
+
+
+def _parse_default(value_str, expected_type):
+    if expected_type == str:
+        return value_str
+    elif expected_type == int:
+        # 先轉換為 float，然後轉換為 int
+        if type(value_str) == str:
+            raise ValueError("Expect int but get str")
+        return int(float(value_str))
+    elif expected_type == float:
+        return float(value_str)
+    elif expected_type == bool:
+        return value_str in ('true', 'yes', '1', 'on')
+    else:
+        # TODO
+        pass
+
+
+def _coerce_default(value, type_name):
+    expected_type = _TYPE_MAP.get(type_name.lower()) if isinstance(type_name, str) else None
+    if expected_type is None or (isinstance(value, expected_type) and not
+                                 (expected_type is int and isinstance(value, bool))):
+        return value
+    return _parse_default(value, expected_type)
+
+
+_TYPE_CHECKS = {
+    'string': ('string', lambda v: isinstance(v, str)),
+    'integer': ('integer', lambda v: isinstance(v, int)),
+    'float': ('float', lambda v: isinstance(v, float) or isinstance(v, int)),
+    'boolean': ('boolean', lambda v: isinstance(v, bool)),
+    'array': ('array', lambda v: isinstance(v, list)),
+    'object': ('object', lambda v: isinstance(v, dict)),
+}
+
+
+def _compile_enum(values):
+    try:
+        allowed = frozenset(values)
+    except TypeError:
+        allowed = None
+
+    def check(value):
+        if allowed is not None:
+            try:
+                return value in allowed
+            except TypeError:
+                pass
+        return value in values
+    return check
+
+
+def _compile_value(schema):
+    # returns check(value, path, errors) for the value of one property or array item
+    if not isinstance(schema, dict):
+        return lambda value, path, errors: None
+
+    type_check = _TYPE_CHECKS.get(schema.get('type'))
+    enum = schema['enum'] if 'enum' in schema else None
+    in_enum = _compile_enum(enum) if enum is not None else None
+    nested = None
+    if schema.get('type') == 'object' and isinstance(schema.get('properties'), dict):
+        nested = _compile_object(schema)
+    elif schema.get('type') == 'array' and isinstance(schema.get('items'), dict):
+        item_check = _compile_value(schema['items'])
+
+        def nested(value, path, errors):
+            for i, item in enumerate(value):
+                item_check(item, f'{path}[{i}]', errors)
+
+    def check(value, path, errors):
+        if type_check is not None:
+            if not type_check[1](value):
+                errors.append(f"Incorrect type for '{path}': Expected {type_check[0]}, got {type(value).__name__}")
+            elif nested is not None:
+                nested(value, path, errors)
+        if in_enum is not None and not in_enum(value):
+            errors.append(f"Incorrect value for '{path}': Expected one of {enum}, got '{value}'")
+    return check
+
+
+def _compile_object(schema):
+    # returns check(arguments, path, errors) for a dict with the given properties
+    properties = schema['properties']
+    required = schema.get('required', [])
+    checks = {param: _compile_value(param_schema) for param, param_schema in properties.items()}
+
+    def check(arguments, path, errors):
+        prefix = f'{path}.' if path else ''
+        for param in required:
+            if param not in arguments:
+                errors.append(f"Missing required parameter: '{prefix}{param}'")
+
+        for param, value in arguments.items():
+            value_check = checks.get(param)
+            if value_check is None:
+                errors.append(f"Unexpected parameter: '{prefix}{param}'")
+                continue
+            value_check(value, prefix + param, errors)
+    return check
+
+
+def _compile_defaults(schema):
+    # returns fill(arguments) adding the defaults of missing properties, recursively
+    if not isinstance(schema, dict) or not isinstance(schema.get('properties'), dict):
+        return None
+
+    defaults = {}
+    nested = {}
+    for param, param_schema in schema['properties'].items():
+        if not isinstance(param_schema, dict):
+            continue
+        if 'default' in param_schema:
+            defaults[param] = _coerce_default(param_schema['default'], param_schema.get('type'))
+        if param_schema.get('type') == 'object':
+            fill = _compile_defaults(param_schema)
+            if fill is not None:
+                nested[param] = fill
+    if not defaults and not nested:
+        return None
+
+    def fill(arguments):
+        filled = dict(arguments)
+        for param, value in defaults.items():
+            if param not in filled:
+                filled[param] = value
+        for param, nested_fill in nested.items():
+            if isinstance(filled.get(param), dict):
+                filled[param] = nested_fill(filled[param])
+        return filled
+    return fill
+
+
+class ArgumentsValidator:
+    # The parameters schema of one function compiled into nested checks: enums become sets and
+    # `object` properties and `array` items are checked recursively.
+    def __init__(self, func_description):
+        self.name = func_description.get('name')
+        parameters = func_description['parameters']
+        if not isinstance(parameters, dict) or parameters == {}:  # for the function which no need param.
+            self._check = None
+            self._fill = None
+        else:
+            self._check = _compile_object(parameters)
+            self._fill = _compile_defaults(parameters)
+
+    def check(self, arguments):
+        if self._check is None:
+            return
+        if not isinstance(arguments, dict):
+            raise ValueError(f"Incorrect type for arguments: Expected object, got {type(arguments).__name__}")
+        errors = []
+        self._check(arguments, '', errors)
+        if errors:
+            raise ValueError('\n'.join(errors))
+
+    def fill_defaults(self, arguments):
+        if self._fill is None:
+            return arguments
+        return self._fill(arguments)
+
+    def __call__(self, arguments):
+        # validated arguments with the defaults of the schema filled in
+        self.check(arguments)
+        return self.fill_defaults(arguments)
@@ -0,0 +1,247 @@
+import array
+import mmap
+import os
+import struct
+import sys
+
+from .batch import RenderError, iter_prompts
+
+
+# A shard holds prompts rendered once, for random access without rendering in the data path:
+#   header: magic, version, flags, number of prompts, size of the data, number of spans
+#   data: the UTF-8 prompts, concatenated, padded to 8 bytes
+#   index: number of prompts + 1 offsets into the data, uint64
+#   with spans: number of prompts + 1 offsets into the span records, uint64, then the span
+#       records (start, end, turn index or -1, kind) of uint32, uint32, int32, uint32, where
+#       start and end are byte offsets in the prompt
+# All integers are little-endian.
+_MAGIC = b'MRSHARD\x00'
+_VERSION = 1
+_HAS_SPANS = 1
+_HEADER = struct.Struct('<8sIIQQQ')
+_OFFSET = struct.Struct('<Q')
+_SPAN = struct.Struct('<IIiI')
+_SPAN_KINDS = ('header', 'user', 'answer', 'tool_call', 'tool_response')
+_SPAN_CODES = {kind: i for i, kind in enumerate(_SPAN_KINDS)}
+_SPAN_ROLES = ('system', 'user', 'assistant', 'assistant', 'tool')
+
+
+def _little_endian(values):
+    if sys.byteorder != 'little':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _byte_spans(prompt, data, spans):
+    # the spans of `prompt` with byte offsets in its encoding `data`
+    if len(data) == len(prompt):
+        return spans
+    byte_spans = []
+    position = 0
+    for start, end, role, index, kind in spans:
+        size = len(prompt[start:end].encode('utf-8'))
+        byte_spans.append((position, position + size, role, index, kind))
+        position += size
+    return byte_spans
+
+
+class ShardWriter:
+    # Writes prompts, rendered by `prompt.get_prompt` or given as strings, into a shard at
+    # `path`. The shard is written next to `path` and moved there by `close`.
+    def __init__(self, path, prompt=None, add_bos_token=False, spans=False):
+        self.path = os.fspath(path)
+        self.prompt = prompt
+        self.add_bos_token = add_bos_token
+        self.spans = spans
+        self._tmp_path = f'{self.path}.tmp'
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(b'\x00' * _HEADER.size)
+        self._offsets = array.array('Q', [0])
+        self._span_offsets = array.array('Q', [0])
+        self._span_records = bytearray()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def add(self, conversations, functions=None):
+        kwargs = {'add_bos_token': self.add_bos_token, 'return_spans': self.spans}
+        if functions is not None:
+            rendered = self.prompt.get_prompt(conversations, functions, **kwargs)
+        else:
+            rendered = self.prompt.get_prompt(conversations, **kwargs)
+        if self.spans:
+            self.add_rendered(*rendered)
+        else:
+            self.add_rendered(rendered)
+        return len(self) - 1
+
+    def add_rendered(self, prompt, spans=None):
+        # `spans` as returned by `get_prompt(..., return_spans=True)`, with character offsets
+        if self._file is None:
+            raise ValueError('writer is closed')
+        if self.spans and spans is None:
+            raise ValueError('spans are required by this shard')
+        data = prompt.encode('utf-8')
+        self._file.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+        if self.spans:
+            for start, end, role, index, kind in _byte_spans(prompt, data, spans):
+                self._span_records += _SPAN.pack(start, end, -1 if index is None else index, _SPAN_CODES[kind])
+            self._span_offsets.append(len(self._span_records) // _SPAN.size)
+        return len(self) - 1
+
+    def close(self):
+        if self._file is None:
+            return
+        f = self._file
+        data_size = self._offsets[-1]
+        f.write(b'\x00' * (-data_size % 8))
+        f.write(_little_endian(self._offsets))
+        if self.spans:
+            f.write(_little_endian(self._span_offsets))
+            f.write(self._span_records)
+        f.seek(0)
+        f.write(_HEADER.pack(_MAGIC, _VERSION, _HAS_SPANS if self.spans else 0, len(self), data_size,
+                             len(self._span_records) // _SPAN.size))
+        f.close()
+        self._file = None
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_shard(path, prompt, items, add_bos_token=False, spans=False, skip_errors=False, workers=None,
+                chunksize=64, window=None):
+    # Renders (conversations, functions) pairs in order, see `iter_prompts`, into a shard. A
+    # conversation which fails validation raises its RenderError, or with `skip_errors` is
+    # left out of the shard. Returns the number of prompts and of skipped conversations.
+    counts = {'records': 0, 'errors': 0}
+    with ShardWriter(path, spans=spans) as writer:
+        for result in iter_prompts(prompt, items, add_bos_token=add_bos_token, workers=workers,
+                                   chunksize=chunksize, window=window, return_spans=spans):
+            if isinstance(result, RenderError):
+                if not skip_errors:
+                    raise result
+                counts['errors'] += 1
+            elif spans:
+                writer.add_rendered(*result)
+                counts['records'] += 1
+            else:
+                writer.add_rendered(result)
+                counts['records'] += 1
+    return counts
+
+
+class ShardReader:
+    # Random access to the prompts of a shard, mapped in memory: `reader[i]` decodes prompt
+    # `i`, `get_bytes(i)` is a zero-copy view of its UTF-8 bytes and `spans(i)` its
+    # (start, end, role, turn index, kind) spans in bytes. A reader is pickled as its path,
+    # so it can be handed to dataloader workers, which map the file again. The views of
+    # `get_bytes` must be released or dropped before the reader is closed.
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self._mmap) < _HEADER.size:
+                raise ValueError(f'Not a prompt shard: {self.path}')
+            magic, version, flags, count, data_size, span_count = _HEADER.unpack_from(self._mmap)
+            if magic != _MAGIC:
+                raise ValueError(f'Not a prompt shard: {self.path}')
+            if version != _VERSION:
+                raise ValueError(f'Unsupported shard version: {version}')
+            self._count = count
+            self._has_spans = bool(flags & _HAS_SPANS)
+            self._data = _HEADER.size
+            self._index = self._data + data_size + (-data_size % 8)
+            self._span_index = self._index + (count + 1) * _OFFSET.size
+            self._span_records = self._span_index + (count + 1) * _OFFSET.size
+            size = self._span_records + span_count * _SPAN.size if self._has_spans else self._span_index
+            if len(self._mmap) != size:
+                raise ValueError(f'Truncated prompt shard: {self.path}')
+            self._view = memoryview(self._mmap)
+        except BaseException:
+            self._mmap.close()
+            raise
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._open()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def has_spans(self):
+        return self._has_spans
+
+    def _bounds(self, index, table):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('shard index out of range')
+        position = table + index * _OFFSET.size
+        start, = _OFFSET.unpack_from(self._mmap, position)
+        end, = _OFFSET.unpack_from(self._mmap, position + _OFFSET.size)
+        return start, end
+
+    def get_bytes(self, index):
+        start, end = self._bounds(index, self._index)
+        return self._view[self._data + start:self._data + end]
+
+    def __getitem__(self, index):
+        start, end = self._bounds(index, self._index)
+        return str(self._mmap[self._data + start:self._data + end], 'utf-8')
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def spans(self, index):
+        if not self._has_spans:
+            raise ValueError('shard has no spans')
+        start, end = self._bounds(index, self._span_index)
+        spans = []
+        for position in range(self._span_records + start * _SPAN.size, self._span_records + end * _SPAN.size,
+                              _SPAN.size):
+            s, e, turn, kind = _SPAN.unpack_from(self._mmap, position)
+            spans.append((s, e, _SPAN_ROLES[kind], None if turn < 0 else turn, _SPAN_KINDS[kind]))
+        return spans
+
+    def close(self):
+        # the views returned by `get_bytes` must be released or dropped first; a live one
+        # raises a BufferError and leaves the reader open
+        if self._mmap is not None:
+            self._view.release()
+            try:
+                self._mmap.close()
+            except BufferError:
+                self._view = memoryview(self._mmap)
+                raise BufferError('cannot close the shard while views returned by get_bytes are alive') from None
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,313 @@
+import json
+
+from .call_id import _unique_ids
+from .json_str import _json_str
+
+
+def _partial_suffix(text, tokens):
+    # length of the longest suffix of `text` which may be the beginning of one of `tokens`
+    longest = 0
+    for token in tokens:
+        for k in range(min(len(token) - 1, len(text)), longest, -1):
+            if token.startswith(text[-k:]):
+                longest = k
+                break
+    return longest
+
+
+class GeneratedStrParser:
+    # Push-style counterpart of `parse_generated_str`: feed the generated text chunk by chunk
+    # and receive events as soon as they are known,
+    #   {'type': 'decision', 'decision': 'answer' | 'tool'}
+    #   {'type': 'answer_delta', 'text': ...}
+    #   {'type': 'tool_call', 'tool_call': {'id': ..., 'type': 'function', 'function': {...}}}
+    #   {'type': 'end'}
+    # `close` returns the same conversation turn as `parse_generated_str` on the whole text,
+    # reusing the ids of the tool calls already emitted. A generation stopped without its end
+    # token, e.g. by the token limit, holds back its last text as a possible special token;
+    # `flush` returns the events of that text, so the deltas add up to the closed turn.
+    def __init__(self, prompt, call_id_allocator=None):
+        self.prompt = prompt  # MRPromptV1, MRPromptV2
+        self.call_id_allocator = call_id_allocator
+
+        self._tool_mode = hasattr(prompt, 'tool_call_begin_token')
+        if self._tool_mode:
+            self._decision_tokens = [prompt.answer_token, prompt.tool_call_token]
+            self._end_token = prompt.instance_end_token
+            self._body_tokens = [prompt.tool_call_begin_token, prompt.instance_end_token]
+        else:
+            self._decision_tokens = []
+            self._end_token = prompt.eos_token
+            self._body_tokens = [prompt.eos_token]
+
+        self._buffer = ''
+        self._phase = 'prefix'  # prefix -> answer | tool -> end
+        self._decision = None
+        self._body = None  # start of the text following the decision tokens
+        self._scan = 0  # no token of interest starts before this position
+        self._emitted = 0  # length of the answer text emitted so far, from `_body`
+        self._open = None  # start of the payload of the tool call being generated
+        self._call_ids = []
+        self._generate_call_id = None
+        if self._tool_mode:
+            self._generate_call_id = _unique_ids(call_id_allocator or prompt.generate_call_id)
+        self._result = None
+
+    @property
+    def decision(self):
+        return self._decision
+
+    def feed(self, chunk):
+        if self._result is not None:
+            raise ValueError('parser is closed')
+        self._buffer += chunk
+        events = []
+        if self._phase == 'prefix':
+            self._parse_prefix(events)
+        if self._phase == 'answer':
+            self._parse_answer(events)
+        if self._phase == 'tool':
+            self._parse_tool(events)
+        return events
+
+    def close(self):
+        if self._result is None:
+            call_ids = iter(self._call_ids)
+            if self._tool_mode:
+                self._result = self.prompt._parse_generated_str(
+                    self._buffer, lambda: next(call_ids, None) or self._generate_call_id())
+            else:
+                self._result = self.prompt.parse_generated_str(self._buffer)
+        return self._result
+
+    def flush(self):
+        # the events of the end of the generation, empty if the end token was already seen
+        if self._phase == 'end':
+            return []
+        conv = self.close()
+        events = []
+        if self._phase == 'prefix' and 'content' in conv:
+            self._decision = 'answer'
+            events.append({'type': 'decision', 'decision': 'answer'})
+        if 'content' in conv and self._phase in ('prefix', 'answer'):
+            text = conv['content'][self._emitted:]
+            if text:
+                self._emitted += len(text)
+                events.append({'type': 'answer_delta', 'text': text})
+        self._phase = 'end'
+        events.append({'type': 'end'})
+        return events
+
+    def _skip_spaces(self, pos):
+        while pos < len(self._buffer) and self._buffer[pos].isspace():
+            pos += 1
+        return pos
+
+    def _parse_prefix(self, events):
+        buffer = self._buffer
+        pos = self._skip_spaces(0)
+        decision = None
+        for token, name in zip(self._decision_tokens, ['answer', 'tool']):
+            rest = buffer[pos:pos + len(token)]
+            if len(rest) < len(token) and token.startswith(rest):
+                return  # wait for more text
+            if rest == token:
+                decision = name
+                pos = self._skip_spaces(pos + len(token))
+        if pos == len(buffer):
+            return
+
+        if decision is None or decision == 'answer':
+            if self._tool_mode:
+                rest = buffer[pos:pos + len(self.prompt.tool_call_begin_token)]
+                if self.prompt.tool_call_begin_token.startswith(rest):
+                    if len(rest) < len(self.prompt.tool_call_begin_token):
+                        return
+                    decision = 'tool'
+            decision = decision or 'answer'
+
+        self._decision = decision
+        self._body = pos
+        self._scan = pos
+        self._phase = decision
+        events.append({'type': 'decision', 'decision': decision})
+
+    def _find(self, token):
+        return self._buffer.find(token, self._scan)
+
+    def _emit_answer(self, events, end, strip):
+        text = self._buffer[self._body + self._emitted:end]
+        if strip:
+            text = text.rstrip()
+        if text:
+            self._emitted += len(text)
+            events.append({'type': 'answer_delta', 'text': text})
+
+    def _parse_answer(self, events):
+        if self._tool_mode:
+            begin = self._find(self.prompt.tool_call_begin_token)
+            end = self._find(self._end_token)
+            if begin >= 0 and (end < 0 or begin < end):
+                # tool calls after some text: the turn is parsed as tool calls
+                self._scan = begin
+                self._phase = 'tool'
+                return
+        else:
+            end = self._find(self._end_token)
+
+        if end >= 0:
+            self._emit_answer(events, end, strip=self._tool_mode)
+            self._phase = 'end'
+            events.append({'type': 'end'})
+            return
+
+        # hold back trailing spaces and a possibly incomplete special token
+        held = _partial_suffix(self._buffer, self._body_tokens)
+        self._emit_answer(events, len(self._buffer) - held, strip=True)
+        self._scan = max(self._scan, len(self._buffer) - held)
+
+    def _parse_tool(self, events):
+        begin_token = self.prompt.tool_call_begin_token
+        end_token = self.prompt.tool_call_end_token
+        while True:
+            if self._open is None:
+                begin = self._find(begin_token)
+                end = self._find(self._end_token)
+                if end >= 0 and (begin < 0 or end < begin):
+                    self._phase = 'end'
+                    events.append({'type': 'end'})
+                    return
+                if begin < 0:
+                    self._scan = max(self._scan, len(self._buffer) - _partial_suffix(self._buffer, self._body_tokens))
+                    return
+                self._open = begin + len(begin_token)
+                self._scan = self._open
+
+            end = self._find(end_token)
+            if end < 0:
+                self._scan = max(self._scan, len(self._buffer) - _partial_suffix(self._buffer, [end_token]))
+                return
+
+            try:
+                func_call = json.loads(self._buffer[self._open:end].strip())
+                func_call['arguments'] = _json_str(func_call['arguments'])
+            except Exception:
+                func_call = None  # `close` falls back like `parse_generated_str`
+            if func_call is not None:
+                call_id = self._generate_call_id()
+                self._call_ids.append(call_id)
+                events.append({
+                    'type': 'tool_call',
+                    'tool_call': {
+                        'id': call_id,
+                        'type': 'function',
+                        'function': func_call
+                    }
+                })
+            self._open = None
+            self._scan = end + len(end_token)
+
+
+class StopSequenceDetector:
+    # Aho-Corasick automaton over the special tokens which end a generation. `feed` scans each
+    # new chunk once, keeping the automaton state between chunks, so a token split across
+    # chunks is still found. After a guard token (the end of a tool call) only a resume token
+    # (the begin of another call) or a stop token may follow; anything else is a runaway and
+    # the generation is cut right after the guard token.
+    def __init__(self, stop_tokens, guard_tokens=(), resume_tokens=()):
+        self._patterns = [(token, 'stop', reason) for token, reason in stop_tokens.items()] + \
+            [(token, 'guard', None) for token in guard_tokens] + \
+            [(token, 'resume', None) for token in resume_tokens]
+        self._build()
+        self.reset()
+
+    @classmethod
+    def from_prompt(cls, prompt):
+        stop_tokens = {prompt.eos_token: 'eos'}
+        if hasattr(prompt, 'instance_end_token'):
+            stop_tokens[prompt.instance_end_token] = 'instance_end'
+            return cls(stop_tokens,
+                       guard_tokens=[prompt.tool_call_end_token],
+                       resume_tokens=[prompt.tool_call_begin_token])
+        return cls(stop_tokens)
+
+    def _build(self):
+        goto = [{}]
+        depth = [0]
+        output = [[]]
+        for k, (token, _, _) in enumerate(self._patterns):
+            if not token:
+                raise ValueError
+            state = 0
+            for ch in token:
+                if ch not in goto[state]:
+                    goto.append({})
+                    depth.append(depth[state] + 1)
+                    output.append([])
+                    goto[state][ch] = len(goto) - 1
+                state = goto[state][ch]
+            output[state].append(k)
+
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for ch, child in goto[state].items():
+                queue.append(child)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(ch, 0) if goto[f].get(ch, 0) != child else 0
+                output[child] = output[child] + output[fail[child]]
+
+        self._goto = goto
+        self._fail = fail
+        self._depth = depth
+        self._output = output
+        self._first_chars = set(token[0] for token, _, _ in self._patterns)
+
+    def reset(self):
+        self._state = 0
+        self._pos = 0
+        self._guard = None  # [cut position, start of the text checked after the guard token]
+        self.match = None
+
+    def feed(self, chunk):
+        if self.match is not None:
+            return self.match
+
+        state = self._state
+        pos = self._pos
+        guard = self._guard
+        if state == 0 and guard is None and not any(ch in chunk for ch in self._first_chars):
+            self._pos = pos + len(chunk)
+            return None
+
+        goto, fail, depth, output = self._goto, self._fail, self._depth, self._output
+        for ch in chunk:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            pos += 1
+
+            for k in output[state]:
+                token, action, reason = self._patterns[k]
+                if action == 'stop':
+                    self.match = {'reason': reason, 'token': token, 'start': pos - len(token), 'end': pos}
+                elif action == 'guard':
+                    guard = [pos, pos]
+                else:
+                    guard = None
+            if self.match is not None:
+                break
+
+            if guard is not None and guard[1] < pos:
+                if ch.isspace() and guard[1] == pos - 1:
+                    guard[1] = pos
+                elif depth[state] < pos - guard[1]:
+                    self.match = {'reason': 'runaway', 'token': None, 'start': guard[0], 'end': guard[0]}
+                    break
+
+        self._state = state
+        self._pos = pos
+        self._guard = guard
+        return self.match
@@ -0,0 +1,189 @@
+import concurrent.futures
+import copy
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def _error_result(e):
+    return {'error': f'{type(e).__name__}: {e}'}
+
+
+def _tool_result(result):
+    # func_response takes a dict, other values are wrapped
+    return result if isinstance(result, dict) else {'result': result}
+
+
+def _call(tool, arguments):
+    return tool(**arguments)
+
+
+class ToolResultCache:
+    # LRU cache of tool results, keyed on the function name and the arguments serialized with
+    # sorted keys. Only the functions registered as idempotent are cached, each with its own
+    # TTL; this is kept out of the function schemas so the rendered tools header does not
+    # change. One cache may be shared by the dispatchers of many sessions.
+    def __init__(self, max_size=1024, ttl=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl  # default seconds a result is kept, None for no limit
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+
+        self._ttls = {}  # {function name: ttl} of the cacheable functions
+        self._entries = OrderedDict()  # {key: (expiry, result)}, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def register(self, name, ttl=None):
+        # marks `name` as idempotent and safe to cache
+        self._ttls[name] = self.ttl if ttl is None else ttl
+
+    def key(self, name, arguments):
+        # None for a call which is not cached
+        if name not in self._ttls:
+            return None
+        try:
+            return name, json.dumps(arguments, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        except (TypeError, ValueError):
+            return None
+
+    def get(self, key):
+        # the cached result for `key`, or None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= self.clock():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(entry[1])
+
+    def put(self, key, result):
+        ttl = self._ttls[key[0]]
+        result = copy.deepcopy(result)
+        with self._lock:
+            self._entries[key] = (None if ttl is None else self.clock() + ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+class ToolDispatcher:
+    # Runs the tool calls returned by `MRChatManager.parse_assistant` with registered blocking
+    # callables on a thread or process pool, and records the results with `func_response` in
+    # the order of the calls. The arguments are checked against the function catalog of the
+    # manager, and the defaults filled in, before a call is submitted; a call which fails
+    # validation, raises or times out records {'error': ...}. Tools run on a process pool must
+    # be picklable, i.e. defined at module level. With a `cache`, the results of the tools
+    # registered as idempotent are reused.
+    def __init__(self, tools=None, executor='thread', max_workers=None, timeout=None, cache=None):
+        if executor == 'thread':
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+            self._owns_executor = True
+        elif executor == 'process':
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+            self._owns_executor = True
+        elif isinstance(executor, concurrent.futures.Executor):
+            self.executor = executor
+            self._owns_executor = False
+        else:
+            raise ValueError(f'Unknown executor: {executor!r}')
+        self.timeout = timeout  # default seconds per call, None for no limit
+        self.cache = cache  # ToolResultCache
+        self.tools = {}  # {function name: (callable, timeout)}
+        for name, tool in (tools or {}).items():
+            self.register(name, tool)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._owns_executor:
+            self.executor.shutdown(wait=True)
+
+    def register(self, name, tool, timeout=None, idempotent=False, ttl=None):
+        # `tool` is called with the arguments of the call as keyword arguments; the results of
+        # an idempotent tool are cached for `ttl` seconds
+        self.tools[name] = (tool, timeout)
+        if idempotent:
+            if self.cache is None:
+                raise ValueError('idempotent tools need a cache')
+            self.cache.register(name, ttl)
+
+    def _submit(self, catalog, func_call):
+        # returns (result, None, None, None, None) for a call answered without running it, or
+        # (None, future, timeout, deadline, cache key)
+        try:
+            tool, timeout = self.tools[func_call['name']]
+        except KeyError:
+            return {'error': f"KeyError: Unknown tool: '{func_call['name']}'"}, None, None, None, None
+        try:
+            arguments = func_call['arguments']
+            if catalog is not None and func_call['name'] in catalog.mapping:
+                arguments = catalog.validator(func_call['name'])(arguments)
+            elif not isinstance(arguments, dict):
+                raise ValueError(f'Incorrect type for arguments: Expected object, got {type(arguments).__name__}')
+        except ValueError as e:
+            return _error_result(e), None, None, None, None
+
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(func_call['name'], arguments)
+            if key is not None:
+                result = self.cache.get(key)
+                if result is not None:
+                    return result, None, None, None, None
+
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        return None, self.executor.submit(_call, tool, arguments), timeout, deadline, key
+
+    def _wait(self, submitted):
+        result, future, timeout, deadline, key = submitted
+        if future is None:
+            return result
+        try:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            result = _tool_result(future.result(remaining))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            return {'error': f'TimeoutError: No result after {timeout} seconds'}
+        except Exception as e:
+            return _error_result(e)
+        if key is not None:
+            self.cache.put(key, result)
+        return result
+
+    def run(self, manager, func_calls):
+        # runs `func_calls` concurrently and records their results in `manager`
+        catalog = manager._sync_functions()
+        submitted = [self._submit(catalog, x) for x in func_calls]
+        results = [self._wait(x) for x in submitted]
+        for x, result in zip(func_calls, results):
+            manager.func_response(x['id'], result)
+        return results
+
+    def step(self, manager, generated_str):
+        # `manager.parse_assistant` followed by `run` for a turn with tool calls
+        result = manager.parse_assistant(generated_str)
+        if 'func_calls' in result:
+            result['results'] = self.run(manager, result['func_calls'])
+        return result
@@ -26,5 +26,10 @@ setuptools.setup(
     install_requires=[
     ],
     extras_require={
+    },
+    entry_points={
+        'console_scripts': [
+            'mtkresearch-render=mtkresearch.llm.render:main',
+        ],
     }
 )
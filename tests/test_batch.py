@@ -0,0 +1,74 @@
+from mtkresearch.llm.batch import RenderError, get_prompts
+from mtkresearch.llm.prompt import MRPromptV1, MRPromptV2
+
+
+functions = [
+    {
+        'name': 'get_current_weather',
+        'description': 'Get the current_weather',
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                'location': {
+                    'type': 'string',
+                    'description': 'The city and state, e.g. San Francisco, CA'
+                }
+            },
+            'required': ['location']
+        }
+    }
+]
+
+
+def _conversations(n):
+    conversations_list = []
+    for i in range(n):
+        conversations_list.append([
+            {
+                "role": "user",
+                "content": f"QUERY{i}"
+            },
+            {
+                "role": "assistant",
+                "tool_calls": [
+                    {
+                        'id': f'ID{i}',
+                        'type': 'function',
+                        'function': {
+                            'arguments': "{\"location\": \"Boston, MA\"}",
+                            'name': 'get_current_weather'
+                        }
+                    }]
+            },
+        ])
+    return conversations_list
+
+
+class TestGetPrompts:
+
+    def test_inline(self):
+        prompt = MRPromptV2()
+        conversations_list = _conversations(5)
+        conversations_list[2] = [{"role": "assistant", "content": "RESP1"}]
+        results = get_prompts(prompt, conversations_list, [functions] * 5)
+
+        for i in [0, 1, 3, 4]:
+            assert results[i] == prompt.get_prompt(conversations_list[i], functions)
+        assert isinstance(results[2], RenderError)
+        assert results[2].index == 2
+
+    def test_pool(self):
+        prompt = MRPromptV2()
+        conversations_list = _conversations(20)
+        functions_list = [functions] * 19 + [[{'name': 'broken'}]]
+        results = get_prompts(prompt, conversations_list, functions_list, add_bos_token=True, workers=2, chunksize=3)
+
+        for i in range(19):
+            assert results[i] == prompt.get_prompt(conversations_list[i], functions, add_bos_token=True)
+        assert isinstance(results[19], RenderError)
+
+    def test_v1(self):
+        prompt = MRPromptV1()
+        conversations_list = [[{"role": "user", "content": f"QUERY{i}"}] for i in range(4)]
+        assert get_prompts(prompt, conversations_list, workers=2) == \
+            [prompt.get_prompt(conversations) for conversations in conversations_list]
@@ -0,0 +1,66 @@
+import itertools
+import pickle
+import re
+
+import pytest
+
+from mtkresearch.llm.call_id import CallIdAllocator
+from mtkresearch.llm.chat import MRChatManager
+from mtkresearch.llm.prompt import MRPromptV2
+from mtkresearch.llm.stream import GeneratedStrParser
+
+
+GENERATED = '<|use_tool|><|tool_call_begin|>{"name": "F", "arguments": "{}"}<|tool_call_end|>' \
+            '<|tool_call_begin|>{"name": "G", "arguments": "{}"}<|tool_call_end|><|im_end|>'
+
+
+class TestCallIdAllocator:
+
+    @pytest.mark.parametrize('mode', ['random', 'fast', 'seeded'])
+    def test_format(self, mode):
+        allocator = CallIdAllocator(mode, batch_size=30)
+        ids = [allocator() for _ in range(100)]
+        assert all(re.fullmatch(r'call_[A-Za-z0-9]{24}', x) for x in ids)
+        assert len(set(ids)) == 100
+
+    def test_seeded(self):
+        a = CallIdAllocator('seeded', seed=7)
+        b = CallIdAllocator('seeded', seed=7)
+        assert [a() for _ in range(5)] == [b() for _ in range(5)]
+        assert CallIdAllocator('seeded', seed=8)() != CallIdAllocator('seeded', seed=7)()
+
+    def test_pickled_fast_allocator_does_not_repeat(self):
+        allocator = CallIdAllocator('fast')
+        allocator()
+        copied = pickle.loads(pickle.dumps(allocator))
+        assert allocator() != copied()
+
+    def test_parse_generated_str(self):
+        prompt = MRPromptV2()
+        conv = prompt.parse_generated_str(GENERATED, call_id_allocator=CallIdAllocator('seeded', seed=1))
+        expected = CallIdAllocator('seeded', seed=1)
+        assert [x['id'] for x in conv['tool_calls']] == [expected(), expected()]
+
+        # the ids of one group are unique even if the allocator repeats itself
+        conv = prompt.parse_generated_str(GENERATED, call_id_allocator=itertools.cycle(['call_a', 'call_b']).__next__)
+        assert [x['id'] for x in conv['tool_calls']] == ['call_a', 'call_b']
+        conv = prompt.parse_generated_str(GENERATED, call_id_allocator=itertools.cycle(['call_a', 'call_a', 'call_b']).__next__)
+        assert [x['id'] for x in conv['tool_calls']] == ['call_a', 'call_b']
+
+    def test_stream_parser(self):
+        prompt = MRPromptV2()
+        parser = GeneratedStrParser(prompt, call_id_allocator=CallIdAllocator('seeded', seed=1))
+        for c in GENERATED:
+            parser.feed(c)
+        assert parser.close() == prompt.parse_generated_str(GENERATED, call_id_allocator=CallIdAllocator('seeded', seed=1))
+
+    def test_manager(self):
+        functions = [{'name': name, 'description': f'{name}-D', 'parameters': None} for name in ['F', 'G']]
+        prompts = []
+        for _ in range(2):
+            manager = MRChatManager(MRPromptV2(), functions=functions, call_id_allocator=CallIdAllocator('seeded', seed=3))
+            manager.user_input('Q1')
+            for x in manager.parse_assistant(GENERATED)['func_calls']:
+                manager.func_response(x['id'], {})
+            prompts.append(manager.get_prompt())
+        assert prompts[0] == prompts[1]
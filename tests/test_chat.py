@@ -1,6 +1,14 @@
+import asyncio
+import copy
+import json
+import pickle
+import threading
 
-from mtkresearch.llm.chat import MRChatManager
+import pytest
+
+from mtkresearch.llm.chat import AsyncMRChatManager, ChatSessionPool, MRChatManager
 from mtkresearch.llm.prompt import MRPromptV1, MRPromptV2
+from mtkresearch.llm.tools import ToolResultCache
 
 
 class TestMRChatManager:
@@ -116,3 +124,446 @@ class TestMRChatManager:
                     'content': 'Q2'
                 },
             ]
+
+    def test_incremental_prompt(self):
+        functions = [
+            {
+                'name': 'F',
+                'description': 'F-D',
+                'parameters': {
+                    'type': 'object',
+                    'properties': {
+                        'V1': {
+                            'type': 'string',
+                            'description': 'V1-D'
+                        }
+                    },
+                    'required': ['V1']
+                }
+            }
+        ]
+        prompt = MRPromptV2()
+        with MRChatManager(prompt=prompt, sys_prompt='SYS', functions=functions) as manager:
+            manager.user_input('Q1')
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations, functions)
+
+            result = manager.parse_assistant('<|use_tool|><|tool_call_begin|>{"name": "F", "arguments": "{\\"V1\\": \\"A1\\"}"}<|tool_call_end|><|tool_call_begin|>{"name": "F", "arguments": "{\\"V1\\": \\"A2\\"}"}<|tool_call_end|><|im_end|>')
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations, functions)
+            for x in result['func_calls']:
+                manager.func_response(x['id'], {'result': x['arguments']['V1']})
+                assert manager.get_prompt(add_bos_token=True) == \
+                    prompt.get_prompt(manager.conversations, functions, add_bos_token=True)
+            manager.parse_assistant('<|answer|>A3<|im_end|>')
+            manager.user_input('Q2')
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations, functions)
+
+            # edits of the history invalidate the cached turns
+            conversations = copy.deepcopy(manager.conversations)
+            conversations[1] = {'role': 'user', 'content': 'Q1-edited'}
+            manager.conversations = conversations
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations, functions)
+            conversations[-2]['content'] = 'A3-edited'
+            manager.conversations = conversations
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations, functions)
+            manager.conversations = conversations[:-2]
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations, functions)
+
+            # as does a new function catalog
+            manager.functions = functions + [{'name': 'G', 'description': 'G-D', 'parameters': None}]
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations, manager.functions)
+
+            # and an edit of the function list in place
+            manager.functions[0]['description'] = 'F-D-edited'
+            manager.functions.append({'name': 'H', 'description': 'H-D', 'parameters': None})
+            assert 'F-D-edited' in manager.get_prompt()
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations, manager.functions)
+
+            # and a change of the config of the prompt
+            prompt.config['compact_functions'] = True
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations, manager.functions)
+            prompt.config['add_decision_token'] = False
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations, manager.functions)
+
+    def test_incremental_prompt_v1(self):
+        prompt = MRPromptV1()
+        with MRChatManager(prompt=prompt) as manager:
+            manager.user_input('Q1')
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations)
+            manager.parse_assistant(' A1</s>')
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations)
+            manager.user_input('Q2')
+            assert manager.get_prompt(add_bos_token=True) == prompt.get_prompt(manager.conversations, add_bos_token=True)
+
+    def test_incremental_validation(self):
+        prompt = MRPromptV2()
+        with MRChatManager(prompt=prompt, sys_prompt='SYS') as manager:
+            manager.user_input('Q1')
+            manager.get_prompt()
+            manager.user_input('Q2')
+            with pytest.raises(ValueError):
+                manager.get_prompt()
+
+            manager.conversations = manager.conversations[:-1]
+            manager.parse_assistant('<|answer|>A1<|im_end|>')
+            manager.user_input('Q2')
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations)
+
+    def test_validate_arguments(self):
+        functions = [
+            {
+                'name': 'F',
+                'description': 'F-D',
+                'parameters': {
+                    'type': 'object',
+                    'properties': {
+                        'V1': {
+                            'type': 'string'
+                        },
+                        'V2': {
+                            'type': 'integer',
+                            'default': 3
+                        }
+                    },
+                    'required': ['V1']
+                }
+            }
+        ]
+        with MRChatManager(prompt=MRPromptV2(), functions=functions, validate_arguments=True) as manager:
+            manager.user_input('Q1')
+            with pytest.raises(ValueError):
+                manager.parse_assistant('<|use_tool|><|tool_call_begin|>{"name": "F", "arguments": "{\\"V2\\": 1}"}<|tool_call_end|><|im_end|>')
+            assert len(manager.conversations) == 1
+
+            result = manager.parse_assistant('<|use_tool|><|tool_call_begin|>{"name": "F", "arguments": "{\\"V1\\": \\"A\\"}"}<|tool_call_end|><|im_end|>')
+            assert result['func_calls'][0]['arguments'] == {'V1': 'A', 'V2': 3}
+            assert manager.conversations[-1]['tool_calls'][0]['function']['arguments'] == '{"V1": "A"}'
+
+    def test_truncation(self):
+        functions = [
+            {
+                'name': 'F',
+                'description': 'F-D',
+                'parameters': {
+                    'type': 'object',
+                    'properties': {
+                        'V1': {
+                            'type': 'string'
+                        }
+                    }
+                }
+            }
+        ]
+        prompt = MRPromptV2()
+        with MRChatManager(prompt=prompt, sys_prompt='SYS', functions=functions, max_length=600) as manager:
+            for i in range(20):
+                manager.user_input(f'Q{i}')
+                text = manager.get_prompt()
+                assert len(text) <= 600
+                assert text == prompt.get_prompt(manager.conversations, functions)
+
+                result = manager.parse_assistant(f'<|use_tool|><|tool_call_begin|>{{"name": "F", "arguments": "{{\\"V1\\": \\"{i}\\"}}"}}<|tool_call_end|><|im_end|>')
+                manager.func_response(result['func_calls'][0]['id'], {'result': 'R' * 50})
+                text = manager.get_prompt()
+                assert len(text) <= 600
+                assert text == prompt.get_prompt(manager.conversations, functions)
+
+                manager.parse_assistant(f'<|answer|>A{i}<|im_end|>')
+                assert len(manager.get_prompt()) <= 600
+
+            assert manager.conversations[0] == {'role': 'system', 'content': 'SYS'}
+            assert manager.conversations[1]['role'] == 'user'
+            assert manager.conversations[-1] == {'role': 'assistant', 'content': 'A19'}
+            assert len(manager.conversations) < 20
+
+    def test_truncation_keeps_latest_user_turn(self):
+        prompt = MRPromptV1()
+        with MRChatManager(prompt=prompt, max_length=10, length_function=lambda x: len(x.split())) as manager:
+            for i in range(3):
+                manager.user_input(f'Q{i}')
+                manager.parse_assistant(f'A{i}</s>')
+            manager.user_input('Q3')
+            assert manager.get_prompt() == prompt.get_prompt([{'role': 'user', 'content': 'Q3'}])
+
+    def test_block_hashes(self):
+        prompt = MRPromptV2()
+        with MRChatManager(prompt=prompt, sys_prompt='SYS') as manager:
+            for i in range(3):
+                manager.user_input(f'Q{i}')
+                assert manager.get_prompt(return_block_hashes=True) == \
+                    prompt.get_prompt(manager.conversations, return_block_hashes=True)
+                manager.parse_assistant(f'<|answer|>A{i}<|im_end|>')
+                assert manager.get_prompt(add_bos_token=True, return_block_hashes=True) == \
+                    prompt.get_prompt(manager.conversations, add_bos_token=True, return_block_hashes=True)
+
+    def test_compact_turns(self):
+        functions = [{'name': 'F', 'description': 'F-D', 'parameters': None}]
+        prompt = MRPromptV2()
+        with MRChatManager(prompt=prompt, sys_prompt='SYS', functions=functions) as manager:
+            manager.user_input('Q1')
+            result = manager.parse_assistant('<|use_tool|><|tool_call_begin|>{"name": "F", "arguments": "{}"}<|tool_call_end|><|im_end|>')
+            manager.func_response(result['func_calls'][0]['id'], {'result': 1})
+
+            # the function name is stored once for the call and its response
+            call, response = manager._turns[-2:]
+            assert call.tool_calls[0][1] is response.name
+
+            # the view is read-only, edits go through an assigned copy
+            conversations = manager.conversations
+            assert conversations[2]['tool_calls'][0]['function'] == {'name': 'F', 'arguments': '{}'}
+            with pytest.raises(TypeError):
+                conversations[1]['content'] = 'Q1-edited'
+            with pytest.raises(TypeError):
+                conversations[2]['tool_calls'][0]['function']['name'] = 'G'
+            with pytest.raises(TypeError):
+                conversations.append({'role': 'user', 'content': 'Q2'})
+            with pytest.raises(TypeError):
+                conversations.pop()
+            assert manager.conversations[1]['content'] == 'Q1'
+            edited = copy.deepcopy(conversations)
+            assert type(edited) is list and type(edited[1]) is dict
+            edited[1]['content'] = 'Q1-edited'
+            manager.conversations = edited
+            assert manager.conversations[1]['content'] == 'Q1-edited'
+            assert pickle.loads(pickle.dumps(conversations)) == conversations
+            # the view shares the values of the turns, payloads are not copied
+            assert manager.conversations[3]['content'] is manager._turns[3].content
+
+            # turns of other shapes round-trip unchanged
+            extra = {'role': 'user', 'content': 'Q2', 'meta': {'source': 'web'}}
+            manager.conversations = manager.conversations + [extra]
+            assert manager.conversations[-1] == extra
+            with pytest.raises(TypeError):
+                manager.conversations[-1]['meta']['source'] = 'app'
+            assert manager.get_prompt() == prompt.get_prompt(manager.conversations, functions)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestChatSessionPool:
+
+    def test_lru_eviction(self):
+        spilled = []
+        pool = ChatSessionPool(MRPromptV2(), sys_prompt='SYS', max_sessions=2,
+                               spill=lambda session_id, manager: spilled.append((session_id, manager.conversations)))
+        for session_id in ['a', 'b']:
+            with pool.session(session_id) as manager:
+                manager.user_input(f'Q-{session_id}')
+        with pool.session('a'):
+            pass
+        with pool.session('c'):
+            pass
+
+        assert 'b' not in pool and 'a' in pool and 'c' in pool
+        assert spilled == [('b', [{'role': 'system', 'content': 'SYS'}, {'role': 'user', 'content': 'Q-b'}])]
+        with pytest.raises(KeyError):
+            with pool.session('b', create=False):
+                pass
+
+    def test_shared_catalog_reference(self, monkeypatch):
+        functions = [{'name': 'F', 'description': 'F-D', 'parameters': None}]
+        pool = ChatSessionPool(MRPromptV2(), functions=functions)
+        for session_id in ['a', 'b']:
+            with pool.session(session_id) as manager:
+                manager.user_input('Q1')
+                manager.get_prompt()
+                # the session keeps a reference to the catalog of the pool, not a copy
+                assert manager._cached_functions == (pool.functions, pool.functions)
+                assert manager._cached_functions[0] is pool.functions
+
+        monkeypatch.setattr('mtkresearch.llm.chat.compile_functions', None)
+        with pool.session('a') as manager:
+            manager.parse_assistant('A1')
+            manager.user_input('Q2')
+            assert manager.get_prompt() == MRPromptV2().get_prompt(manager.conversations, functions)
+
+    def test_idle_ttl(self):
+        clock = FakeClock()
+        spilled = []
+        pool = ChatSessionPool(MRPromptV2(), idle_ttl=10, clock=clock,
+                               spill=lambda session_id, manager: spilled.append(session_id))
+        with pool.session('a'):
+            pass
+        clock.now = 5
+        with pool.session('b'):
+            pass
+        clock.now = 12
+        assert pool.evict_idle() == 1
+        assert spilled == ['a'] and len(pool) == 1
+
+    def test_session_in_use_is_not_evicted(self):
+        pool = ChatSessionPool(MRPromptV2(), max_sessions=1)
+        with pool.session('a') as manager:
+            with pool.session('b'):
+                pass
+            assert 'a' in pool and 'b' not in pool
+            manager.user_input('Q1')
+
+    def test_failing_spill(self, caplog):
+        spilled = []
+
+        def spill(session_id, manager):
+            spilled.append(session_id)
+            if session_id == 'a':
+                raise RuntimeError('spill failed')
+
+        clock = FakeClock()
+        pool = ChatSessionPool(MRPromptV2(), idle_ttl=10, clock=clock, spill=spill)
+        for session_id in ['a', 'b']:
+            with pool.session(session_id):
+                pass
+        clock.now = 20
+        with pool.session('c') as manager:
+            manager.user_input('Q1')
+        # each session is spilled and released, and the failure is logged, not raised
+        assert spilled == ['a', 'b'] and len(pool) == 1
+        assert "spill of session 'a' failed" in caplog.text
+        assert pool._sessions['c'].users == 0
+        clock.now = 40
+        assert pool.evict_idle() == 1 and spilled == ['a', 'b', 'c']
+
+    def test_shared_catalog(self):
+        functions = [{'name': 'F', 'description': 'F-D', 'parameters': None}]
+        prompt = MRPromptV2()
+        pool = ChatSessionPool(prompt, functions=functions)
+        with pool.session('a') as a, pool.session('b') as b:
+            assert a.functions is b.functions is pool.functions
+            assert a.prompt is b.prompt is prompt
+            a.user_input('Q1')
+            assert a.get_prompt() == prompt.get_prompt(a.conversations, functions)
+
+    def test_concurrent_access(self):
+        pool = ChatSessionPool(MRPromptV2(), max_sessions=4)
+
+        def worker(i):
+            for j in range(50):
+                with pool.session(j % 8) as manager:
+                    if not manager.conversations or manager.conversations[-1]['role'] != 'user':
+                        manager.user_input(f'Q{i}')
+                    else:
+                        manager.parse_assistant(f'<|answer|>A{i}<|im_end|>')
+                    manager.get_prompt()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(pool) <= 4
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class TestAsyncMRChatManager:
+    functions = [
+        {
+            'name': name,
+            'description': f'{name}-D',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'delay': {
+                        'type': 'float'
+                    }
+                },
+                'required': ['delay']
+            }
+        } for name in ['F', 'G', 'H']
+    ]
+    generated = '<|use_tool|>' + ''.join(
+        '<|tool_call_begin|>' + json.dumps({'name': name, 'arguments': json.dumps({'delay': delay})}) + '<|tool_call_end|>'
+        for name, delay in [('F', 0.05), ('G', 0.0), ('H', 10.0)]
+    ) + '<|im_end|>'
+
+    def test_concurrent_calls(self):
+        finished = []
+
+        def tool(name):
+            async def call(delay):
+                await asyncio.sleep(delay)
+                finished.append(name)
+                return {'name': name}
+            return call
+
+        async def g(delay):
+            raise RuntimeError('failed')
+
+        manager = AsyncMRChatManager(MRPromptV2(), functions=self.functions,
+                                     tools={'F': tool('F'), 'H': tool('H')}, timeout=0.2)
+        manager.register_tool('G', g)
+        manager.user_input('Q1')
+        result = run(manager.step(self.generated))
+
+        assert finished == ['F']
+        assert result['results'] == [
+            {'name': 'F'},
+            {'error': 'RuntimeError: failed'},
+            {'error': 'TimeoutError: No result after 0.2 seconds'}
+        ]
+        # recorded in the order of the calls, not of completion
+        assert [x['tool_call_id'] for x in manager.conversations[-3:]] == [x['id'] for x in result['func_calls']]
+        assert manager.get_prompt() == MRPromptV2().get_prompt(manager.conversations, self.functions)
+
+    def test_cancellation(self):
+        cancelled = []
+
+        async def tool(delay):
+            try:
+                await asyncio.sleep(delay + 10)
+            except asyncio.CancelledError:
+                cancelled.append(delay)
+                raise
+
+        async def fast(delay):
+            return 'done'
+
+        async def main(manager):
+            task = asyncio.ensure_future(manager.step(self.generated))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        manager = AsyncMRChatManager(MRPromptV2(), functions=self.functions, tools={'F': tool, 'G': fast, 'H': tool})
+        manager.user_input('Q1')
+        run(main(manager))
+        assert sorted(cancelled) == [0.05, 10.0]
+        # the finished call records its result, the cancelled ones an error
+        responses = manager.conversations[-3:]
+        assert [conv['name'] for conv in responses] == ['F', 'G', 'H']
+        assert [json.loads(conv['content']) for conv in responses] == [
+            {'error': 'CancelledError: The call was cancelled'},
+            {'result': 'done'},
+            {'error': 'CancelledError: The call was cancelled'},
+        ]
+        manager.parse_assistant('<|answer|>A1<|im_end|>')
+        manager.user_input('Q2')
+        assert manager.get_prompt() == manager.prompt.get_prompt(manager.conversations, self.functions)
+
+    def test_cache(self):
+        calls = []
+
+        async def tool(delay):
+            calls.append(delay)
+            return {'delay': delay}
+
+        cache = ToolResultCache()
+        for _ in range(2):
+            manager = AsyncMRChatManager(MRPromptV2(), functions=self.functions, cache=cache)
+            for name in ['F', 'G', 'H']:
+                manager.register_tool(name, tool, idempotent=name != 'H')
+            manager.user_input('Q1')
+            run(manager.step(self.generated))
+        assert calls == [0.05, 0.0, 10.0, 10.0]
+        assert cache.stats() == {'hits': 2, 'misses': 2, 'size': 2}
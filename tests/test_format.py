@@ -0,0 +1,72 @@
+import pickle
+
+import pytest
+
+from mtkresearch.llm.format import V1_FORMAT, PromptFormat
+from mtkresearch.llm.prompt import MRPromptV1, MRPromptV2
+
+
+class ChatMLPrompt(MRPromptV1):
+    format = {
+        'system': {
+            'template': '<|im_start|>system\n{system}<|im_end|>\n',
+            'default': 'You are a helpful assistant.',
+        },
+        'turns': {
+            'user': {'template': '<|im_start|>user\n{content}<|im_end|>\n<|im_start|>assistant\n'},
+            'answer': {'template': '{content}<|im_end|>\n'},
+        },
+    }
+
+
+class TestPromptFormat:
+
+    def test_custom_format(self):
+        prompt = ChatMLPrompt()
+        conversations = [
+            {'role': 'user', 'content': ' Hi '},
+            {'role': 'assistant', 'content': 'Hello'},
+        ]
+        assert prompt.get_prompt(conversations) == (
+            '<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n'
+            '<|im_start|>user\nHi<|im_end|>\n<|im_start|>assistant\nHello<|im_end|>\n'
+        )
+        conversations += [{'role': 'user', 'content': 'Bye'}, {'role': 'assistant', 'content': 'yo'}]
+        assert prompt.get_prompt([{'role': 'system', 'content': 'SYS'}] + conversations) == (
+            '<|im_start|>system\nSYS<|im_end|>\n'
+            '<|im_start|>user\nHi<|im_end|>\n<|im_start|>assistant\nHello<|im_end|>\n'
+            '<|im_start|>user\nBye<|im_end|>\n<|im_start|>assistant\nyo<|im_end|>\n'
+        )
+        assert prompt.get_prompt([{'role': 'system', 'content': ' '}] + conversations).startswith(
+            '<|im_start|>system\n<|im_end|>\n')
+
+    def test_unknown_field(self):
+        with pytest.raises(ValueError):
+            PromptFormat({'system': {'template': '{system}{unknown_token}'}}, vars(MRPromptV1()))
+        with pytest.raises(ValueError):
+            PromptFormat({'system': {'template': '{system}'}, 'turns': {'function': {'template': ''}}}, {})
+        with pytest.raises(ValueError):
+            PromptFormat(dict(V1_FORMAT, system={'template': 'no slot'}), vars(MRPromptV1()))
+
+    def test_tokens_and_config(self):
+        prompt = MRPromptV2()
+        conversations = [
+            {'role': 'user', 'content': 'Hi'},
+            {'role': 'assistant', 'content': 'Hello'},
+        ]
+        assert prompt.answer_token + 'Hello' in prompt.get_prompt(conversations)
+        prompt.config['add_decision_token'] = False
+        assert prompt.answer_token not in prompt.get_prompt(conversations)
+
+        prompt = MRPromptV1()
+        prompt.get_prompt(conversations)
+        prompt.eos_token = '<eos>'
+        assert prompt.get_prompt(conversations).endswith('Hello<eos>')
+
+    def test_pickle(self):
+        prompt = MRPromptV2()
+        conversations = [{'role': 'user', 'content': 'Hi'}]
+        rendered = prompt.get_prompt(conversations)
+        copy = pickle.loads(pickle.dumps(prompt))
+        assert '_compiled_formats' not in vars(copy)
+        assert copy.get_prompt(conversations) == rendered
@@ -0,0 +1,81 @@
+import json
+import pickle
+
+from mtkresearch.llm.chat import MRChatManager
+from mtkresearch.llm.json_str import JsonStr
+from mtkresearch.llm.prompt import MRPromptV2
+
+
+class CountingLoads:
+    def __init__(self, monkeypatch):
+        self.count = 0
+        loads = json.loads
+
+        def counting(*args, **kwargs):
+            self.count += 1
+            return loads(*args, **kwargs)
+        monkeypatch.setattr(json, 'loads', counting)
+
+
+class TestJsonStr:
+
+    def test_str(self):
+        s = JsonStr('{"a": "\\u4e2d"}')
+        assert s == '{"a": "\\u4e2d"}' and json.dumps({'s': s}) == json.dumps({'s': '{"a": "\\u4e2d"}'})
+        assert s.parsed == {'a': '中'}
+        assert s.canonical == '{"a": "中"}'
+        # pickled as the plain string, without the caches
+        restored = pickle.loads(pickle.dumps(s))
+        assert type(restored) is str and restored == s
+        assert not hasattr(s, '__dict__')
+
+        s = JsonStr('{"a": 1}')
+        assert s.canonical is s
+
+        s = JsonStr.dumps({'a': '中'})
+        assert s == json.dumps({'a': '中'}) and s.canonical == '{"a": "中"}'
+
+    def test_cached(self, monkeypatch):
+        s = JsonStr('{"a": 1}')
+        loads = CountingLoads(monkeypatch)
+        for _ in range(3):
+            assert s.parsed == {'a': 1} and s.canonical == '{"a": 1}'
+        assert loads.count == 1
+
+    def test_history_is_decoded_once(self, monkeypatch):
+        functions = [{'name': 'F', 'description': 'F-D', 'parameters': None}]
+        prompt = MRPromptV2()
+        manager = MRChatManager(prompt, functions=functions)
+        manager.user_input('Q1')
+        result = manager.parse_assistant('<|use_tool|><|tool_call_begin|>{"name": "F", "arguments": "{\\"x\\": \\"中\\"}"}<|tool_call_end|><|im_end|>')
+        assert result['func_calls'][0]['arguments'] == {'x': '中'}
+        manager.func_response(result['func_calls'][0]['id'], {'result': '中'})
+        conversations = manager.conversations
+        assert isinstance(conversations[1]['tool_calls'][0]['function']['arguments'], JsonStr)
+        assert isinstance(conversations[2]['content'], JsonStr)
+
+        expected = prompt.get_prompt(json.loads(json.dumps(conversations)), functions)
+        assert prompt.get_prompt(conversations, functions) == expected
+        loads = CountingLoads(monkeypatch)
+        for _ in range(3):
+            assert prompt.get_prompt(conversations, functions) == expected
+        assert loads.count == 0
+
+    def test_parsed_is_a_copy(self):
+        s = JsonStr('{"a": {"b": 1}}')
+        s.parsed['a']['b'] = 2
+        assert s.parsed == {'a': {'b': 1}} and s.canonical == '{"a": {"b": 1}}'
+
+        functions = [{
+            'name': 'get_current_weather', 'description': 'D',
+            'parameters': {'type': 'object', 'properties': {'location': {'type': 'string'}}}
+        }]
+        prompt = MRPromptV2()
+        manager = MRChatManager(prompt, functions=functions)
+        manager.user_input('Q1')
+        result = manager.parse_assistant('<|use_tool|><|tool_call_begin|>{"name": "get_current_weather", "arguments": "{\\"location\\": \\"Taipei\\"}"}<|tool_call_end|><|im_end|>')
+        expected = manager.get_prompt()
+        result['func_calls'][0]['arguments']['location'] = 'NORMALIZED'
+        result['func_calls'][0]['arguments']['extra'] = 1
+        assert manager.get_prompt() == expected == prompt.get_prompt(manager.conversations, functions)
+        assert 'NORMALIZED' not in expected
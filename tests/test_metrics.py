@@ -0,0 +1,85 @@
+import pytest
+
+from mtkresearch.llm.chat import MRChatManager
+from mtkresearch.llm.metrics import Instrumentation, MetricsAggregator
+from mtkresearch.llm.prompt import MRPromptV1, MRPromptV2
+
+
+class TestInstrumentation:
+
+    def test_prompt_stages(self):
+        events = []
+        aggregator = MetricsAggregator()
+        prompt = MRPromptV2()
+        prompt.instrumentation = Instrumentation(aggregator, lambda *event: events.append(event))
+        functions = [{'name': 'F', 'description': 'F-D', 'parameters': None}]
+        conversations = [{'role': 'system', 'content': 'SYS'}, {'role': 'user', 'content': 'Q1'}]
+
+        text = prompt.get_prompt(conversations, functions)
+        assert [(kind, name) for kind, name, _ in events] == [
+            ('duration', 'check_functions'),
+            ('duration', 'validate'),
+            ('duration', 'header'),
+            ('duration', 'render'),
+            ('size', 'turns'),
+            ('size', 'prompt_chars'),
+        ]
+        assert events[-1][2] == len(text) and events[-2][2] == 2
+
+        with pytest.raises(ValueError):
+            prompt.get_prompt([{'role': 'assistant', 'content': 'A1'}])
+        prompt.parse_generated_str('<|use_tool|><|tool_call_begin|>{"name": "F"}<|tool_call_end|><|im_end|>')
+        prompt.parse_generated_str('<|use_tool|><|tool_call_begin|>{"name": "F", "arguments": "{}"}<|tool_call_end|><|im_end|>')
+
+        snapshot = aggregator.snapshot()
+        assert snapshot['count'] == {'validate.errors': 1, 'parse.skip_errors': 1, 'parse.tool_calls': 1}
+        assert snapshot['duration']['parse']['count'] == 2
+        assert snapshot['size']['prompt_chars'] == {'count': 1, 'sum': len(text), 'min': len(text), 'max': len(text)}
+
+    def test_v1(self):
+        aggregator = MetricsAggregator()
+        prompt = MRPromptV1()
+        prompt.instrumentation = Instrumentation(aggregator)
+        prompt.get_prompt([{'role': 'user', 'content': 'Q1'}])
+        prompt.parse_generated_str('A1</s>')
+        assert sorted(aggregator.snapshot()['duration']) == ['header', 'parse', 'render', 'validate']
+        assert MRPromptV1.instrumentation is None
+
+    def test_chat_manager(self):
+        aggregator = MetricsAggregator()
+        prompt = MRPromptV2()
+        with MRChatManager(prompt, sys_prompt='SYS', max_length=60,
+                           instrumentation=Instrumentation(aggregator)) as manager:
+            for i in range(3):
+                manager.user_input(f'Q{i}')
+                manager.get_prompt()
+                manager.parse_assistant(f'<|answer|>A{i}<|im_end|>')
+            manager.conversations = manager.conversations[:2]
+            manager.get_prompt()
+
+        snapshot = aggregator.snapshot()
+        assert snapshot['count']['chat.header_renders'] == 1  # the edit keeps the header
+        assert snapshot['count']['chat.invalidations'] == 1
+        assert snapshot['count']['chat.truncations'] >= 1
+        assert snapshot['duration']['chat.sync']['count'] == 4
+        assert 'parse' not in snapshot['duration']  # the prompt itself is not instrumented
+
+    def test_prometheus(self):
+        aggregator = MetricsAggregator()
+        metrics = Instrumentation(aggregator)
+        metrics.duration('validate', 0.5)
+        metrics.duration('validate', 0.25)
+        metrics.size('prompt_chars', 10)
+        metrics.count('parse.skip_errors')
+        assert aggregator.prometheus() == (
+            '# TYPE mtkresearch_prompt_stage_seconds summary\n'
+            'mtkresearch_prompt_stage_seconds_sum{stage="validate"} 0.75\n'
+            'mtkresearch_prompt_stage_seconds_count{stage="validate"} 2\n'
+            '# TYPE mtkresearch_prompt_size summary\n'
+            'mtkresearch_prompt_size_sum{name="prompt_chars"} 10\n'
+            'mtkresearch_prompt_size_count{name="prompt_chars"} 1\n'
+            '# TYPE mtkresearch_prompt_events_total counter\n'
+            'mtkresearch_prompt_events_total{name="parse.skip_errors"} 1\n'
+        )
+        aggregator.reset()
+        assert aggregator.prometheus() == ''
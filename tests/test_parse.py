@@ -0,0 +1,90 @@
+import pytest
+
+from mtkresearch.llm.call_id import CallIdAllocator
+from mtkresearch.llm.parse import PromptParser, parse_prompts
+from mtkresearch.llm.prompt import MRPromptV2
+
+
+class TestPromptParser:
+    prompt = MRPromptV2()
+    functions = [
+        {
+            'name': 'get_current_weather',
+            'description': 'Get the current_weather',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'location': {'type': 'string'}
+                },
+                'required': ['location']
+            }
+        }
+    ]
+    conversations = [
+        {'role': 'system', 'content': 'SYS'},
+        {'role': 'user', 'content': 'QUERY1'},
+        {
+            'role': 'assistant',
+            'tool_calls': [{
+                'id': 'call_8jLWqlXaY3OisD24IHJLwD3G',
+                'type': 'function',
+                'function': {'name': 'get_current_weather', 'arguments': '{"location": "台北"}'}
+            }]
+        },
+        {
+            'role': 'tool',
+            'tool_call_id': 'call_8jLWqlXaY3OisD24IHJLwD3G',
+            'name': 'get_current_weather',
+            'content': '{"temperature": "22 celsius"}'
+        },
+        {'role': 'assistant', 'content': 'RESP1'},
+        {'role': 'user', 'content': 'QUERY2'},
+    ]
+
+    def test_round_trip(self):
+        text = self.prompt.get_prompt(self.conversations, self.functions, add_bos_token=True)
+        assert self.prompt.parse_prompt(text) == (self.conversations, self.functions)
+
+        conversations = [{'role': 'user', 'content': ' QUERY1 '}, {'role': 'assistant', 'content': 'RESP1'}]
+        assert self.prompt.parse_prompt(self.prompt.get_prompt(conversations)) == ([
+            {'role': 'system', 'content': 'You are a helpful assistant.'},
+            {'role': 'user', 'content': 'QUERY1'},
+            {'role': 'assistant', 'content': 'RESP1'},
+        ], None)
+
+    def test_last_tool_calls(self):
+        conversations = self.conversations[:3]
+        text = self.prompt.get_prompt(conversations, self.functions)
+        parsed, _ = self.prompt.parse_prompt(text, call_id_allocator=CallIdAllocator('seeded', seed=0))
+        assert parsed[:2] == conversations[:2]
+        call = parsed[2]['tool_calls'][0]
+        assert call['id'] == CallIdAllocator('seeded', seed=0)()
+        assert call['function'] == conversations[2]['tool_calls'][0]['function']
+
+    def test_stream(self):
+        other = [{'role': 'system', 'content': 'SYS2'}, {'role': 'user', 'content': 'QUERY3'}]
+        # without bos tokens, a prompt starts with its tools or system block
+        text = self.prompt.get_prompt(self.conversations, self.functions) + self.prompt.get_prompt(other) + \
+            self.prompt.get_prompt(self.conversations[:5], self.functions, add_bos_token=True)
+        expected = [(self.conversations, self.functions), (other, None), (self.conversations[:5], self.functions)]
+        for size in [1, 5, 64, len(text)]:
+            chunks = (text[i:i + size] for i in range(0, len(text), size))
+            assert list(parse_prompts(self.prompt, chunks)) == expected
+
+        with pytest.raises(ValueError):
+            self.prompt.parse_prompt(text)
+
+    def test_errors(self):
+        text = self.prompt.get_prompt(self.conversations, self.functions)
+        with pytest.raises(ValueError, match='Missing'):
+            self.prompt.parse_prompt(text[:text.index('QUERY2') + 3])
+        with pytest.raises(ValueError, match='Unexpected text'):
+            self.prompt.parse_prompt('QUERY' + text)
+        with pytest.raises(ValueError, match='Unknown role'):
+            self.prompt.parse_prompt('<|im_start|>other\nX<|im_end|>')
+
+        parser = PromptParser(self.prompt)
+        parser.feed(text)
+        parser.close()
+        with pytest.raises(ValueError):
+            parser.feed(text)
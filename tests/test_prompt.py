@@ -1,6 +1,12 @@
 import json
 
-from mtkresearch.llm.prompt import MRPromptV1, MRPromptV2
+import copy
+import pickle
+
+import pytest
+
+from mtkresearch.llm.prompt import MRPromptV1, MRPromptV2, ConversationValidator, FunctionCatalog, compile_functions
+from mtkresearch.llm.schema import ArgumentsValidator
 
 
 class TestMRPromptV1:
@@ -493,3 +499,291 @@ class TestMRPromptV2:
         assert conv['tool_calls'][1]['type'] == 'function'
         assert conv['tool_calls'][1]['function']['name'] == 'get_current_weather'
         assert conv['tool_calls'][1]['function']['arguments'] == '{"location": "Taipei, Taiwan"}'
+
+
+class TestFunctionCatalog:
+    functions = TestMRPromptV2.functions
+
+    def test_compile(self):
+        catalog = compile_functions(self.functions)
+        assert isinstance(catalog, FunctionCatalog)
+        assert list(catalog) == self.functions
+        assert catalog.mapping['get_current_weather'] == self.functions[0]
+        assert compile_functions(catalog) is catalog
+
+        # a fresh copy of the same catalog hits the cache
+        assert compile_functions(copy.deepcopy(self.functions)) is catalog
+        assert pickle.loads(pickle.dumps(catalog)) is catalog
+
+    def test_compile_invalid(self):
+        functions = copy.deepcopy(self.functions)
+        functions[0]['parameters']['required'] = ['date']
+        with pytest.raises(ValueError):
+            compile_functions(functions)
+        with pytest.raises(ValueError):
+            MRPromptV2().check_functions(functions)
+
+    def test_get_prompt_with_catalog(self):
+        prompt = MRPromptV2()
+        conversations = [
+            {
+                "role": "user",
+                "content": "QUERY1"
+            },
+        ]
+        catalog = compile_functions(self.functions)
+        assert prompt.get_prompt(conversations, catalog) == prompt.get_prompt(conversations, self.functions)
+
+
+class TestConversationValidator:
+    functions = TestMRPromptV2.functions
+
+    def test_feed(self):
+        prompt = MRPromptV2()
+        conversations = [
+            {
+                "role": "system",
+                "content": "SYS"
+            },
+            {
+                "role": "user",
+                "content": "QUERY1"
+            },
+            {
+                "role": "assistant",
+                "tool_calls": [
+                    {
+                        'id': 'ID1',
+                        'type': 'function',
+                        'function': {
+                            'arguments': "{\"location\": \"Boston, MA\"}",
+                            'name': 'get_current_weather'
+                        }
+                    }]
+            },
+            {
+                "role": "tool",
+                "tool_call_id": "ID1",
+                "name": "get_current_weather",
+                "content": "{\"temperature\": \"22 celsius\"}"
+            },
+        ]
+        validator = ConversationValidator(prompt, functions=self.functions)
+        for conv in conversations:
+            validator.feed(conv)
+        validator.finish()
+
+        with pytest.raises(ValueError):
+            validator.feed({"role": "tool", "tool_call_id": "ID2", "name": "get_current_weather", "content": "{}"})
+        with pytest.raises(ValueError):
+            validator.feed({"role": "tool", "tool_call_id": "ID1", "name": "get_weather", "content": "{}"})
+        validator.feed({"role": "assistant", "content": "RESP1"})
+        with pytest.raises(ValueError):
+            validator.feed({"role": "assistant", "content": "RESP2"})
+
+    def test_list_validators_compiled_once(self, monkeypatch):
+        compiled = []
+
+        class CountingValidator(ArgumentsValidator):
+            def __init__(self, func_description):
+                compiled.append(func_description['name'])
+                super().__init__(func_description)
+
+        monkeypatch.setattr('mtkresearch.llm.prompt.ArgumentsValidator', CountingValidator)
+        call = {'role': 'assistant', 'tool_calls': [{
+            'id': 'ID1', 'type': 'function',
+            'function': {'arguments': '{"location": "Boston, MA"}', 'name': 'get_current_weather'}}]}
+        response = {'role': 'tool', 'tool_call_id': 'ID1', 'name': 'get_current_weather', 'content': '{}'}
+        conversations = [{'role': 'user', 'content': 'QUERY1'}, call, response] * 3
+        conversations.append({'role': 'assistant', 'content': 'RESP1'})
+        MRPromptV2().check_conversations(conversations, functions=self.functions)
+        assert compiled == ['get_current_weather']
+
+    def test_system_needs_user(self):
+        prompt = MRPromptV2()
+        validator = ConversationValidator(prompt)
+        validator.feed({"role": "system", "content": "SYS"})
+        with pytest.raises(ValueError):
+            validator.finish()
+        with pytest.raises(ValueError):
+            validator.feed({"role": "assistant", "content": "RESP1"})
+        with pytest.raises(ValueError):
+            prompt.check_conversations([{"role": "system", "content": "SYS"}, {"role": "assistant", "content": "RESP1"}])
+
+
+class TestSpans:
+
+    def test_v2_spans(self):
+        prompt = MRPromptV2()
+        conversations = [
+            {
+                "role": "system",
+                "content": "系統"
+            },
+            {
+                "role": "user",
+                "content": "問1"
+            },
+            {
+                "role": "assistant",
+                "tool_calls": [
+                    {
+                        'id': 'ID1',
+                        'type': 'function',
+                        'function': {
+                            'arguments': "{\"location\": \"波士頓\"}",
+                            'name': 'get_current_weather'
+                        }
+                    }]
+            },
+            {
+                "role": "tool",
+                "tool_call_id": "ID1",
+                "name": "get_current_weather",
+                "content": "{\"temperature\": \"22 度c\"}"
+            },
+            {
+                "role": "assistant",
+                "content": "答1"
+            },
+        ]
+        functions = TestMRPromptV2.functions
+        text, spans = prompt.get_prompt(conversations, functions, add_bos_token=True, return_spans=True)
+        assert text == prompt.get_prompt(conversations, functions, add_bos_token=True)
+        assert [(role, index, kind) for _, _, role, index, kind in spans] == [
+            ('system', 0, 'header'),
+            ('user', 1, 'user'),
+            ('assistant', 2, 'tool_call'),
+            ('tool', 3, 'tool_response'),
+            ('assistant', 4, 'answer'),
+        ]
+        assert spans[0][0] == 0 and spans[-1][1] == len(text)
+        for (_, end, _, _, _), (start, _, _, _, _) in zip(spans, spans[1:]):
+            assert end == start
+        assert text[spans[4][0]:spans[4][1]] == '<|answer|>答1<|im_end|>'
+        assert text[spans[1][0]:spans[1][1]] == '<|im_start|>user\n問1<|im_end|><|im_start|>assistant\n'
+
+    def test_v1_spans(self):
+        prompt = MRPromptV1()
+        conversations = [
+            {
+                "role": "user",
+                "content": "QUERY1"
+            },
+            {
+                "role": "assistant",
+                "content": "RESPONSE1"
+            },
+        ]
+        text, spans = prompt.get_prompt(conversations, return_spans=True)
+        assert spans[0][2:] == ('system', None, 'header')
+        assert text[spans[2][0]:spans[2][1]] == 'RESPONSE1</s>'
+
+
+class TestBlockHashes:
+
+    def test_prefix_hashes(self):
+        prompt = MRPromptV2()
+        functions = TestMRPromptV2.functions
+        conversations = [
+            {
+                "role": "system",
+                "content": "SYS"
+            },
+            {
+                "role": "user",
+                "content": "QUERY1"
+            },
+            {
+                "role": "assistant",
+                "content": "RESPONSE1"
+            },
+        ]
+        text, hashes = prompt.get_prompt(conversations, functions, return_block_hashes=True)
+        assert [end for end, _ in hashes] == [
+            text.index('<|im_start|>system'), text.index('<|im_start|>user'), text.index('<|answer|>'), len(text)]
+
+        longer = conversations + [{"role": "user", "content": "QUERY2"}]
+        text2, spans, hashes2 = prompt.get_prompt(longer, functions, return_spans=True, return_block_hashes=True)
+        assert hashes2[:len(hashes)] == hashes
+        assert len(hashes2) == len(spans) + 1  # the header has two blocks
+
+        _, other = prompt.get_prompt([{"role": "system", "content": "SYS2"}] + longer[1:], functions, return_block_hashes=True)
+        assert other[0] == hashes[0]
+        assert all(x != y for x, y in zip(other[1:], hashes2[1:]))
+
+
+class TestCompactFunctions:
+    functions = [
+        {
+            'name': 'get_current_weather',
+            'description': 'Get the current weather of a city',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'location': {'type': 'string', 'description': ''},
+                    'raw': {},
+                    'unit': {'type': 'string', 'enum': ['celsius', ''], 'default': ''}
+                },
+                'required': []
+            }
+        },
+        {'name': 'F', 'description': '', 'parameters': None}
+    ]
+
+    def test_serialize(self):
+        catalog = compile_functions(self.functions)
+        assert catalog.serialize() == catalog.serialized
+        assert json.loads(catalog.serialize(compact=True)) == [
+            {
+                'name': 'get_current_weather',
+                'description': 'Get the current weather of a city',
+                'parameters': {
+                    'type': 'object',
+                    'properties': {
+                        'location': {'type': 'string'},
+                        'raw': {},
+                        'unit': {'type': 'string', 'enum': ['celsius', ''], 'default': ''}
+                    }
+                }
+            },
+            {'name': 'F', 'description': '', 'parameters': None}
+        ]
+        assert ', ' not in catalog.serialize(compact=True)
+        assert json.loads(catalog.serialize(max_description_length=7))[0]['description'] == 'Get the…'
+        assert catalog.functions == self.functions
+
+    def test_get_prompt(self):
+        prompt = MRPromptV2()
+        conversations = [{'role': 'user', 'content': 'QUERY1'}]
+        default = prompt.get_prompt(conversations, self.functions)
+        prompt.config['compact_functions'] = True
+        compact = prompt.get_prompt(conversations, self.functions)
+        catalog = compile_functions(self.functions)
+        assert compact == default.replace(catalog.serialized, catalog.serialize(compact=True))
+
+        report = prompt.functions_report(self.functions)
+        assert report['default_tools_block'] - report['tools_block'] == report['saved'] == len(default) - len(compact)
+        assert report['functions']['F'] == len('{"name":"F","description":"","parameters":null}')
+        texts = []
+        prompt.functions_report(self.functions, count_tokens=lambda text: texts.append(text) or 0)
+        assert texts[1] == compact[:compact.index('<|im_start|>system')]
+
+    def test_round_trip(self):
+        prompt = MRPromptV2()
+        prompt.config['compact_functions'] = True
+        functions = self.functions + [
+            {'name': 'G', 'description': 'G-D', 'parameters': {}},
+            {'name': 'H', 'description': 'H-D', 'parameters': {'type': 'object', 'properties': {}}},
+        ]
+        conversations = [
+            {'role': 'user', 'content': 'QUERY1'},
+            {'role': 'assistant', 'tool_calls': [
+                {'id': 'call_1', 'type': 'function', 'function': {'name': 'F', 'arguments': '{}'}}]},
+            {'role': 'tool', 'tool_call_id': 'call_1', 'name': 'F', 'content': '{"a": 1}'},
+        ]
+        text = prompt.get_prompt(conversations, functions)
+        parsed_conversations, parsed_functions = prompt.parse_prompt(text)
+        assert [func['name'] for func in parsed_functions] == ['get_current_weather', 'F', 'G', 'H']
+        assert prompt.get_prompt(parsed_conversations, parsed_functions) == text
+
@@ -0,0 +1,54 @@
+import io
+import json
+
+from mtkresearch.llm.prompt import MRPromptV2
+from mtkresearch.llm.render import convert, main
+
+
+records = [
+    {'id': 0, 'conversations': [{'role': 'user', 'content': 'QUERY1'}]},
+    {'id': 1, 'conversations': [{'role': 'assistant', 'content': 'RESP1'}]},
+    {'id': 2, 'conversations': [{'role': 'system', 'content': 'SYS'}, {'role': 'user', 'content': '問1'}]},
+]
+
+
+class TestRender:
+
+    def test_convert(self):
+        prompt = MRPromptV2()
+        lines = [json.dumps(r, ensure_ascii=False) + '\n' for r in records * 10]
+        lines.insert(4, '{broken\n')
+        output = io.StringIO()
+        counts = convert(iter(lines), output, prompt, workers=2, chunksize=2, window=2)
+        assert counts == {'records': 31, 'errors': 11}
+
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert results[4]['error'].startswith('line 5: ')
+        # errors name the line of the record, the unparsed lines included
+        assert results[5]['error'].startswith('line 6: ValueError')
+        del results[4]
+        for record, result in zip(records * 10, results):
+            assert result['id'] == record['id']
+            if record['id'] == 1:
+                assert 'error' in result
+            else:
+                assert result['prompt'] == prompt.get_prompt(record['conversations'])
+
+    def test_main(self, tmp_path):
+        path = tmp_path / 'in.jsonl'
+        path.write_text(''.join(json.dumps(r) + '\n' for r in records), encoding='utf-8')
+        out = tmp_path / 'out.jsonl'
+        assert main([str(path), '-o', str(out), '--add-bos-token']) == 0
+        results = [json.loads(line) for line in out.read_text(encoding='utf-8').splitlines()]
+        assert results[0]['prompt'] == MRPromptV2().get_prompt(records[0]['conversations'], add_bos_token=True)
+
+    def test_stdio_is_utf8(self, monkeypatch):
+        # stdin and stdout of an ASCII locale
+        stdin = io.TextIOWrapper(io.BytesIO((json.dumps(records[2]) + '\n').encode('ascii')), encoding='ascii')
+        stdout = io.TextIOWrapper(io.BytesIO(), encoding='ascii')
+        monkeypatch.setattr('sys.stdin', stdin)
+        monkeypatch.setattr('sys.stdout', stdout)
+        assert main([]) == 0
+        result = json.loads(stdout.buffer.getvalue().decode('utf-8'))
+        assert result['prompt'] == MRPromptV2().get_prompt(records[2]['conversations'])
+        assert not stdout.closed
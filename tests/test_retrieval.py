@@ -0,0 +1,66 @@
+from mtkresearch.llm.prompt import MRPromptV2
+from mtkresearch.llm.retrieval import ToolRetriever, _tokenize
+
+
+functions = [
+    {
+        'name': 'get_current_weather',
+        'description': '查詢目前的天氣',
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                'location': {'type': 'string', 'description': '城市名稱，例如台北'}
+            },
+            'required': ['location']
+        }
+    },
+    {
+        'name': 'send_email',
+        'description': '寄送電子郵件',
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                'to': {'type': 'string', 'description': '收件人的郵件地址'}
+            }
+        }
+    },
+    {'name': 'searchFlights', 'description': 'Search flights between two cities', 'parameters': None},
+]
+
+
+class TestToolRetriever:
+
+    def test_tokenize(self):
+        assert _tokenize('searchFlights 台北天氣') == ['search', 'flights', '台', '北', '天', '氣', '台北', '北天', '天氣']
+        assert _tokenize('天氣', ngram_range=(2, 2)) == ['天氣']
+
+    def test_search(self):
+        retriever = ToolRetriever(functions, k=1)
+        assert retriever.search('台北今天的天氣如何？') == ['get_current_weather']
+        assert retriever.search('幫我寄一封郵件') == ['send_email']
+        assert retriever.search('cheap flights to Tokyo') == ['searchFlights']
+        assert retriever.search('hello') == []
+        assert retriever.search('台北天氣, flights', k=3) == ['get_current_weather', 'searchFlights']
+
+    def test_select(self):
+        prompt = MRPromptV2()
+        retriever = ToolRetriever(functions, k=1)
+        conversations = [
+            {'role': 'user', 'content': '台北天氣如何？'},
+            {'role': 'assistant', 'tool_calls': [{
+                'id': 'call_1', 'type': 'function',
+                'function': {'name': 'get_current_weather', 'arguments': '{"location": "台北"}'}
+            }]},
+            {'role': 'tool', 'tool_call_id': 'call_1', 'name': 'get_current_weather', 'content': '{"溫度": 22}'},
+            {'role': 'assistant', 'content': '22 度'},
+            {'role': 'user', 'content': '把結果寄到我的郵件'},
+        ]
+        selection = retriever.select(conversations)
+        assert [func['name'] for func in selection] == ['get_current_weather', 'send_email']
+        assert retriever.select(conversations) is selection
+        assert prompt.get_prompt(conversations, selection) == prompt.get_prompt(conversations, functions[:2])
+
+        selection = retriever.select([{'role': 'user', 'content': 'hello'}])
+        assert len(selection) == 0
+        assert prompt.get_prompt([{'role': 'user', 'content': 'hello'}], selection) == \
+            prompt.get_prompt([{'role': 'user', 'content': 'hello'}])
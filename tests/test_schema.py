@@ -0,0 +1,82 @@
+import pytest
+
+from mtkresearch.llm.schema import ArgumentsValidator
+
+
+function = {
+    'name': 'book',
+    'description': 'Book a trip',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'city': {
+                'type': 'string',
+                'enum': ['Taipei', 'Hsinchu']
+            },
+            'nights': {
+                'type': 'integer',
+                'default': 1
+            },
+            'breakfast': {
+                'type': 'boolean',
+                'default': 'yes'
+            },
+            'guest': {
+                'type': 'object',
+                'properties': {
+                    'name': {'type': 'string'},
+                    'age': {'type': 'integer'},
+                    'vip': {'type': 'boolean', 'default': False}
+                },
+                'required': ['name']
+            },
+            'rooms': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'beds': {'type': 'integer'}
+                    }
+                }
+            }
+        },
+        'required': ['city']
+    }
+}
+
+
+class TestArgumentsValidator:
+    validator = ArgumentsValidator(function)
+
+    def test_valid(self):
+        arguments = {'city': 'Taipei', 'guest': {'name': 'A'}, 'rooms': [{'beds': 2}]}
+        assert self.validator(arguments) == {
+            'city': 'Taipei',
+            'nights': 1,
+            'breakfast': True,
+            'guest': {'name': 'A', 'vip': False},
+            'rooms': [{'beds': 2}]
+        }
+        assert arguments == {'city': 'Taipei', 'guest': {'name': 'A'}, 'rooms': [{'beds': 2}]}
+
+    def test_errors(self):
+        with pytest.raises(ValueError) as e:
+            self.validator.check({'city': 'Tainan', 'nights': '2', 'size': 1})
+        assert str(e.value).split('\n') == [
+            "Incorrect value for 'city': Expected one of ['Taipei', 'Hsinchu'], got 'Tainan'",
+            "Incorrect type for 'nights': Expected integer, got str",
+            "Unexpected parameter: 'size'",
+        ]
+
+    def test_nested_errors(self):
+        with pytest.raises(ValueError) as e:
+            self.validator.check({'city': 'Taipei', 'guest': {'age': 'old'}, 'rooms': [{'beds': 1}, {'beds': []}]})
+        assert str(e.value).split('\n') == [
+            "Missing required parameter: 'guest.name'",
+            "Incorrect type for 'guest.age': Expected integer, got str",
+            "Incorrect type for 'rooms[1].beds': Expected integer, got list",
+        ]
+
+    def test_no_parameters(self):
+        validator = ArgumentsValidator({'name': 'now', 'description': 'Time', 'parameters': {}})
+        assert validator({'any': 1}) == {'any': 1}
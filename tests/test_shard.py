@@ -0,0 +1,94 @@
+import pickle
+
+import pytest
+
+from mtkresearch.llm.batch import RenderError
+from mtkresearch.llm.prompt import MRPromptV1, MRPromptV2
+from mtkresearch.llm.shard import ShardReader, ShardWriter, write_shard
+
+
+functions = [{'name': 'F', 'description': 'F-D', 'parameters': None}]
+items = [
+    ([{'role': 'user', 'content': 'QUERY1'}], None),
+    ([{'role': 'system', 'content': '系統'}, {'role': 'user', 'content': '問題'},
+      {'role': 'assistant', 'content': '回答'}], None),
+    ([{'role': 'user', 'content': 'QUERY2'},
+      {'role': 'assistant', 'tool_calls': [
+          {'id': 'call_1', 'type': 'function', 'function': {'name': 'F', 'arguments': '{}'}}]},
+      {'role': 'tool', 'tool_call_id': 'call_1', 'name': 'F', 'content': '{"a": "甲"}'}], functions),
+]
+
+
+class TestShard:
+
+    def test_round_trip(self, tmp_path):
+        prompt = MRPromptV2()
+        path = tmp_path / 'prompts.shard'
+        assert write_shard(path, prompt, items, spans=True) == {'records': 3, 'errors': 0}
+
+        with ShardReader(path) as reader:
+            assert len(reader) == 3 and reader.has_spans
+            for i, (conversations, functions) in enumerate(items):
+                text, spans = prompt.get_prompt(conversations, functions, return_spans=True)
+                assert reader[i] == text
+                data = bytes(reader.get_bytes(i))
+                assert data == text.encode('utf-8')
+                byte_spans = reader.spans(i)
+                assert [x[2:] for x in byte_spans] == [x[2:] for x in spans]
+                assert [data[s:e].decode('utf-8') for s, e, *_ in byte_spans] == [text[s:e] for s, e, *_ in spans]
+            assert reader[-1] == reader[2] and list(reader) == [reader[i] for i in range(3)]
+            with pytest.raises(IndexError):
+                reader[3]
+
+            copy = pickle.loads(pickle.dumps(reader))
+            assert list(copy) == list(reader)
+            copy.close()
+
+    def test_writer(self, tmp_path):
+        prompt = MRPromptV1()
+        path = tmp_path / 'prompts.shard'
+        with ShardWriter(path, prompt, add_bos_token=True) as writer:
+            assert writer.add(items[0][0]) == 0
+            assert writer.add_rendered('') == 1
+            assert not path.exists()
+        with ShardReader(path) as reader:
+            assert list(reader) == [prompt.get_prompt(items[0][0], add_bos_token=True), '']
+            with pytest.raises(ValueError):
+                reader.spans(0)
+
+        with pytest.raises(RuntimeError):
+            with ShardWriter(tmp_path / 'aborted.shard', prompt) as writer:
+                writer.add(items[0][0])
+                raise RuntimeError
+        assert list(tmp_path.iterdir()) == [path]
+
+    def test_errors(self, tmp_path):
+        prompt = MRPromptV2()
+        invalid = items + [([{'role': 'assistant', 'content': 'RESP1'}], None)] + items
+        with pytest.raises(RenderError):
+            write_shard(tmp_path / 'a.shard', prompt, invalid)
+        assert write_shard(tmp_path / 'a.shard', prompt, invalid, skip_errors=True, workers=2, chunksize=2) == \
+            {'records': 6, 'errors': 1}
+        with ShardReader(tmp_path / 'a.shard') as reader:
+            assert len(reader) == 6
+
+        (tmp_path / 'b.shard').write_bytes(b'x' * 64)
+        with pytest.raises(ValueError):
+            ShardReader(tmp_path / 'b.shard')
+        data = (tmp_path / 'a.shard').read_bytes()
+        (tmp_path / 'c.shard').write_bytes(data[:-8])
+        with pytest.raises(ValueError):
+            ShardReader(tmp_path / 'c.shard')
+
+    def test_close_with_live_view(self, tmp_path):
+        path = tmp_path / 'prompts.shard'
+        write_shard(path, MRPromptV2(), items)
+        reader = ShardReader(path)
+        view = reader.get_bytes(0)
+        with pytest.raises(BufferError):
+            reader.close()
+        # the reader is still open
+        assert bytes(reader.get_bytes(1)) == reader[1].encode('utf-8')
+        view.release()
+        reader.close()
+        reader.close()
@@ -0,0 +1,94 @@
+from mtkresearch.llm.prompt import MRPromptV1, MRPromptV2
+from mtkresearch.llm.stream import GeneratedStrParser, StopSequenceDetector
+
+
+def _feed(parser, generated_str, size):
+    events = []
+    for i in range(0, len(generated_str), size):
+        events += parser.feed(generated_str[i:i + size])
+    return events
+
+
+class TestGeneratedStrParser:
+
+    def test_answer(self):
+        prompt = MRPromptV2()
+        generated_str = '<|answer|> RESP1 <|im_end|>'
+        for size in range(1, len(generated_str) + 1):
+            parser = GeneratedStrParser(prompt)
+            events = _feed(parser, generated_str, size)
+            assert events[0] == {'type': 'decision', 'decision': 'answer'}
+            assert ''.join(e['text'] for e in events if e['type'] == 'answer_delta') == 'RESP1'
+            assert events[-1] == {'type': 'end'}
+            assert parser.close() == prompt.parse_generated_str(generated_str)
+
+    def test_tool_calls(self):
+        prompt = MRPromptV2()
+        generated_str = '<|use_tool|><|tool_call_begin|>{"name": "get_ans", "arguments": "{\\"determine\\": true}"}<|tool_call_end|><|tool_call_begin|>{"name": "get_current_weather", "arguments": "{\\"location\\": \\"Taipei, Taiwan\\"}"}<|tool_call_end|><|im_end|>'
+        first_call_end = generated_str.index('<|tool_call_end|>') + len('<|tool_call_end|>')
+
+        parser = GeneratedStrParser(prompt)
+        events = parser.feed(generated_str[:first_call_end])
+        assert parser.decision == 'tool'
+        assert events[-1]['type'] == 'tool_call'
+        assert events[-1]['tool_call']['function'] == {'name': 'get_ans', 'arguments': '{"determine": true}'}
+
+        events += parser.feed(generated_str[first_call_end:])
+        assert [e['type'] for e in events] == ['decision', 'tool_call', 'tool_call', 'end']
+        conv = parser.close()
+        assert conv['tool_calls'] == [e['tool_call'] for e in events if e['type'] == 'tool_call']
+        for x in conv['tool_calls']:
+            del x['id']
+        expected = prompt.parse_generated_str(generated_str)
+        for x in expected['tool_calls']:
+            del x['id']
+        assert conv == expected
+
+    def test_flush_without_end_token(self):
+        prompt = MRPromptV2()
+        for generated_str in ['<|answer|> RESP1 <|', '<|answer|>RESP1 <|im_e', '<|ans']:
+            for size in range(1, len(generated_str) + 1):
+                parser = GeneratedStrParser(prompt)
+                events = _feed(parser, generated_str, size)
+                events += parser.flush()
+                conv = parser.close()
+                assert conv == prompt.parse_generated_str(generated_str)
+                assert ''.join(e['text'] for e in events if e['type'] == 'answer_delta') == conv['content']
+                assert events[0] == {'type': 'decision', 'decision': 'answer'} and events[-1] == {'type': 'end'}
+                assert parser.flush() == []
+
+        parser = GeneratedStrParser(prompt)
+        parser.feed('<|answer|>RESP1<|im_end|>')
+        assert parser.flush() == []
+
+    def test_v1(self):
+        prompt = MRPromptV1()
+        parser = GeneratedStrParser(prompt)
+        events = _feed(parser, ' RESP1</s>', 3)
+        assert ''.join(e['text'] for e in events if e['type'] == 'answer_delta') == 'RESP1'
+        assert parser.close() == {'role': 'assistant', 'content': 'RESP1'}
+
+
+class TestStopSequenceDetector:
+
+    def test_split_token(self):
+        detector = StopSequenceDetector.from_prompt(MRPromptV2())
+        assert detector.feed('<|answer|>RESP1<|im_') is None
+        assert detector.feed('end|>') == {'reason': 'instance_end', 'token': '<|im_end|>', 'start': 15, 'end': 25}
+        assert detector.feed('more') == detector.match
+
+    def test_runaway(self):
+        generated_str = '<|use_tool|><|tool_call_begin|>{"name": "F", "arguments": "{}"}<|tool_call_end|>'
+        detector = StopSequenceDetector.from_prompt(MRPromptV2())
+        assert detector.feed(generated_str + '<|tool_call_begin|>{"name": "G", "arguments": "{}"}<|tool_call_end|>\n<|im') is None
+        assert detector.feed('_end|>')['reason'] == 'instance_end'
+
+        detector.reset()
+        assert detector.feed(generated_str + '<|tool_call_b') is None
+        assert detector.feed('ogus') == {'reason': 'runaway', 'token': None, 'start': len(generated_str), 'end': len(generated_str)}
+
+    def test_v1(self):
+        detector = StopSequenceDetector.from_prompt(MRPromptV1())
+        assert detector.feed('RESP1 <|im_end|>') is None
+        assert detector.feed('</') is None
+        assert detector.feed('s>')['reason'] == 'eos'
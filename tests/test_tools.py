@@ -0,0 +1,162 @@
+import json
+import threading
+import time
+
+from mtkresearch.llm.chat import MRChatManager
+from mtkresearch.llm.prompt import MRPromptV2
+from mtkresearch.llm.tools import ToolDispatcher, ToolResultCache
+
+
+FUNCTIONS = [
+    {
+        'name': 'F',
+        'description': 'F-D',
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                'x': {
+                    'type': 'integer'
+                },
+                'y': {
+                    'type': 'integer',
+                    'default': 1
+                }
+            },
+            'required': ['x']
+        }
+    },
+    {
+        'name': 'G',
+        'description': 'G-D',
+        'parameters': None
+    }
+]
+
+
+def add(x, y):
+    return x + y
+
+
+def generated(*calls):
+    return '<|use_tool|>' + ''.join(
+        '<|tool_call_begin|>' + json.dumps({'name': name, 'arguments': json.dumps(arguments)}) + '<|tool_call_end|>'
+        for name, arguments in calls
+    ) + '<|im_end|>'
+
+
+class TestToolDispatcher:
+
+    def test_thread_pool(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def f(x, y):
+            barrier.wait()  # both calls run at the same time
+            return {'sum': x + y}
+
+        manager = MRChatManager(MRPromptV2(), functions=FUNCTIONS)
+        manager.user_input('Q1')
+        with ToolDispatcher({'F': f}, max_workers=2) as dispatcher:
+            result = dispatcher.step(manager, generated(('F', {'x': 1}), ('F', {'x': 2, 'y': 5})))
+
+        assert result['results'] == [{'sum': 2}, {'sum': 7}]
+        assert [x['tool_call_id'] for x in manager.conversations[-2:]] == [x['id'] for x in result['func_calls']]
+        assert manager.get_prompt() == MRPromptV2().get_prompt(manager.conversations, FUNCTIONS)
+
+    def test_process_pool(self):
+        manager = MRChatManager(MRPromptV2(), functions=FUNCTIONS)
+        manager.user_input('Q1')
+        with ToolDispatcher({'F': add}, executor='process', max_workers=2) as dispatcher:
+            result = dispatcher.step(manager, generated(('F', {'x': 1}), ('F', {'x': 2, 'y': 5})))
+        assert result['results'] == [{'result': 2}, {'result': 7}]
+
+    def test_errors(self):
+        submitted = []
+
+        def f(x, y):
+            submitted.append(x)
+            time.sleep(x / 5)
+            return {}
+
+        def g():
+            raise RuntimeError('failed')
+
+        manager = MRChatManager(MRPromptV2(), functions=FUNCTIONS)
+        manager.user_input('Q1')
+        with ToolDispatcher({'F': f}, timeout=0.1) as dispatcher:
+            dispatcher.register('G', g)
+            result = dispatcher.step(manager, generated(('F', {'x': 'a'}), ('F', {'x': 1}), ('G', {}), ('H', {})))
+
+        assert submitted == [1]  # the invalid call is never submitted
+        assert result['results'] == [
+            {'error': "ValueError: Incorrect type for 'x': Expected integer, got str"},
+            {'error': 'TimeoutError: No result after 0.1 seconds'},
+            {'error': 'RuntimeError: failed'},
+            {'error': "KeyError: Unknown tool: 'H'"}
+        ]
+        assert len(manager.conversations) == 6
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestToolResultCache:
+
+    def test_key(self):
+        cache = ToolResultCache()
+        cache.register('F')
+        assert cache.key('F', {'x': 1, 'y': 2}) == cache.key('F', {'y': 2, 'x': 1})
+        assert cache.key('F', {'x': 1}) != cache.key('F', {'x': 2})
+        assert cache.key('G', {'x': 1}) is None  # not idempotent
+
+    def test_lru_and_ttl(self):
+        clock = FakeClock()
+        cache = ToolResultCache(max_size=2, clock=clock)
+        cache.register('F', ttl=10)
+        cache.register('G')
+        a, b, c = cache.key('F', {'x': 1}), cache.key('G', {'x': 2}), cache.key('G', {'x': 3})
+        cache.put(a, {'r': 1})
+        cache.put(b, {'r': 2})
+        assert cache.get(a) == {'r': 1}
+        cache.put(c, {'r': 3})
+        assert cache.get(b) is None  # least recently used
+        clock.now = 10
+        assert cache.get(a) is None  # expired
+        assert cache.get(c) == {'r': 3}
+        assert cache.stats() == {'hits': 2, 'misses': 2, 'size': 1}
+
+    def test_dispatcher(self):
+        calls = []
+
+        def f(x, y):
+            calls.append((x, y))
+            return {'sum': x + y}
+
+        cache = ToolResultCache()
+        with ToolDispatcher(executor='thread', cache=cache) as dispatcher:
+            dispatcher.register('F', f, idempotent=True)
+            for _ in range(2):
+                manager = MRChatManager(MRPromptV2(), functions=FUNCTIONS)
+                manager.user_input('Q1')
+                # the defaults are filled in before the key is built
+                result = dispatcher.step(manager, generated(('F', {'x': 1}), ('F', {'y': 1, 'x': 1})))
+                assert result['results'] == [{'sum': 2}, {'sum': 2}]
+
+        assert calls == [(1, 1), (1, 1)]  # both calls of the first turn missed
+        assert cache.stats() == {'hits': 2, 'misses': 2, 'size': 1}
+
+    def test_errors_are_not_cached(self):
+        def g():
+            raise RuntimeError('failed')
+
+        cache = ToolResultCache()
+        with ToolDispatcher(executor='thread', cache=cache) as dispatcher:
+            dispatcher.register('G', g, idempotent=True)
+            manager = MRChatManager(MRPromptV2(), functions=FUNCTIONS)
+            manager.user_input('Q1')
+            dispatcher.step(manager, generated(('G', {})))
+        assert len(cache) == 0